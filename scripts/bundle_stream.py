@@ -0,0 +1,208 @@
+import codecs
+import hashlib
+import json
+from typing import Iterable, Iterator, List, Mapping
+
+import orjson
+
+# 1 MiB reads, a bundle is never held in memory, only the entry being decoded
+CHUNK_SIZE = 1024 * 1024
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER = '0123456789+-.eE'
+
+
+class BundleReader:
+    """Iterate the entries of a FHIR Bundle one at a time, in memory bounded by the largest entry.
+
+    Top level elements other than `entry` are collected in `header`, elements that follow
+    `entry` in the file are only available after iteration. `md5` and `size` of the file
+    are available after iteration.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.header = {}
+        self.md5 = None
+        self.size = None
+        self._decoder = json.JSONDecoder()
+
+    def __iter__(self) -> Iterator[dict]:
+        md5_hash = hashlib.md5()
+        size = 0
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        buffer = ''
+        pos = 0
+        eof = False
+
+        with open(self.path, 'rb') as fp:
+
+            def _fill(minimum):
+                """Append at least minimum bytes (or the rest of the file) to the buffer."""
+                nonlocal buffer, pos, size, eof
+                if pos:
+                    buffer = buffer[pos:]
+                    pos = 0
+                data = fp.read(max(minimum, self.chunk_size))
+                md5_hash.update(data)
+                size += len(data)
+                eof = not data
+                buffer += text_decoder.decode(data, final=eof)
+
+            def _skip_whitespace():
+                nonlocal pos
+                while True:
+                    while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                        pos += 1
+                    if pos < len(buffer) or eof:
+                        return
+                    _fill(0)
+
+            def _expect(*tokens) -> str:
+                nonlocal pos
+                _skip_whitespace()
+                if pos >= len(buffer) or buffer[pos] not in tokens:
+                    found = buffer[pos:pos + 20] if pos < len(buffer) else 'end of file'
+                    raise json.JSONDecodeError(f"Expecting one of {tokens!r}, found {found!r}", buffer, pos)
+                pos += 1
+                return buffer[pos - 1]
+
+            def _value():
+                """Decode the next value, reading more until it is complete."""
+                nonlocal pos
+                _skip_whitespace()
+                while True:
+                    try:
+                        value, end = self._decoder.raw_decode(buffer, pos)
+                        # a number may continue in the next chunk, e.g. `0.` | `0001`, complete once
+                        # a non-number character follows
+                        following = end
+                        if isinstance(value, (int, float)):
+                            while following < len(buffer) and buffer[following] in _NUMBER:
+                                following += 1
+                        if following < len(buffer) or eof:
+                            pos = end
+                            return value
+                    except json.JSONDecodeError:
+                        if eof:
+                            raise
+                    # grow geometrically, large entries are decoded a bounded number of times
+                    _fill(len(buffer) - pos)
+
+            _fill(0)
+            _expect('{')
+            _skip_whitespace()
+            if buffer[pos:pos + 1] == '}':
+                pos += 1
+            else:
+                while True:
+                    key = _value()
+                    _expect(':')
+                    if key == 'entry':
+                        _expect('[')
+                        _skip_whitespace()
+                        if buffer[pos:pos + 1] == ']':
+                            pos += 1
+                        else:
+                            while True:
+                                yield _value()
+                                if _expect(',', ']') == ']':
+                                    break
+                    else:
+                        self.header[key] = _value()
+                    if _expect(',', '}') == '}':
+                        break
+
+            # drain trailing whitespace, md5 and size cover the whole file
+            _skip_whitespace()
+            if pos < len(buffer):
+                raise json.JSONDecodeError('Extra data', buffer, pos)
+            self.md5 = md5_hash.hexdigest()
+            self.size = size
+
+
+def iter_bundle_resources(path, chunk_size=CHUNK_SIZE) -> Iterator[dict]:
+    """Yield each entry.resource of a FHIR Bundle, raises AssertionError if path is not a Bundle."""
+    reader = BundleReader(path, chunk_size=chunk_size)
+    for entry in reader:
+        # synthea writes resourceType first, fhirclient's as_json() after entry, checked once read
+        assert reader.header.get('resourceType', 'Bundle') == 'Bundle', f"{path} is not a FHIR bundle"
+        yield entry['resource']
+    assert reader.header.get('resourceType') == 'Bundle', f"{path} is not a FHIR bundle"
+
+
+def iter_reference_dicts(obj) -> Iterator[dict]:
+    """Yield the Reference elements (dicts with a `reference`) in a resource dict."""
+    if isinstance(obj, dict):
+        if isinstance(obj.get('reference'), str):
+            yield obj
+            return
+        for value in obj.values():
+            if isinstance(value, (dict, list)):
+                yield from iter_reference_dicts(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            if isinstance(value, (dict, list)):
+                yield from iter_reference_dicts(value)
+
+
+def local_references(entries: Iterable[dict]) -> dict:
+    """fullUrl and ResourceType/id of each entry -> ResourceType/id, the references a bundle's entries resolve."""
+    references = {}
+    for entry in entries:
+        resource = entry['resource']
+        relative_path = f"{resource['resourceType']}/{resource['id']}"
+        references[relative_path] = relative_path
+        if entry.get('fullUrl'):
+            references[entry['fullUrl']] = relative_path
+    return references
+
+
+def rewrite_references(resource: dict, references: Mapping[str, str]) -> List[dict]:
+    """Rewrite the References of resource found in references, e.g. local_references(), returns the rest."""
+    unresolved = []
+    for reference in iter_reference_dicts(resource):
+        if reference['reference'] in references:
+            reference['reference'] = references[reference['reference']]
+        else:
+            unresolved.append(reference)
+    return unresolved
+
+
+class BundleWriter:
+    """Write a FHIR Bundle entry by entry to a binary file.
+
+    with BundleWriter(fp, {'resourceType': 'Bundle', 'type': 'transaction'}) as writer:
+        writer.write(entry)
+    """
+
+    def __init__(self, fp, header: dict):
+        self.fp = fp
+        self.bytes_written = 0
+        self._entry_count = 0
+        self._write(b'{')
+        for key, value in header.items():
+            if key == 'entry':
+                continue
+            self._write(orjson.dumps(key) + b':' + orjson.dumps(value) + b',')
+        self._write(b'"entry":[')
+
+    def _write(self, data: bytes):
+        self.bytes_written += self.fp.write(data)
+
+    def write(self, entry: dict):
+        if self._entry_count:
+            self._write(b',')
+        self._write(orjson.dumps(entry))
+        self._entry_count += 1
+
+    def close(self):
+        self._write(b']}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
@@ -1,13 +1,29 @@
 import asyncio
+import collections
+import contextlib
+import functools
+import heapq
+import http.server
+import io
+import itertools
 import logging
+import os
+import random
+import threading
 import time
+import urllib.parse
+import zlib
 from pathlib import Path
-from typing import Iterator
+from typing import Iterable, Iterator, List
 
 import aiohttp
 import click
+import orjson
 from fhirclient.models.bundle import BundleEntryRequest
 
+from bundle_stream import BundleReader, iter_bundle_resources, iter_reference_dicts, local_references, rewrite_references
+from load_ledger import LEDGER_PATH, LoadLedger
+
 logging.basicConfig(format='%(asctime)s %(message)s',  encoding='utf-8', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -22,6 +38,9 @@ def bundle_entry_request_as_json(self, strict=True):
 
 BundleEntryRequest.as_json = bundle_entry_request_as_json
 
+# 256 KiB reads when compressing from disk
+GZIP_CHUNK_SIZE = 256 * 1024
+
 headers = {
     "Content-Type": "application/fhir+json;charset=utf-8",
     # https://hapifhir.io/hapi-fhir/docs/server_jpa/performance.html#disable-upsert-existence-check
@@ -29,88 +48,483 @@ headers = {
 }
 
 
-async def load(path, url):
-    """Read a bundle, load it to server."""
-    print(path)
-    session = None
+class AdaptiveSplit:
+    """Sub-bundle size limits, additive increase / multiplicative decrease on the observed latency.
+
+    Limits start at, and never exceed, max_entries and max_bytes. Shared by all workers.
+    """
+
+    MINIMUM_SCALE = 1 / 64
+    INCREASE = 0.05
+
+    def __init__(self, max_entries: int, max_bytes: int, target_latency: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.scale = 1.0
+
+    @property
+    def entries(self) -> int:
+        return max(1, int(self.max_entries * self.scale))
+
+    @property
+    def bytes(self) -> int:
+        return max(1, int(self.max_bytes * self.scale))
+
+    def observe(self, latency: float):
+        if latency > self.target_latency:
+            self.scale = max(self.MINIMUM_SCALE, self.scale / 2)
+            logger.info(f"{latency:0.1f} seconds > {self.target_latency} sub-bundles now {self.entries} entries, "
+                        f"{self.bytes} bytes")
+        else:
+            self.scale = min(1.0, self.scale + self.INCREASE)
+
+
+def _split_entries(entries: List[dict]) -> List[dict]:
+    """Make entries independent transactions: urn:uuid references become ResourceType/id, requests PUT.
+
+    Returns the entries ordered so that referenced entries come first.
+    """
+    references = local_references(entries)
+    position = {}
+    dependencies = []
+    for entry in entries:
+        resource = entry['resource']
+        relative_path = f"{resource['resourceType']}/{resource['id']}"
+        position[relative_path] = len(dependencies)
+        if entry.get('fullUrl', '').startswith('urn:uuid:'):
+            del entry['fullUrl']
+        # preserve the ids, see bundle_entry_request_as_json
+        entry['request'] = {'method': 'PUT', 'url': relative_path}
+        rewrite_references(resource, references)
+        depends_on = {reference['reference'] for reference in iter_reference_dicts(resource)
+                      if reference['reference'] in references and reference['reference'] != relative_path}
+        dependencies.append(depends_on)
+
+    # Kahn's algorithm, ties keep file order
+    dependents = [[] for _ in entries]
+    waiting = []
+    for index, depends_on in enumerate(dependencies):
+        waiting.append(len(depends_on))
+        for relative_path in depends_on:
+            dependents[position[relative_path]].append(index)
+    ready = [index for index, count in enumerate(waiting) if count == 0]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        index = heapq.heappop(ready)
+        ordered.append(index)
+        for dependent in dependents[index]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                heapq.heappush(ready, dependent)
+    if len(ordered) < len(entries):
+        # reference cycle, the rest keep file order
+        cycle = sorted(set(range(len(entries))) - set(ordered))
+        logger.warning(f"{len(cycle)} entries are in a reference cycle, kept in file order")
+        ordered.extend(cycle)
+    return [entries[index] for index in ordered]
+
+
+def _sub_bundle(serialized_entries: List[bytes]) -> List[bytes]:
+    """Chunks of a transaction bundle."""
+    chunks = [b'{"resourceType":"Bundle","type":"transaction","entry":[']
+    for index, serialized_entry in enumerate(serialized_entries):
+        if index:
+            chunks.append(b',')
+        chunks.append(serialized_entry)
+    chunks.append(b']}')
+    return chunks
+
+
+class GzipBody:
+    """Request body that gzips chunks as they are sent, the compressed body is never held in memory."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = chunks
+        self.wire_bytes = 0
+
+    async def __aiter__(self):
+        # wbits=31, gzip container
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in self.chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                self.wire_bytes += len(compressed)
+                yield compressed
+        compressed = compressor.flush()
+        self.wire_bytes += len(compressed)
+        yield compressed
+
+
+def _file_chunks(fp) -> Iterator[bytes]:
+    return iter(lambda: fp.read(GZIP_CHUNK_SIZE), b'')
+
+
+class Retry:
+    """Bounded exponential backoff with full jitter for 429, 5xx and timeouts."""
+
+    STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_retries: int = 6, base: float = 1.0, maximum: float = 60.0):
+        self.max_retries = max_retries
+        self.base = base
+        self.maximum = maximum
+
+    def delay(self, attempt: int, retry_after: str = None) -> float:
+        """Seconds to wait before retry attempt (0 based), at least the server's Retry-After."""
+        delay = random.uniform(0, min(self.maximum, self.base * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.maximum, float(retry_after)))
+        return delay
+
+
+class RetryableError(Exception):
+    """A response worth retrying."""
+
+    def __init__(self, status: int, retry_after: str = None):
+        super().__init__(f"HTTP {status}")
+        self.retry_after = retry_after
+
+
+async def _post_once(session: aiohttp.ClientSession, url, body, size: int, compress: bool) -> (float, int):
+    """POST a transaction, returns the latency and bytes on the wire."""
+    tic = time.perf_counter()
+    if compress:
+        data = GzipBody(_file_chunks(body) if isinstance(body, io.IOBase) else body)
+        request_headers = {'Content-Encoding': 'gzip'}
+    else:
+        data = body if isinstance(body, io.IOBase) else b''.join(body)
+        request_headers = None
+    async with session.post(url=url, data=data, headers=request_headers) as response:
+        if response.status in Retry.STATUSES:
+            raise RetryableError(response.status, response.headers.get('Retry-After'))
+        if response.status != 200:
+            logger.error(await response.json())
+        response.raise_for_status()
+        await response.read()
+    return time.perf_counter() - tic, data.wire_bytes if compress else size
+
+
+async def _post(session: aiohttp.ClientSession, url, open_body, size: int, compress: bool,
+                retry: Retry = None) -> (float, int):
+    """_post_once, retried. open_body() returns a context manager of a fresh body (an open file or chunks)."""
+    retry = retry or Retry(max_retries=0)
+    for attempt in itertools.count():
+        try:
+            with open_body() as body:
+                return await _post_once(session, url, body, size, compress)
+        except (RetryableError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            if attempt >= retry.max_retries:
+                raise
+            delay = retry.delay(attempt, getattr(e, 'retry_after', None))
+            logger.warning(f"{e.__class__.__name__} {e}, retry {attempt + 1} of {retry.max_retries} in {delay:0.1f} seconds")
+            await asyncio.sleep(delay)
+
+
+def _rate(size: int, wire_bytes: int, latency: float) -> str:
+    """Throughput for the log, with the compression ratio when compressed."""
+    rate = f"{size / latency / 1e6:0.2f} MB/s"
+    if wire_bytes != size:
+        rate += f" {wire_bytes / latency / 1e6:0.2f} MB/s on the wire, {size / max(wire_bytes, 1):0.1f}x"
+    return rate
+
+
+async def load(session: aiohttp.ClientSession, path, url, split: AdaptiveSplit = None, compress: bool = False,
+               retry: Retry = None) -> int:
+    """Read a bundle, load it to server, returns bytes sent on the wire.
+
+    With split, the bundle is sent as sequential sub-transactions sized by split.
+    With compress, bodies are gzipped as they are sent.
+    With retry, failed requests are retried, a sub-transaction on its own.
+    """
+    tic = time.perf_counter()
+    if not split:
+        # streamed from disk
+        size = os.path.getsize(path)
+        latency, wire_bytes = await _post(session, url, lambda: open(path, 'rb'), size, compress, retry)
+        logger.info(f"POST {path} {latency:0.4f} seconds {_rate(size, wire_bytes, latency)}")
+        return wire_bytes
+
+    entries = [orjson.dumps(entry) for entry in _split_entries(list(BundleReader(path)))]
+    sent = 0
+    sub_bundle_count = 0
+    start = 0
+    while start < len(entries):
+        # limits may have changed while the last sub-bundle was in flight
+        end = start + 1
+        size = len(entries[start])
+        while end < len(entries) and end - start < split.entries and size + len(entries[end]) <= split.bytes:
+            size += len(entries[end])
+            end += 1
+        chunks = _sub_bundle(entries[start:end])
+        size = sum(len(chunk) for chunk in chunks)
+        latency, wire_bytes = await _post(session, url, lambda: contextlib.nullcontext(chunks), size, compress, retry)
+        split.observe(latency)
+        logger.info(f"POST {path} entries {start}-{end} {latency:0.4f} seconds {_rate(size, wire_bytes, latency)}")
+        sent += wire_bytes
+        sub_bundle_count += 1
+        start = end
+    toc = time.perf_counter()
+    logger.info(f"POST {path} {sub_bundle_count} sub-bundles {toc - tic:0.4f} seconds {sent / (toc - tic) / 1e6:0.2f} MB/s")
+    return sent
+
+
+async def load_paths(session: aiohttp.ClientSession, paths: List[Path], url, concurrency,
+                     split: AdaptiveSplit = None, compress: bool = False, retry: Retry = None,
+                     ledger: LoadLedger = None) -> (int, dict):
+    """Keep concurrency requests in flight until all paths are loaded.
+
+    A bundle that fails after its retries is skipped, returns bytes sent and path -> error of the failures.
+    """
+    queue = asyncio.Queue()
+    for path in paths:
+        queue.put_nowait(path)
+    sent = 0
+    failures = {}
+
+    async def _worker():
+        nonlocal sent
+        while True:
+            try:
+                path = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                sent += await load(session, path, url, split, compress, retry)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError, ValueError) as e:
+                logger.error(f"FAILED {path} {e.__class__.__name__} {e}")
+                failures[str(path)] = f"{e.__class__.__name__} {e}"
+                continue
+            if ledger:
+                ledger.record(url, path)
+
+    workers = [asyncio.create_task(_worker()) for _ in range(min(concurrency, len(paths)))]
     try:
-        tic = time.perf_counter()
-        with open(path, 'r') as data:
-            bundle = data.read()
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.post(url=url, data=bundle) as response:
-                if response.status != 200:
-                    logger.error(await response.json())
-                response.raise_for_status()
-        session = None
-        toc = time.perf_counter()
-        logger.info(f"POST {path} {toc - tic:0.4f} seconds")
-        return True
+        await asyncio.gather(*workers)
     finally:
-        if session:
-            await session.close()
+        for worker in workers:
+            worker.cancel()
+    return sent, failures
+
+
+def _dependency_paths(coherent_path) -> List[str]:
+    """Bundles of the resources patients reference, in load order."""
+    # TODO - does Medication, etc. belong here too?
+    return [f'{coherent_path}/fhir/organizations.json', f'{coherent_path}/fhir/practitioners.json']
+
+
+def _patient_paths(coherent_path) -> List[Path]:
+    return sorted([p for p in Path(f'{coherent_path}/fhir/').glob('*.json') if
+                   'organizations' not in str(p) and 'practitioners' not in str(p)])
+
+
+async def load_all(coherent_path, url, chunk_size, split: AdaptiveSplit = None, compress: bool = False,
+                   retry: Retry = None, ledger: LoadLedger = None) -> dict:
+    """Load all the bundles, skip those the ledger has recorded, returns path -> error of the failures."""
+    tic = time.perf_counter()
+    # one session, connections are reused across bundles
+    connector = aiohttp.TCPConnector(limit=chunk_size, limit_per_host=chunk_size)
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        # load dependencies in order, resources that must exist prior
+        paths = _dependency_paths(coherent_path)
+        print(paths)
+        # bytes on the wire
+        sent = 0
+        for path in paths:
+            if ledger and ledger.loaded(url, path):
+                logger.info(f"SKIP {path} already loaded")
+                continue
+            # patients can't load without them, a failure stops the run
+            sent += await load(session, path, url, split, compress, retry)
+            if ledger:
+                ledger.record(url, path)
+
+        # get all the patients
+        paths = _patient_paths(coherent_path)
+        if ledger:
+            remaining = [path for path in paths if not ledger.loaded(url, path)]
+            logger.info(f"{len(paths) - len(remaining)} bundles already loaded, loading {len(remaining)}")
+            paths = remaining
+
+        # doing this as a maximum of 3 seems to work when combined with nice -10 on a laptop
+        sent_, failures = await load_paths(session, paths, url, chunk_size, split, compress, retry, ledger)
+        sent += sent_
+
+    toc = time.perf_counter()
+    logger.info(f"Loaded {len(paths) - len(failures)} bundles, {sent / 1e6:0.1f} MB in {toc - tic:0.1f} seconds "
+                f"{sent / (toc - tic) / 1e6:0.2f} MB/s")
+    return failures
+
 
+def _conditional_references(resource: dict) -> Iterator[str]:
+    """The conditional references that resolve to resource, e.g. Practitioner?identifier=system|value."""
+    for identifier in resource.get('identifier', []):
+        if identifier.get('system') and identifier.get('value'):
+            yield f"{resource['resourceType']}?identifier={identifier['system']}|{identifier['value']}"
 
-def _chunker(seq: Iterator, size: int) -> Iterator:
-    """Iterate over a list in chunks.
 
-    Args:
-        seq: an iterable
-        size: desired chunk size
+class NdjsonStaging:
+    """Write the resources of bundles to <staging_path>/<ResourceType>.ndjson for $import.
 
-    Returns:
-        an iterator that returns lists of size or less
+    $import does not resolve urn:uuid or conditional references, they are rewritten to ResourceType/id.
+    Conditional references resolve against the identifiers of bundles passed to index().
     """
-    return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
+    def __init__(self, staging_path: Path):
+        self.staging_path = Path(staging_path)
+        self.staging_path.mkdir(parents=True, exist_ok=True)
+        self.conditional_references = {}
+        self.unresolved = 0
+        self._emitters = {}
 
-async def load_all(coherent_path, url, chunk_size):
-    """Load all the bundles"""
+    def index(self, path):
+        """Resolve conditional references to the resources in path, e.g. organizations and practitioners."""
+        for resource in iter_bundle_resources(path):
+            for conditional_reference in _conditional_references(resource):
+                self.conditional_references[conditional_reference] = f"{resource['resourceType']}/{resource['id']}"
 
-    # load dependencies in order, resources that must exist prior
-    # TODO - does Medication, etc. belong here too?
-    paths = [f'{coherent_path}/fhir/organizations.json', f'{coherent_path}/fhir/practitioners.json']
-    print(paths)
-    ok = False
-    for chunk in _chunker(paths, 1):
-        tasks = []
-        for path in chunk:
-            task = asyncio.create_task(load(path=path, url=url))
-            tasks.append(task)
-
-        ok = all([
-            await ok_
-            for ok_ in asyncio.as_completed(tasks)
-        ])
-
-    assert ok, "Did not load dependencies"
-
-    # get all the patients
-    paths = sorted([p for p in Path(f'{coherent_path}/fhir/').glob('*.json') if
-                    'organizations' not in str(p) and 'practitioners' not in str(p)])
-
-    # doing this as a maximum of 3 seems to work when combined with nice -10 on a laptop
-    limit = None
-    count = 0
-    for chunk in _chunker(paths, chunk_size):
-        tasks = []
-
-        for path in chunk:
-            task = asyncio.create_task(load(path=path, url=url))
-            tasks.append(task)
-            count += 1
-            if limit and count == limit:
-                break
-
-        ok = all([
-            await ok_
-            for ok_ in asyncio.as_completed(tasks)
-        ])
-
-        if limit and count == limit:
-            break
-
-    assert ok, "Did not load bundles"
+    def write(self, path):
+        """Append the resources of the bundle at path."""
+        entries = list(BundleReader(path))
+        references = collections.ChainMap(local_references(entries), self.conditional_references)
+        for entry in entries:
+            resource = entry['resource']
+            for reference in rewrite_references(resource, references):
+                if '?' in reference['reference']:
+                    self.unresolved += 1
+            resource_type = resource['resourceType']
+            if resource_type not in self._emitters:
+                self._emitters[resource_type] = open(self.staging_path.joinpath(f"{resource_type}.ndjson"), 'wb')
+            self._emitters[resource_type].write(orjson.dumps(resource) + b'\n')
+
+    def close(self) -> dict:
+        """Close the files, returns ResourceType -> path."""
+        for fp in self._emitters.values():
+            fp.close()
+        if self.unresolved:
+            logger.warning(f"{self.unresolved} conditional references did not resolve, they are imported as is")
+        return {resource_type: Path(fp.name) for resource_type, fp in sorted(self._emitters.items())}
+
+
+class _StagingRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+@contextlib.contextmanager
+def serve_staging(staging_path, host: str, port: int, bind: str = '127.0.0.1') -> Iterator[str]:
+    """Serve staging_path over http from a thread, yields the base url.
+
+    Stands in for the https, s3 etc. location a production server imports from.
+    host must be reachable from the FHIR server, e.g. host.docker.internal, port 0 is any free port.
+    bind is the interface listened on, the staged files are patient data, loopback unless the server needs more.
+    """
+    handler = functools.partial(_StagingRequestHandler, directory=str(staging_path))
+    server = http.server.ThreadingHTTPServer((bind, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://{host}:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def import_parameters(ndjson_paths: dict, staging_url: str) -> dict:
+    """Bulk Data $import Parameters, see https://hl7.org/fhir/uv/bulkdata/"""
+    staging_url = staging_url if staging_url.endswith('/') else f"{staging_url}/"
+    scheme = urllib.parse.urlparse(staging_url).scheme
+    parameters = [
+        {'name': 'inputFormat', 'valueCode': 'application/fhir+ndjson'},
+        {'name': 'inputSource', 'valueUri': staging_url},
+        {'name': 'storageDetail',
+         'part': [{'name': 'type', 'valueCode': 'https' if scheme.startswith('http') else scheme}]},
+    ]
+    for resource_type, path in ndjson_paths.items():
+        parameters.append({'name': 'input', 'part': [
+            {'name': 'type', 'valueCode': resource_type},
+            {'name': 'url', 'valueUri': urllib.parse.urljoin(staging_url, path.name)},
+        ]})
+    return {'resourceType': 'Parameters', 'parameter': parameters}
+
+
+async def bulk_import(session: aiohttp.ClientSession, url, parameters: dict, poll_interval: float,
+                      retry: Retry = None) -> dict:
+    """Kick off $import, poll its status url until complete, returns the completion response."""
+    retry = retry or Retry(max_retries=0)
+    async with session.post(url=f"{url}/$import", data=orjson.dumps(parameters),
+                            headers={'Prefer': 'respond-async'}) as response:
+        if response.status != 202:
+            logger.error(await response.text())
+            response.raise_for_status()
+            raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                              message='$import did not respond 202 Accepted')
+        status_url = response.headers['Content-Location']
+    logger.info(f"$import accepted, polling {status_url}")
+
+    attempt = 0
+    delay = poll_interval
+    while True:
+        await asyncio.sleep(delay)
+        async with session.get(status_url) as response:
+            retry_after = response.headers.get('Retry-After')
+            if response.status == 202:
+                logger.info(f"$import {response.headers.get('X-Progress', 'in progress')}")
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else poll_interval
+                attempt = 0
+                continue
+            if response.status in Retry.STATUSES and attempt < retry.max_retries:
+                delay = retry.delay(attempt, retry_after)
+                attempt += 1
+                logger.warning(f"$import status HTTP {response.status}, retry {attempt} of {retry.max_retries} "
+                               f"in {delay:0.1f} seconds")
+                continue
+            if response.status != 200:
+                logger.error(await response.text())
+                response.raise_for_status()
+            return await response.json(content_type=None)
+
+
+async def import_all(coherent_path, url, staging_path: Path, staging_url: str, poll_interval: float,
+                     retry: Retry = None, ledger: LoadLedger = None):
+    """Write the bundles the ledger has not recorded as ndjson, load them with a single $import."""
+    tic = time.perf_counter()
+    staging = NdjsonStaging(staging_path)
+    paths = []
+    for path in _dependency_paths(coherent_path):
+        # conditional references of patients resolve to them, loaded or not
+        staging.index(path)
+        paths.append(path)
+    paths.extend(_patient_paths(coherent_path))
+    if ledger:
+        remaining = [path for path in paths if not ledger.loaded(url, path)]
+        logger.info(f"{len(paths) - len(remaining)} bundles already loaded, importing {len(remaining)}")
+        paths = remaining
+    if not paths:
+        return
+    for path in paths:
+        staging.write(path)
+    ndjson_paths = staging.close()
+    size = sum(os.path.getsize(path) for path in ndjson_paths.values())
+    toc = time.perf_counter()
+    logger.info(f"Wrote {len(ndjson_paths)} ndjson files, {size / 1e6:0.1f} MB to {staging_path} "
+                f"in {toc - tic:0.1f} seconds")
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        completion = await bulk_import(session, url, import_parameters(ndjson_paths, staging_url), poll_interval, retry)
+    for output in completion.get('output', []):
+        logger.info(f"$import {output.get('type', '')} {output.get('count', '')} {output.get('url', '')}")
+    errors = completion.get('error', [])
+    for error in errors:
+        logger.error(f"$import error {error.get('type', '')} {error.get('url', '')}")
+    assert not errors, f"$import reported {len(errors)} errors"
+    if ledger:
+        for path in paths:
+            ledger.record(url, path)
+    toc = time.perf_counter()
+    logger.info(f"Imported {len(paths)} bundles, {size / 1e6:0.1f} MB in {toc - tic:0.1f} seconds "
+                f"{size / (toc - tic) / 1e6:0.2f} MB/s")
 
 
 @click.command()
@@ -119,10 +533,66 @@ async def load_all(coherent_path, url, chunk_size):
 @click.option('--url', default="http://localhost:8090/fhir", show_default=True,
               help='url to HAPI FHIR server')
 @click.option('--chunk_size', default=5, show_default=True,
-              help='Number of simultaneous loaders')
-def main(coherent_path, url, chunk_size):
+              help='Number of requests in flight')
+@click.option('--split_entries', default=0, show_default=True,
+              help='Maximum entries per sub-transaction, 0 to POST each bundle whole. A split bundle is loaded as '
+                   'several transactions, it is no longer atomic: a failure can leave part of it on the server')
+@click.option('--split_bytes', default=5_000_000, show_default=True,
+              help='Maximum bytes per sub-transaction')
+@click.option('--target_latency', default=10.0, show_default=True,
+              help='Seconds, slower sub-transactions halve the sub-transaction size, faster ones grow it back')
+@click.option('--gzip/--no-gzip', 'compress', default=False, show_default=True,
+              help='Stream request bodies through gzip, Content-Encoding: gzip')
+@click.option('--mode', default='transaction', show_default=True, type=click.Choice(['transaction', 'import']),
+              help='POST a transaction per bundle, or write ndjson and load it with a single Bulk Data $import')
+@click.option('--staging_path', default=None, show_default=True,
+              help='--mode import, directory of the ndjson, default <coherent_path>/import')
+@click.option('--staging_url', default=None, show_default=True,
+              help='--mode import, url the FHIR server reads staging_path from, e.g. https:// or file://. '
+                   'Default serves staging_path over http from this process')
+@click.option('--staging_host', default='localhost', show_default=True,
+              help='--mode import, host name of this process as seen by the FHIR server, e.g. host.docker.internal')
+@click.option('--staging_bind', default='127.0.0.1', show_default=True,
+              help='--mode import, interface to serve staging_path on. A FHIR server in docker can not reach '
+                   'loopback, set it explicitly, e.g. the docker bridge address 172.17.0.1, or 0.0.0.0 for all '
+                   'interfaces on a trusted network')
+@click.option('--staging_port', default=0, show_default=True,
+              help='--mode import, port to serve staging_path on, 0 is any free port')
+@click.option('--poll_interval', default=5.0, show_default=True,
+              help='--mode import, seconds between $import status requests unless the server sends Retry-After')
+@click.option('--max_retries', default=6, show_default=True,
+              help='Retries of a request after 429, 5xx or a timeout, with exponential backoff and jitter')
+@click.option('--backoff_base', default=1.0, show_default=True,
+              help='Seconds, the first retry waits up to this, doubling each retry')
+@click.option('--backoff_max', default=60.0, show_default=True,
+              help='Seconds, the longest wait between retries')
+@click.option('--ledger', 'ledger_path', default=LEDGER_PATH, show_default=True,
+              help='Records bundles loaded by path and md5, a restarted load skips them')
+@click.option('--resume/--no-resume', default=True, show_default=True,
+              help='Skip bundles the ledger has recorded, --no-resume loads everything again')
+def main(coherent_path, url, chunk_size, split_entries, split_bytes, target_latency, compress, mode, staging_path,
+         staging_url, staging_host, staging_bind, staging_port, poll_interval, max_retries, backoff_base, backoff_max,
+         ledger_path, resume):
     """Load coherent study into a FHIR server"""
-    asyncio.run(load_all(coherent_path, url, chunk_size))
+    split = AdaptiveSplit(split_entries, split_bytes, target_latency) if split_entries else None
+    ledger = LoadLedger(ledger_path)
+    if not resume:
+        ledger.forget(url)
+    retry = Retry(max_retries, backoff_base, backoff_max)
+    if mode == 'import':
+        staging_path = Path(staging_path or f'{coherent_path}/import')
+        with contextlib.ExitStack() as stack:
+            staging_url = staging_url or stack.enter_context(
+                serve_staging(staging_path, staging_host, staging_port, staging_bind)
+            )
+            asyncio.run(import_all(coherent_path, url, staging_path, staging_url, poll_interval, retry, ledger))
+        failures = {}
+    else:
+        failures = asyncio.run(load_all(coherent_path, url, chunk_size, split, compress, retry, ledger))
+    ledger.close()
+    for path, error in sorted(failures.items()):
+        logger.error(f"FAILED {path} {error}")
+    assert not failures, f"Did not load {len(failures)} bundles, run again to retry them"
     logger.info('done')
 
 
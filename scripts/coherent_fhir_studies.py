@@ -10,6 +10,8 @@ from fhirclient.models.fhirreference import FHIRReference
 from fhirclient.models.researchstudy import ResearchStudy
 from fhirclient.models.researchsubject import ResearchSubject
 
+from cohort_index import CohortIndex
+
 ACED_NAMESPACE = uuid.uuid3(uuid.NAMESPACE_DNS, 'aced-ipd.org')
 
 logging.basicConfig(format='%(asctime)s %(message)s',  encoding='utf-8', level=logging.INFO)
@@ -53,16 +55,56 @@ def cli():
               help='url to HAPI FHIR server')
 @click.option('--manifest', default="coherent_studies.manifest.yaml", show_default=True,
               help='Study names, conditions, expected counts, etc.')
-def test(url, manifest):
+@click.option('--cohort_index', default=None, show_default=True,
+              help='Optional. Check offline against the cohort_index.json written by ingest instead of the server')
+def test(url, manifest, cohort_index):
     """Check study manifest's patients with conditions counts."""
     study_manifests = yaml.load(open(manifest), yaml.SafeLoader)
+    if cohort_index:
+        cohort_index = CohortIndex.load(cohort_index)
     for name, values in study_manifests.items():
+        if 'expected_count' not in values:
+            continue
+        if cohort_index:
+            total = cohort_index.condition_count(values['conditions'])
+            assert total == values['expected_count'], (name, total)
+            continue
         response = requests.get(f"{url}/Condition?code={','.join(values['conditions'])}&_summary=count")
         assert response.json()['total'] == values['expected_count'],  (name, response.json())
 
     print('Condition counts OK.')
 
 
+@cli.command()
+@click.option('--cohort_index', default="output/cohort_index.json", show_default=True,
+              help='Written by ingest')
+@click.option('--any', 'any_of', multiple=True,
+              help='Condition code, patients with any of these codes. Repeat for each code.')
+@click.option('--all', 'all_of', multiple=True,
+              help='Condition code, patients with all of these codes. Repeat for each code.')
+@click.option('--manifest', default=None, show_default=True,
+              help='Optional. Query every study in the manifest, `conditions` are --any')
+@click.option('--patients/--no-patients', default=False, show_default=True,
+              help='Print the matching patient ids')
+def query(cohort_index, any_of, all_of, manifest, patients):
+    """Count patients by condition codes, offline."""
+    cohort_index = CohortIndex.load(cohort_index)
+    if manifest:
+        queries = {
+            name: (values['conditions'], all_of)
+            for name, values in yaml.load(open(manifest), yaml.SafeLoader).items() if values['conditions']
+        }
+    else:
+        queries = {'query': (any_of, all_of)}
+    for name, (any_of_, all_of_) in queries.items():
+        bitmap = cohort_index.query(any_of=any_of_, all_of=all_of_)
+        print(f"{name} has {cohort_index.patient_count(bitmap)} patients, "
+              f"{cohort_index.condition_count(any_of_)} conditions")
+        if patients:
+            for patient_id in cohort_index.patient_ids(bitmap):
+                print(f"  {patient_id}")
+
+
 @cli.command()
 @click.option('--url', default="http://localhost:8090/fhir", show_default=True,
               help='url to HAPI FHIR server')
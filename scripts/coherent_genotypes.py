@@ -0,0 +1,177 @@
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List
+
+import click
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+from bundle_stream import iter_bundle_resources
+
+logging.basicConfig(format='%(asctime)s %(message)s',  encoding='utf-8', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+GENOTYPES_VERSION = 1
+
+
+def _document_references(output_path: Path) -> Iterator[dict]:
+    """DocumentReferences written by ingest, from its bundles or ndjson."""
+    with open(output_path.joinpath('ingest_manifest.json')) as fp:
+        manifest = json.load(fp)
+    if manifest['settings']['output_format'] == 'ndjson':
+        with open(output_path.joinpath('ndjson', 'DocumentReference.ndjson'), 'rb') as fp:
+            for line in fp:
+                yield orjson.loads(line)
+        return
+    for entry in sorted(manifest['bundles'].values(), key=lambda entry: entry['patient_conditions']['bundle_file_path']):
+        for resource in iter_bundle_resources(entry['patient_conditions']['bundle_file_path']):
+            if resource['resourceType'] == 'DocumentReference':
+                yield resource
+
+
+def dna_document_references(output_path: Path) -> List[dict]:
+    """(document_reference_id, patient_id, path) of every DocumentReference with a _dna.csv attachment url."""
+    references = []
+    for document_reference in _document_references(output_path):
+        for content in document_reference.get('content', []):
+            url = content.get('attachment', {}).get('url')
+            if url and '_dna.csv' in url:
+                references.append({
+                    'document_reference_id': document_reference['id'],
+                    'patient_id': document_reference['subject']['reference'].split('/')[-1],
+                    'path': url
+                })
+    return references
+
+
+def _read_genotypes(path: str, variant_column: str, genotype_column: str) -> (pa.Array, pa.Array):
+    """Variant and genotype columns of a _dna.csv, first and last column unless named."""
+    table = pa_csv.read_csv(path, read_options=pa_csv.ReadOptions(use_threads=False))
+    variants = table.column(variant_column) if variant_column else table.column(0)
+    genotypes = table.column(genotype_column) if genotype_column else table.column(table.num_columns - 1)
+    return variants.cast(pa.string()).combine_chunks(), genotypes.cast(pa.string()).combine_chunks()
+
+
+class _Dictionary:
+    """Grow a dictionary shared by all files, encode arrays against it."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def encode(self, values: pa.Array) -> pa.Array:
+        encoded = values.dictionary_encode()
+        # one python step per distinct value, rows are mapped by take, nulls stay null
+        mapping = pa.array(
+            [self.ids.setdefault(value, len(self.ids)) for value in encoded.dictionary.to_pylist()], type=pa.int32()
+        )
+        return mapping.take(encoded.indices)
+
+    def encode_repeated(self, value: str, length: int) -> pa.Array:
+        return pa.repeat(pa.scalar(self.ids.setdefault(value, len(self.ids)), type=pa.int32()), length)
+
+    def dictionary_array(self, indices: List[pa.Array]) -> pa.DictionaryArray:
+        indices = pa.concat_arrays(indices) if indices else pa.array([], type=pa.int32())
+        return pa.DictionaryArray.from_arrays(indices, pa.array(list(self.ids), type=pa.string()))
+
+
+def build_genotypes(references: List[dict], variant_column: str = None, genotype_column: str = None,
+                    workers: int = 4) -> (pa.Table, dict):
+    """Concatenate every _dna.csv into one table, returns the table and document_reference_id -> row slice.
+
+    Columns are dictionary encoded against dictionaries shared by all patients.
+    """
+    document_references = _Dictionary()
+    variants = _Dictionary()
+    genotypes = _Dictionary()
+    columns = {'document_reference_id': [], 'variant': [], 'genotype': []}
+    index = {}
+    offset = 0
+    # pyarrow releases the GIL, threads read many small files in parallel
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        arrays = executor.map(
+            lambda reference: _read_genotypes(reference['path'], variant_column, genotype_column), references
+        )
+        for reference, (variant_array, genotype_array) in zip(references, arrays):
+            columns['document_reference_id'].append(
+                document_references.encode_repeated(reference['document_reference_id'], len(variant_array))
+            )
+            columns['variant'].append(variants.encode(variant_array))
+            columns['genotype'].append(genotypes.encode(genotype_array))
+            index[reference['document_reference_id']] = {
+                'patient_id': reference['patient_id'],
+                'path': reference['path'],
+                'offset': offset,
+                'length': len(variant_array)
+            }
+            offset += len(variant_array)
+
+    table = pa.table({
+        'document_reference_id': document_references.dictionary_array(columns['document_reference_id']),
+        'variant': variants.dictionary_array(columns['variant']),
+        'genotype': genotypes.dictionary_array(columns['genotype']),
+    })
+    return table, index
+
+
+def open_genotypes(genotypes_path) -> (pa.Table, dict):
+    """Memory map the table written by main, returns the table and its index."""
+    table = pa.ipc.open_file(pa.memory_map(str(genotypes_path))).read_all()
+    with open(Path(genotypes_path).with_suffix('.index.json')) as fp:
+        index = json.load(fp)
+    assert index['version'] == GENOTYPES_VERSION, f"{genotypes_path} version {index['version']} is not supported"
+    return table, index['document_references']
+
+
+def patient_genotypes(table: pa.Table, index: dict, document_reference_id: str) -> pa.Table:
+    """The rows of a single _dna.csv, zero copy."""
+    entry = index[document_reference_id]
+    return table.slice(entry['offset'], entry['length'])
+
+
+def variant_carriers(table: pa.Table, variant: str) -> dict:
+    """document_reference_id -> genotype for every _dna.csv with a genotype for variant."""
+    rows = table.filter(pc.equal(table.column('variant'), variant))
+    return dict(zip(
+        rows.column('document_reference_id').to_pylist(),
+        rows.column('genotype').to_pylist()
+    ))
+
+
+@click.command()
+@click.option('--output_path', default='output/', show_default=True,
+              help='ingest output, reads ingest_manifest.json and the bundles or ndjson it lists')
+@click.option('--genotypes_path', default=None, show_default=True,
+              help='Arrow IPC file to write, default <output_path>/genotypes.arrow. '
+                   'The index is written alongside as genotypes.index.json')
+@click.option('--variant_column', default=None, show_default=True,
+              help='Column name of the variant id, default is the first column')
+@click.option('--genotype_column', default=None, show_default=True,
+              help='Column name of the genotype, default is the last column')
+@click.option('--workers', default=max(multiprocessing.cpu_count() - 1, 1), show_default=True,
+              help='Number of reader threads')
+def main(output_path, genotypes_path, variant_column, genotype_column, workers):
+    """Read every _dna.csv referenced by ingest into one memory mappable genotype table."""
+    tic = time.perf_counter()
+    output_path = Path(output_path)
+    genotypes_path = Path(genotypes_path) if genotypes_path else output_path.joinpath('genotypes.arrow')
+    references = dna_document_references(output_path)
+    logger.info(f"Reading {len(references)} _dna.csv files")
+    table, index = build_genotypes(references, variant_column, genotype_column, workers)
+    with pa.OSFile(str(genotypes_path), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    with open(genotypes_path.with_suffix('.index.json'), 'w') as fp:
+        json.dump({'version': GENOTYPES_VERSION, 'document_references': index}, fp)
+    toc = time.perf_counter()
+    logger.info(f"Wrote {table.num_rows} genotypes, {len(table.column('variant').chunk(0).dictionary) if table.num_rows else 0} variants "
+                f"to {genotypes_path} in {toc - tic:0.4f} seconds")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,25 @@
-import asyncio
 import base64
+import copy
+import itertools
 import json
 import logging
-import os
+import multiprocessing
 import pathlib
+import re
 import time
+import traceback
 import uuid
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
-from typing import Iterator, Dict
+from functools import lru_cache
+from typing import Dict, List
 import unicodedata
 import click
+import pyarrow as pa
+import pyarrow.parquet as pq
 from fhirclient.models.bundle import Bundle, BundleEntry, BundleEntryRequest
 from fhirclient.models.codeableconcept import CodeableConcept
+from fhirclient.models.coding import Coding
 from fhirclient.models.documentreference import DocumentReference
 from fhirclient.models.extension import Extension
 from fhirclient.models.fhirreference import FHIRReference
@@ -20,6 +28,8 @@ from fhirclient.models.observation import Observation, ObservationComponent
 from fhirclient.models.specimen import Specimen
 from fhirclient.models.task import Task, TaskInput, TaskOutput
 
+from file_digest import file_attributes
+
 logging.basicConfig(format='%(asctime)s %(message)s',  encoding='utf-8', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -35,22 +45,27 @@ def _redact_file_name(path, patient, coherent_path):
     return path.replace(file_name, redacted_file_name)
 
 
-def _file_attributes(file_name):
-    """Calculate the hash and size."""
-    import hashlib
-
-    md5_hash = hashlib.md5()
+def _file_attributes(file_name, cache=True):
+    """Calculate the hash and size, see file_digest."""
     file_name = unicodedata.normalize("NFKD", file_name)
-    with open(file_name, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
+    return file_attributes(file_name, cache=cache)
 
-    return md5_hash.hexdigest(), os.lstat(file_name).st_size
 
+# Coherent sentences look like:
+# The <gene> gene with variant index <snp>_<capture> has clinical significance of '<significance>' for an <risk> of: <a>, <b> and <c>.
+# each lookahead finds its field independently, as _parse_assertation_split does
+ASSERTATION_PATTERN = re.compile(
+    r"^(?=.*?The (?P<gene>(?:(?!The )(?! gene).)*))"
+    r"(?=.*of (?!.*of )[^']*'(?P<significance>[^']*))"
+    r"(?=.*index (?P<variant_id>[^ ]*))"
+    r"(?=(?P<risk_clause>(?:(?!of: ).)*)of: )"
+    r"(?=.*of: (?!.*of: )(?P<conditions>.*))",
+    re.DOTALL
+)
 
-def _parse_assertation(assertation_sentence: str) -> Dict[str, str]:
-    """Parse sentence."""
+
+def _parse_assertation_split(assertation_sentence: str) -> Dict[str, str]:
+    """Parse sentence, for sentences ASSERTATION_PATTERN doesn't match."""
     gene = assertation_sentence.split('The ')[1].split(' gene')[0]
 
     assertation_parts = assertation_sentence.split('of ')
@@ -71,6 +86,100 @@ def _parse_assertation(assertation_sentence: str) -> Dict[str, str]:
     return {'gene': gene, 'significance': significance, 'snp_id': snp_id, 'snp_capture': snp_capture, 'risk': risk, 'conditions': conditions}
 
 
+@lru_cache(maxsize=4096)
+def _parse_assertation(assertation_sentence: str) -> Dict[str, str]:
+    """Parse sentence. Coherent repeats a small vocabulary of sentences, results are cached, don't modify them."""
+    match = ASSERTATION_PATTERN.match(assertation_sentence)
+    if not match:
+        return _parse_assertation_split(assertation_sentence)
+
+    variant_id = match['variant_id']
+    snp_id = variant_id
+    snp_capture = None
+    # FS Follistatin? FeatureSelection ? Frame Shift ?
+    if '_' in variant_id:
+        snp_id, snp_capture = variant_id.split('_')
+    conditions = match['conditions'].replace(' and ', ',').replace('.', '').split(',')
+
+    return {'gene': match['gene'], 'significance': match['significance'], 'snp_id': snp_id, 'snp_capture': snp_capture,
+            'risk': match['risk_clause'].split(' an ')[-1].strip(), 'conditions': conditions}
+
+
+# genomic implications, one row per Observation, see _implication_rows
+IMPLICATIONS_SCHEMA = pa.schema([
+    ('patient_id', pa.string()),
+    ('observation_id', pa.string()),
+    ('gene', pa.dictionary(pa.int32(), pa.string())),
+    ('snp_id', pa.string()),
+    ('snp_capture', pa.dictionary(pa.int32(), pa.string())),
+    ('significance', pa.dictionary(pa.int32(), pa.string())),
+    ('risk', pa.dictionary(pa.int32(), pa.string())),
+    ('conditions', pa.list_(pa.dictionary(pa.int32(), pa.string()))),
+])
+
+
+def _component_code(system, code, display) -> CodeableConcept:
+    return CodeableConcept({'coding': [{'system': system, 'code': code, 'display': display}]})
+
+
+# constant fragments of a genomic implication, built once and shallow copied onto each observation
+GENOMIC_CATEGORY = CodeableConcept(
+    {
+        'coding': [
+            {
+                'system': "https://loinc.org",
+                'code': '55233-1',
+                'display': 'Genetic analysis master panel'
+            },
+            {
+                'system': "http://terminology.hl7.org/CodeSystem/observation-category",
+                'code': 'laboratory',
+                'display': 'laboratory'
+            },
+        ]
+    }
+)
+DIAGNOSTIC_IMPLICATION_CODING = Coding({
+    "system": "http://hl7.org/fhir/uv/genomics-reporting/CodeSystem/tbd-codes-cs",
+    "code": "diagnostic-implication",
+    "display": "diagnostic-implication"
+})
+TBD_CODES = "http://hl7.org/fhir/uv/genomics-reporting/CodeSystem/tbd-codes-cs"
+GENE_STUDIED_CODE = _component_code("http://loinc.org", "48018-6", "Gene studied ID")
+REFERENCE_SEQUENCE_CODE = _component_code("http://loinc.org", "48013-7", "Genomic reference sequence ID")
+CONCLUSION_CODE = _component_code(TBD_CODES, "conclusion-string", "conclusion-string")
+EVIDENCE_LEVEL_CODE = _component_code(TBD_CODES, "evidence-level", "evidence-level")
+PREDICTED_PHENOTYPE_CODE = _component_code(TBD_CODES, "predicted-phenotype", "predicted-phenotype")
+INTERPRETATION_COMPONENT = ObservationComponent({
+    "code": _component_code(TBD_CODES, "observation-interpretation", "observation-interpretation").as_json(),
+    "valueCodeableConcept": {
+        "coding": [
+            # {
+            #     "system": "http://hl7.org/fhir/ValueSet/observation-interpretation",
+            #     "code": f"TODO - lookup FHIR code for {implication['risk']}",
+            #     "display": implication['risk']
+            # }
+            {
+                "system": "http://terminology.hl7.org/CodeSystem/risk-probability",
+                "code": 'moderate',
+                "display": 'The specified outcome has a reasonable likelihood of occurrence.'
+            }
+
+        ]
+    }
+})
+
+
+def _component(code: CodeableConcept, value_codeable_concept: CodeableConcept = None,
+               value_string: str = None) -> ObservationComponent:
+    """ObservationComponent with a shallow copy of a prebuilt code."""
+    component = ObservationComponent()
+    component.code = copy.copy(code)
+    component.valueCodeableConcept = value_codeable_concept
+    component.valueString = value_string
+    return component
+
+
 def _genomic_observation(observation) -> Observation:
     """Transform dict into a Genomic Implication Observation."""
     # fix missing data
@@ -84,186 +193,60 @@ def _genomic_observation(observation) -> Observation:
     assertation_sentence = observation.code.coding[0].display
     implication = _parse_assertation(assertation_sentence)
     # cast the observation into a full GenomicInterpretation
-    observation.category = []
     # set category
-    observation.category.append(
-        CodeableConcept(
-            {
-                'coding': [
-                    {
-                        'system': "https://loinc.org",
-                        'code': '55233-1',
-                        'display': 'Genetic analysis master panel'
-                    },
-                    {
-                        'system': "http://terminology.hl7.org/CodeSystem/observation-category",
-                        'code': 'laboratory',
-                        'display': 'laboratory'
-                    },
-                ]
-            }
-        )
-    )
-    observation.code = CodeableConcept({
-        'coding': [
-            {
-                "system": "http://www.genenames.org/geneId",
-                "code": implication['gene'],
-                "display": implication['gene']
-            },
-            {
-                "system": "http://hl7.org/fhir/uv/genomics-reporting/CodeSystem/tbd-codes-cs",
-                "code": "diagnostic-implication",
-                "display": "diagnostic-implication"
-            }
-        ]
-    })
+    observation.category = [copy.copy(GENOMIC_CATEGORY)]
+    gene_coding = {
+        "system": "http://www.genenames.org/geneId",
+        "code": implication['gene'],
+        "display": implication['gene']
+    }
+    observation.code = CodeableConcept({'coding': [gene_coding]})
+    observation.code.coding.append(copy.copy(DIAGNOSTIC_IMPLICATION_CODING))
     # set generic summary view
     observation.valueString = assertation_sentence
-    observation.valueCodeableConcept = CodeableConcept(
-        {
-            "coding": [
-                {
-                    "system": "http://www.genenames.org/geneId",
-                    "code": implication['gene'],
-                    "display": implication['gene']
-                }
-            ]
-        }
-    )
+    observation.valueCodeableConcept = CodeableConcept({"coding": [gene_coding]})
     # set detailed view
     if not observation.component:
         observation.component = []
     # geneId
-    observation.component.append(ObservationComponent({
-        "code": {
-            "coding": [
-                {
-                    "system": "http://loinc.org",
-                    "code": "48018-6",
-                    "display": "Gene studied ID"
-                }
-            ]
-        },
-        "valueCodeableConcept": {
-            "coding": [
-                {
-                    "system": "http://www.genenames.org/geneId",
-                    "code": implication['gene'],
-                    "display": implication['gene']
-                }
-            ]
-        }
-    }))
+    observation.component.append(_component(GENE_STUDIED_CODE, CodeableConcept({"coding": [gene_coding]})))
     # snp_id
-    observation.component.append(ObservationComponent({
-        "code": {
-            "coding": [
-                {
-                    "system": "http://loinc.org",
-                    "code": "48013-7",
-                    "display": "Genomic reference sequence ID"
-                }
-            ]
-        },
-        "valueCodeableConcept": {
-            "coding": [
-                {
-                    "system": "https://www.ncbi.nlm.nih.gov/snp/",
-                    "code": implication['snp_id'],
-                    "display": implication['snp_id']
-                }
-            ]
-        }
-    }))
+    observation.component.append(_component(REFERENCE_SEQUENCE_CODE, CodeableConcept({
+        "coding": [
+            {
+                "system": "https://www.ncbi.nlm.nih.gov/snp/",
+                "code": implication['snp_id'],
+                "display": implication['snp_id']
+            }
+        ]
+    })))
     # conclusion
-    observation.component.append(ObservationComponent({
-        "code": {
-            "coding": [
-                {
-                    "system": "http://hl7.org/fhir/uv/genomics-reporting/CodeSystem/tbd-codes-cs",
-                    "code": "conclusion-string",
-                    "display": "conclusion-string"
-                }
-            ]
-        },
-        "valueString": assertation_sentence
-    }))
+    observation.component.append(_component(CONCLUSION_CODE, value_string=assertation_sentence))
     # evidence-level
-    observation.component.append(ObservationComponent({
-        "code": {
-            "coding": [
-                {
-                    "system": "http://hl7.org/fhir/uv/genomics-reporting/CodeSystem/tbd-codes-cs",
-                    "code": "evidence-level",
-                    "display": "evidence-level"
-                }
-            ]
-        },
-
-        # TODO - translate this vocabulary
-        "valueCodeableConcept": {
-            "coding": [
-                {
-                    "system": "http://loinc.org/LL5356-2/",
-                    "code": implication['significance'],  # f"TODO lookup code for: ",
-                    "display": implication['significance']
-                }
-            ]
-        }
-    }))
+    # TODO - translate this vocabulary
+    observation.component.append(_component(EVIDENCE_LEVEL_CODE, CodeableConcept({
+        "coding": [
+            {
+                "system": "http://loinc.org/LL5356-2/",
+                "code": implication['significance'],  # f"TODO lookup code for: ",
+                "display": implication['significance']
+            }
+        ]
+    })))
     # predicted-phenotype
-    observation.component.append(ObservationComponent({
-        "code": {
-            "coding": [
-                {
-                    "system": "http://hl7.org/fhir/uv/genomics-reporting/CodeSystem/tbd-codes-cs",
-                    "code": "predicted-phenotype",
-                    "display": "predicted-phenotype"
-                }
-            ]
-        },
-
-        # TODO - translate this vocabulary
-        "valueCodeableConcept": {
-            "coding": [
-                {
-                    "system": "http://snomed.info/sct",
-                    "code": condition.strip(),  # f"TODO - lookup snomed code for {condition}",
-                    "display": condition.strip()
-                }
-                for condition in implication['conditions']
-            ]
-        }
-    }))
+    # TODO - translate this vocabulary
+    observation.component.append(_component(PREDICTED_PHENOTYPE_CODE, CodeableConcept({
+        "coding": [
+            {
+                "system": "http://snomed.info/sct",
+                "code": condition.strip(),  # f"TODO - lookup snomed code for {condition}",
+                "display": condition.strip()
+            }
+            for condition in implication['conditions']
+        ]
+    })))
     # observation-interpretation
-    observation.component.append(ObservationComponent({
-        "code": {
-            "coding": [
-                {
-                    "system": "http://hl7.org/fhir/uv/genomics-reporting/CodeSystem/tbd-codes-cs",
-                    "code": "observation-interpretation",
-                    "display": "observation-interpretation"
-                }
-            ]
-        },
-
-        "valueCodeableConcept": {
-            "coding": [
-                # {
-                #     "system": "http://hl7.org/fhir/ValueSet/observation-interpretation",
-                #     "code": f"TODO - lookup FHIR code for {implication['risk']}",
-                #     "display": implication['risk']
-                # }
-                {
-                    "system": "http://terminology.hl7.org/CodeSystem/risk-probability",
-                    "code": 'moderate',
-                    "display": 'The specified outcome has a reasonable likelihood of occurrence.'
-                }
-
-            ]
-        }
-    }))
+    observation.component.append(copy.copy(INTERPRETATION_COMPONENT))
     return observation
 
 
@@ -493,7 +476,8 @@ def _transform_document_reference(bundle: Bundle, coherent_path: Path) -> Bundle
             # alter attachment
             document_reference.content[0].attachment.data = None
             document_reference.content[0].attachment.url = path
-            md5, file_size = _file_attributes(path)
+            # rewritten on every run, not worth caching
+            md5, file_size = _file_attributes(path, cache=False)
             document_reference.content[0].attachment.size = file_size
             if not document_reference.content[0].attachment.extension:
                 document_reference.content[0].attachment.extension = []
@@ -536,8 +520,41 @@ def _transform_document_reference(bundle: Bundle, coherent_path: Path) -> Bundle
     return bundle
 
 
-async def transform(path, coherent_path):
-    """Read a bundle, transform it/fix it, save it in place."""
+def _implication_rows(bundle: Bundle) -> List[dict]:
+    """IMPLICATIONS_SCHEMA rows for the genomic implication Observations of a transformed bundle."""
+    patient_id = next((e.resource.id for e in bundle.entry if e.resource.resource_type == 'Patient'), None)
+    rows = []
+    for e in bundle.entry:
+        if e.resource.resource_type != 'Observation' or not e.resource.code or not e.resource.code.coding:
+            continue
+        if not any(coding.code == DIAGNOSTIC_IMPLICATION_CODING.code for coding in e.resource.code.coding):
+            continue
+        implication = _parse_assertation(e.resource.valueString)
+        rows.append({
+            'patient_id': patient_id,
+            'observation_id': e.resource.id,
+            'gene': implication['gene'],
+            'snp_id': implication['snp_id'],
+            'snp_capture': implication['snp_capture'],
+            'significance': implication['significance'],
+            'risk': implication['risk'],
+            'conditions': [condition.strip() for condition in implication['conditions']],
+        })
+    return rows
+
+
+def write_table(table: pa.Table, path):
+    """Write Parquet if path ends with .parquet, otherwise an Arrow IPC file."""
+    if str(path).endswith('.parquet'):
+        pq.write_table(table, path)
+        return
+    with pa.OSFile(str(path), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def transform(path, coherent_path) -> List[dict]:
+    """Read a bundle, transform it/fix it, save it in place. Returns the bundle's implication rows."""
     tic = time.perf_counter()
     with open(path, 'r') as fp:
         bundle = Bundle(json.loads(fp.read()))
@@ -549,60 +566,70 @@ async def transform(path, coherent_path):
         fp.write(transformed)
     toc = time.perf_counter()
     logger.info(f"READ and TRANSFORMED {path} {toc - tic:0.4f} seconds")
-    return True
+    return _implication_rows(bundle)
 
 
-def _chunker(seq: Iterator, size: int) -> Iterator:
-    """Iterate over a list in chunks.
+def _transform_or_error(path, coherent_path) -> (Path, List[dict], str):
+    """Run transform in a worker, return the error instead of raising so one bundle can't stop the run."""
+    try:
+        return path, transform(path, coherent_path), None
+    except Exception:
+        return path, [], traceback.format_exc()
 
-    Args:
-        seq: an iterable
-        size: desired chunk size
-
-    Returns:
-        an iterator that returns lists of size or less
-    """
-    return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
+def transform_all(coherent_path, workers, implications_path=None):
+    """Transform all the bundles in a process pool, returns the paths that failed.
 
-async def transform_all(coherent_path):
-    """Load all the bundles"""
+    If implications_path is set, write the genomic implications table there, see IMPLICATIONS_SCHEMA.
+    """
 
     # get all the patients
     paths = sorted([p for p in Path(f'{coherent_path}/fhir/').glob('*.json') if
                     'organizations' not in str(p) and 'practitioners' not in str(p)])
 
-    # doing this as a maximum of 6 seems to work when combined with nice -10 on a laptop
-    limit = None
-    count = 0
-    ok = False
-    for chunk in _chunker(paths, 6):
-        tasks = []
-
-        for path in chunk:
-            task = asyncio.create_task(transform(path=path, coherent_path=coherent_path))
-            tasks.append(task)
-            count += 1
-            if limit and count == limit:
-                break
-
-        ok = all([
-            await ok_
-            for ok_ in asyncio.as_completed(tasks)
-        ])
-
-        if limit and count == limit:
-            break
-
-    assert ok, "Did not transform bundles"
+    failures = []
+    implications = []
+    # sliding window, a slow bundle only holds up its own worker
+    window = workers * 2
+    paths_iter = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for path in itertools.islice(paths_iter, window):
+            pending.add(executor.submit(_transform_or_error, path, coherent_path))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, rows, error = future.result()
+                if error:
+                    logger.error(f"FAILED {path}\n{error}")
+                    failures.append(path)
+                implications.extend(rows)
+            for path in itertools.islice(paths_iter, len(done)):
+                pending.add(executor.submit(_transform_or_error, path, coherent_path))
+
+    logger.info(f"Transformed {len(paths) - len(failures)} of {len(paths)} bundles")
+    if implications_path:
+        # completion order varies, keep the table stable
+        implications.sort(key=lambda row: (row['patient_id'] or '', row['observation_id']))
+        write_table(pa.Table.from_pylist(implications, schema=IMPLICATIONS_SCHEMA), implications_path)
+        logger.info(f"Wrote {len(implications)} implications to {implications_path}")
+    return failures
 
 
 @click.command()
 @click.option('--coherent_path', default='output', show_default=True,
               help='Unzipped directory: see http://hdx.mitre.org/downloads/coherent-11-07-2022.zip')
-def main(coherent_path):
+@click.option('--workers', default=max(multiprocessing.cpu_count() - 1, 1), show_default=True,
+              help='Number of worker processes')
+@click.option('--implications_path', default=None, show_default=True,
+              help='Optional. Write genomic implications by patient and observation, '
+                   'Parquet if it ends with .parquet, otherwise Arrow IPC')
+def main(coherent_path, workers, implications_path):
     """Adjust DocumentReferences see https://github.com/ACED-IDP/data_model/issues/20"""
-    asyncio.run(transform_all(coherent_path))
+    failures = transform_all(coherent_path, workers, implications_path)
+    for path in failures:
+        logger.error(f"FAILED {path}")
+    assert not failures, f"Did not transform {len(failures)} bundles"
     logger.info('done')
 
 
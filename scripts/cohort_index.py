@@ -0,0 +1,109 @@
+import base64
+import json
+import zlib
+from typing import Iterable
+
+COHORT_INDEX_VERSION = 1
+
+
+def _encode_bitmap(bitmap: int) -> str:
+    """Compressed, json friendly bitmap."""
+    return base64.b64encode(zlib.compress(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'))).decode()
+
+
+def _decode_bitmap(encoded: str) -> int:
+    return int.from_bytes(zlib.decompress(base64.b64decode(encoded)), 'little')
+
+
+class CohortIndex:
+    """Condition code posting lists over patient ordinals.
+
+    Bit n of a posting is set if patients[n] has a Condition with that code.
+    condition_counts are the number of Conditions per code, what a FHIR server counts for
+    `Condition?code=...&_summary=count`, see coherent_fhir_studies test.
+    """
+
+    def __init__(self, patients: list, bundle_file_paths: list, postings: dict, condition_counts: dict,
+                 displays: dict):
+        self.patients = patients
+        self.bundle_file_paths = bundle_file_paths
+        self.postings = postings
+        self.condition_counts = condition_counts
+        self.displays = displays
+
+    @classmethod
+    def build(cls, patient_conditions: Iterable[dict]) -> 'CohortIndex':
+        """Build from {'patient_id', 'bundle_file_path', 'conditions': [coding dict, ...]}, ordinals follow patient_id."""
+        patient_conditions = sorted(patient_conditions, key=lambda patient: patient['patient_id'])
+        postings = {}
+        condition_counts = {}
+        displays = {}
+        for ordinal, patient in enumerate(patient_conditions):
+            for coding in patient['conditions']:
+                code = coding['code']
+                postings[code] = postings.get(code, 0) | (1 << ordinal)
+                condition_counts[code] = condition_counts.get(code, 0) + 1
+                displays.setdefault(code, coding.get('display'))
+        return cls(
+            [patient['patient_id'] for patient in patient_conditions],
+            [str(patient['bundle_file_path']) for patient in patient_conditions],
+            postings, condition_counts, displays
+        )
+
+    @classmethod
+    def load(cls, path) -> 'CohortIndex':
+        with open(path) as fp:
+            index = json.load(fp)
+        assert index['version'] == COHORT_INDEX_VERSION, f"{path} version {index['version']} is not supported"
+        return cls(
+            index['patients'],
+            index['bundle_file_paths'],
+            {code: _decode_bitmap(values['patients']) for code, values in index['codes'].items()},
+            {code: values['condition_count'] for code, values in index['codes'].items()},
+            {code: values['display'] for code, values in index['codes'].items()},
+        )
+
+    def save(self, path):
+        index = {
+            'version': COHORT_INDEX_VERSION,
+            'patients': self.patients,
+            'bundle_file_paths': self.bundle_file_paths,
+            'codes': {
+                code: {
+                    'display': self.displays[code],
+                    'condition_count': self.condition_counts[code],
+                    'patients': _encode_bitmap(self.postings[code])
+                }
+                for code in sorted(self.postings)
+            }
+        }
+        with open(path, 'w') as fp:
+            json.dump(index, fp)
+
+    def query(self, any_of: Iterable[str] = (), all_of: Iterable[str] = ()) -> int:
+        """Bitmap of patients with any of any_of and all of all_of codes."""
+        any_of, all_of = list(any_of), list(all_of)
+        assert any_of or all_of, "Query needs at least one code"
+        bitmap = (1 << len(self.patients)) - 1
+        if any_of:
+            union = 0
+            for code in any_of:
+                union |= self.postings.get(code, 0)
+            bitmap &= union
+        for code in all_of:
+            bitmap &= self.postings.get(code, 0)
+        return bitmap
+
+    def patient_ids(self, bitmap: int) -> list:
+        return [patient_id for ordinal, patient_id in enumerate(self.patients) if bitmap >> ordinal & 1]
+
+    def bundle_paths(self, bitmap: int) -> list:
+        return [path for ordinal, path in enumerate(self.bundle_file_paths) if bitmap >> ordinal & 1]
+
+    @staticmethod
+    def patient_count(bitmap: int) -> int:
+        return bin(bitmap).count('1')
+
+    def condition_count(self, codes: Iterable[str]) -> int:
+        """Number of Conditions with any of codes."""
+        return sum(self.condition_counts.get(code, 0) for code in set(codes))
@@ -11,6 +11,8 @@ import click
 import pathlib
 import subprocess
 
+from bundle_stream import iter_bundle_resources
+
 # setup logging
 logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 # setup default logging format
@@ -39,15 +41,11 @@ def resource_generator(file_path):
     """Yield resources from a FHIR bundle."""
     if not file_path.exists():
         logger.warning(f"{file_path} does not exist")
-        raise StopIteration
+        return
     try:
-        with file_path.open() as _:
-            data = json.load(_)
-            logging.info(f"loaded {file_path} {data}")
-            assert 'resourceType' in data, f"{file_path} is not a FHIR bundle"
-            assert data['resourceType'] == 'Bundle', f"{file_path} is not a FHIR bundle"
-            for entry in data['entry']:
-                yield entry['resource']
+        # an entry at a time, large bundles are never fully loaded
+        yield from iter_bundle_resources(file_path)
+        logging.info(f"loaded {file_path}")
     except json.decoder.JSONDecodeError:
         logger.warning(f"{file_path} is not valid json")
     except AssertionError as e:
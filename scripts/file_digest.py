@@ -0,0 +1,64 @@
+import hashlib
+import os
+import sqlite3
+
+# override with FILE_DIGEST_CACHE, shared by ingest.py and coherent_refactor_bundle.py
+DIGEST_CACHE_PATH = os.environ.get('FILE_DIGEST_CACHE', '.file_digest.sqlite')
+
+# 1 MiB reads, the DICOM files are large
+BUFFER_SIZE = 1024 * 1024
+
+# (pid, cache_path) -> connection, connections can't cross a fork
+_CONNECTIONS = {}
+
+
+def _connection(cache_path) -> sqlite3.Connection:
+    """Open (once per process) the digest cache."""
+    key = (os.getpid(), cache_path)
+    if key not in _CONNECTIONS:
+        connection = sqlite3.connect(cache_path, timeout=60, isolation_level=None)
+        # many pool workers read and write concurrently
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS file_digest '
+            '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT)'
+        )
+        _CONNECTIONS[key] = connection
+    return _CONNECTIONS[key]
+
+
+def md5_file(file_name) -> str:
+    """Hash file with large buffered reads."""
+    md5_hash = hashlib.md5()
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file_name, "rb", buffering=0) as f:
+        for size in iter(lambda: f.readinto(buffer), 0):
+            md5_hash.update(view[:size])
+    return md5_hash.hexdigest()
+
+
+def file_attributes(file_name, cache=True, cache_path=DIGEST_CACHE_PATH) -> (str, int):
+    """Calculate the hash and size, reuse the cached hash if (path, size, mtime_ns) are unchanged.
+
+    Set cache=False for files rewritten on every run, e.g. clinical notes.
+    """
+    stat = os.stat(file_name)
+    if not cache:
+        return md5_file(file_name), stat.st_size
+
+    path = os.path.abspath(file_name)
+    connection = _connection(cache_path)
+    row = connection.execute(
+        'SELECT md5 FROM file_digest WHERE path = ? AND size = ? AND mtime_ns = ?',
+        (path, stat.st_size, stat.st_mtime_ns)
+    ).fetchone()
+    if row:
+        return row[0], stat.st_size
+
+    md5 = md5_file(file_name)
+    connection.execute(
+        'INSERT OR REPLACE INTO file_digest VALUES (?, ?, ?, ?)',
+        (path, stat.st_size, stat.st_mtime_ns, md5)
+    )
+    return md5, stat.st_size
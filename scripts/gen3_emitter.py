@@ -40,6 +40,8 @@ from gen3.index import Gen3Index
 from pelican.dictionary import DataDictionaryTraversal
 from pydantic import BaseModel, PrivateAttr
 
+from note_store import open_note_store, parse_url
+
 logging.basicConfig(level=logging.INFO)
 
 logger = logging.getLogger(__name__)
@@ -1234,7 +1236,9 @@ async def upload_and_decorate_document_reference(document_reference, bucket_name
         logger.warning('content_url not found')
         return 
     md5sum = document_reference["md5sum"]
-    object_name = document_reference['file_name'].lstrip('./')
+    note = parse_url(document_reference['file_name'])
+    # ingest --note_store sqlite, the note is read from the store
+    object_name = f"{note[1]}.txt" if note else document_reference['file_name'].lstrip('./')
 
     hashes = {'md5': md5sum}
     assert 'id' in document_reference, document_reference
@@ -1264,7 +1268,12 @@ async def upload_and_decorate_document_reference(document_reference, bucket_name
     signed_url = urllib.parse.unquote(document['url'])
     guid = document_reference['id']
 
-    with open(document_reference['file_name'], 'rb') as data_f:
+    if note:
+        store_path, md5 = note
+        data_f = io.BytesIO(open_note_store(store_path).get(md5))
+    else:
+        data_f = open(document_reference['file_name'], 'rb')
+    with data_f:
         # When you use this header, Amazon S3 checks the object against the provided MD5 value and,
         # if they do not match, returns an error.
         content_md5 = base64.b64encode(bytes.fromhex(md5sum))
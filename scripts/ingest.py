@@ -1,35 +1,68 @@
 import csv
+import hashlib
+import itertools
 import json
+import math
 import pathlib
-from typing import Mapping, Sequence, Set, List
+import shutil
+from typing import Dict, Iterable, List
 
 import click
+import orjson
+import yaml
 import os
 from pathlib import Path
 import time
 import multiprocessing
 import logging
 from fhirclient.models.bundle import Bundle, BundleEntry, BundleEntryRequest
+from fhirclient.models.coding import Coding
+from fhirclient.models.diagnosticreport import DiagnosticReport
 from fhirclient.models.documentreference import DocumentReference
 from fhirclient.models.researchstudy import ResearchStudy
 from fhirclient.models.researchsubject import ResearchSubject
 from fhirclient.models.specimen import Specimen
 from fhirclient.models.task import Task, TaskInput, TaskOutput
+from fhirclient.models.fhirabstractbase import FHIRAbstractBase
 from fhirclient.models.fhirreference import FHIRReference
+from fhirclient.models.imagingstudy import ImagingStudy
 from fhirclient.models.narrative import Narrative
 from fhirclient.models.organization import Organization
+from fhirclient.models.patient import Patient
 from fhirclient.models.location import Location
 from fhirclient.models.practitioner import Practitioner
+from fhirclient.models.resource import Resource
 from pydantic import BaseModel
 from fhirclient.models.extension import Extension
 
+from file_digest import file_attributes
+from note_store import NoteStore
+from note_index import NoteIndex
+from bundle_stream import BundleReader, BundleWriter, iter_reference_dicts
+from cohort_index import CohortIndex
+
 import base64
 import uuid
-from itertools import repeat
+from collections import defaultdict
+from contextlib import contextmanager
+from resource import getrusage, RUSAGE_SELF
+from functools import partial
 
 
 logging.basicConfig(level=logging.INFO, format='%(process)d - %(levelname)s - %(message)s')
 
+# bump when _transform_bundle output changes, invalidates ingest_manifest.json
+INGEST_MANIFEST_VERSION = 1
+
+
+# read by create_global_resources, relative to coherent_path
+GLOBAL_RESOURCE_CSVS = ['output/csv/providers.csv', 'output/csv/organizations.csv']
+
+
+def global_resource_digests(coherent_path) -> dict:
+    """md5 of the csv files behind the global resource index, a change invalidates ingest_manifest.json."""
+    return {csv_path: file_attributes(f'{coherent_path}/{csv_path}')[0] for csv_path in GLOBAL_RESOURCE_CSVS}
+
 
 def create_global_resources(coherent_path) -> list:
     """Reads CSV files for Organizations, Practitioners etc. used across bundles.
@@ -126,166 +159,433 @@ def create_global_resources(coherent_path) -> list:
     return global_resources
 
 
-def _normalize_references(bundle, global_resources, file_path) -> Bundle:
+def global_reference_index(global_resources: list) -> (dict, set):
+    """Map `ResourceType?identifier=system|value` to ResourceType/id for global resources.
+
+    Returns the identifier index and the set of global references.
+    """
+    global_index = {}
+    global_references = set()
+    for resource in global_resources:
+        if hasattr(resource, 'identifier') and resource.identifier:
+            for identifier in resource.identifier:
+                global_index[f"{resource.resource_type}?identifier={identifier.system}|{identifier.value}"] = f"{resource.resource_type}/{resource.id}"
+                global_references.add(f"{resource.resource_type}/{resource.id}")
+    return global_index, global_references
+
+
+# populated once per pool process by _init_worker
+WORKER_STATE = {}
+
+# the dict engine builds fhirclient objects only for these, see _classify_bundle_json
+DICT_ENGINE_MATERIALIZED = {
+    'Patient': Patient,
+    'DiagnosticReport': DiagnosticReport,
+    'DocumentReference': DocumentReference,
+}
+
+DICOM_METADATA_URL = "http://aced-idp.org/fhir/StructureDefinition/dicom-metadata"
+# DICOM keyword -> FHIR extension value type
+DICOM_METADATA_KEYWORDS = {
+    'Modality': 'valueString',
+    'BodyPartExamined': 'valueString',
+    'Manufacturer': 'valueString',
+    'StudyInstanceUID': 'valueString',
+    'SeriesInstanceUID': 'valueString',
+    'SOPClassUID': 'valueString',
+    # ordinals of this file's series in the study and instance in the series
+    'SeriesNumber': 'valueInteger',
+    'InstanceNumber': 'valueInteger',
+    # counts, when the modality or archive wrote them, see also ImagingStudy.numberOfSeries, numberOfInstances
+    'NumberOfStudyRelatedSeries': 'valueInteger',
+    'NumberOfStudyRelatedInstances': 'valueInteger',
+    'NumberOfSeriesRelatedInstances': 'valueInteger',
+    'NumberOfFrames': 'valueInteger',
+    'Rows': 'valueInteger',
+    'Columns': 'valueInteger',
+    'BitsAllocated': 'valueInteger',
+    'StudyDate': 'valueDate',
+    'AcquisitionDate': 'valueDate',
+}
+
+
+def _init_worker(coherent_path, settings: dict):
+    """Pool initializer, build the global resource index once per worker rather than once per bundle.
+
+    settings: output_format, engine, validate_sample_rate, note_store_path (None to write note files), dicom_metadata,
+        note_index_path (None for no index)
+    """
+    global_index, global_references = global_reference_index(create_global_resources(coherent_path))
+    WORKER_STATE.update(settings)
+    WORKER_STATE['global_index'] = global_index
+    WORKER_STATE['global_references'] = global_references
+    # ImagingStudy is only rewritten when DICOM metadata is added
+    WORKER_STATE['materialized'] = (
+        {**DICT_ENGINE_MATERIALIZED, 'ImagingStudy': ImagingStudy} if settings['dicom_metadata']
+        else DICT_ENGINE_MATERIALIZED
+    )
+    # ResourceType -> open shard file, see _write_ndjson_shards
+    WORKER_STATE['ndjson_shards'] = {}
+    WORKER_STATE['note_store'] = NoteStore(settings['note_store_path']) if settings['note_store_path'] else None
+    WORKER_STATE['note_index'] = NoteIndex(settings['note_index_path']) if settings['note_index_path'] else None
+
+
+def _ndjson_shard_path(output_path: Path) -> Path:
+    """Directory of per-worker ndjson shards."""
+    return output_path.joinpath('ndjson', 'shards')
+
+
+def _write_ndjson_shards(resources: Iterable[dict], output_path: Path) -> int:
+    """Append each resource to this worker's shard for its resource type, returns bytes written."""
+    shards = WORKER_STATE['ndjson_shards']
+    bytes_written = 0
+    for resource in resources:
+        resource_type = resource['resourceType']
+        if resource_type not in shards:
+            shards[resource_type] = open(
+                _ndjson_shard_path(output_path).joinpath(f"{resource_type}.{os.getpid()}.ndjson"), "ab"
+            )
+        bytes_written += shards[resource_type].write(orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE))
+    # pool workers exit without closing files
+    for shard in shards.values():
+        shard.flush()
+    return bytes_written
+
+
+def concatenate_ndjson_shards(output_path: Path) -> list:
+    """Concatenate worker shards into <output_path>/ndjson/<ResourceType>.ndjson, remove the shards."""
+    shard_path = _ndjson_shard_path(output_path)
+    shards = defaultdict(list)
+    for shard in sorted(shard_path.glob('*.ndjson')):
+        shards[shard.name.split('.')[0]].append(shard)
+    ndjson_paths = []
+    for resource_type, resource_type_shards in sorted(shards.items()):
+        ndjson_path = shard_path.parent.joinpath(f"{resource_type}.ndjson")
+        with open(ndjson_path, 'wb') as output_stream:
+            for shard in resource_type_shards:
+                with open(shard, 'rb') as input_stream:
+                    shutil.copyfileobj(input_stream, output_stream, 1024 * 1024)
+                shard.unlink()
+        ndjson_paths.append(ndjson_path)
+    return ndjson_paths
+
+
+# fhirclient class -> attribute names that can lead to a FHIRReference, see _reference_plan
+REFERENCE_PLANS = {}
+REFERENCE_PLANS_IN_PROGRESS = set()
+
+
+def _reference_plan(klass) -> list:
+    """Names of klass's attributes that can hold a FHIRReference, directly or nested.
+
+    Computed once per class from fhirclient's elementProperties(). Properties typed as Resource
+    (i.e. contained) are always kept since the runtime class decides what they hold.
+    """
+    plan = REFERENCE_PLANS.get(klass)
+    if plan is not None:
+        return plan
+    # register before recursing, a class being planned (e.g. Extension.extension) counts as holding references
+    plan = REFERENCE_PLANS[klass] = []
+    REFERENCE_PLANS_IN_PROGRESS.add(klass)
+    for name, _, type_, _, _, _ in klass().elementProperties():
+        if not (isinstance(type_, type) and issubclass(type_, FHIRAbstractBase)):
+            continue
+        if issubclass(type_, (FHIRReference, Resource)) or type_ in REFERENCE_PLANS_IN_PROGRESS or _reference_plan(type_):
+            plan.append(name)
+    REFERENCE_PLANS_IN_PROGRESS.remove(klass)
+    return plan
+
+
+def _iter_references(obj):
+    """Yield the FHIRReferences in obj, visiting only attributes its class's reference plan lists."""
+    for name in _reference_plan(obj.__class__):
+        value = getattr(obj, name, None)
+        if value is None:
+            continue
+        for item in value if isinstance(value, list) else (value,):
+            if isinstance(item, FHIRReference):
+                yield item
+            else:
+                yield from _iter_references(item)
+
+
+def _referenced_global_resources(global_resources: list, references: set) -> list:
+    """The global resources in references, plus the globals they in turn reference (e.g. Practitioner -> Organization)."""
+    global_resources_by_reference = {f"{resource.resource_type}/{resource.id}": resource for resource in global_resources}
+    pending = [reference for reference in references if reference in global_resources_by_reference]
+    referenced = set()
+    while pending:
+        reference = pending.pop()
+        if reference in referenced:
+            continue
+        referenced.add(reference)
+        pending.extend(
+            reference_.reference for reference_ in _iter_references(global_resources_by_reference[reference])
+            if reference_.reference in global_resources_by_reference
+        )
+    return [global_resources_by_reference[reference] for reference in sorted(referenced)]
+
+
+class _ReferenceNormalizer:
+    """Rewrite references to ResourceType/id, collect the global resources referenced."""
+
+    def __init__(self, local_index, global_index, global_references, file_path):
+        self.local_index = local_index
+        self.global_index = global_index
+        self.global_references = global_references
+        self.file_path = file_path
+        self.logged_already = set()
+        self.add_to_research_study_bundle = set()
+
+    def resolve(self, reference):
+        """Global identifiers take precedence over the bundle's own."""
+        resolved = self.global_index.get(reference)
+        if resolved is None:
+            resolved = self.local_index.get(reference)
+        return resolved
+
+    def normalize(self, reference, display, resource_type, resource_id):
+        """Return reference as ResourceType/id, unchanged (and logged) if it can't be resolved."""
+        resolved = self.resolve(reference)
+        if resolved is None:
+            found = True
+            resolved = reference
+            if '/' in reference and '?' not in reference:
+                pass
+            elif '?' in reference:
+                found = False
+                name_reference = reference.split('=')[0]
+                stripped_name = ''.join(filter(str.isalnum, display)).replace("Dr", '')
+                name_reference += f'=name|{stripped_name}'
+                name_resolved = self.resolve(name_reference)
+                if name_resolved is not None:
+                    # logging.info(f"{reference} {name_reference} found in G {name_resolved}")
+                    resolved = name_resolved
+                    found = True
+            if not found:
+                if f"{reference} {display}" not in self.logged_already:
+                    logging.warning(f"{reference} {display} not found in bundle "
+                                    f"{resource_type}/{resource_id} {self.file_path}")
+                    self.logged_already.add(f"{reference} {display}")
+
+        # add global_reference to bundle
+        if resolved in self.global_references:
+            self.add_to_research_study_bundle.add(resolved)
+        return resolved
+
+
+def _normalize_references(bundle, global_index, global_references, file_path) -> Bundle:
     """Ensure that all reference identifiers transformed formed to ResourceType/id"""
-    logged_already = []
-    g = {
+    local_index = {
         f'urn:uuid:{e.resource.id}': f"{e.resource.resource_type}/{e.resource.id}" for e in bundle.entry
     }
 
     for e in bundle.entry:
         if hasattr(e.resource, 'identifier') and e.resource.identifier:
             for identifier in e.resource.identifier:
-                g[f"{e.resource.resource_type}?identifier={identifier.system}|{identifier.value}"] = f"{e.resource.resource_type}/{e.resource.id}"
+                local_index[f"{e.resource.resource_type}?identifier={identifier.system}|{identifier.value}"] = f"{e.resource.resource_type}/{e.resource.id}"
         if hasattr(e.resource, 'contained') and e.resource.contained:
             for contained in e.resource.contained:
                 # TODO - ensure that contained resources make it to destination system
-                g[f"#{contained.id}"] = f"#{contained.id}"
-
-    is_global = []
-    add_to_research_study_bundle = []
-    for resource in global_resources:
-        if hasattr(resource, 'identifier') and resource.identifier:
-            for identifier in resource.identifier:
-                g[f"{resource.resource_type}?identifier={identifier.system}|{identifier.value}"] = f"{resource.resource_type}/{resource.id}"
-                is_global.append(f"{resource.resource_type}/{resource.id}")
-
-    # see https://gist.github.com/sente/1480558
-    string_types = (str, unicode) if str is bytes else (str, bytes)
-    iteritems = lambda mapping: getattr(mapping, 'iteritems', mapping.items)()
-
-    def __iter__(obj_):
-        for attr, value in obj_.__dict__.items():
-            if not attr.startswith('_'):
-                yield attr, value
-
-    def obj_walk(obj, path=(), memo=None):
-        """Traverse the obj, handle references."""
-        if memo is None:
-            memo = set()
-        iterator = None
-        if isinstance(obj, Mapping):
-            iterator = iteritems
-        elif 'fhirclient' in obj.__class__.__module__:
-            iterator = __iter__
-        elif isinstance(obj, (Sequence, Set)) and not isinstance(obj, string_types):
-            iterator = enumerate
-
-        if 'fhirclient.models.fhirreference' == obj.__class__.__module__:
-            iterator = None
-            if obj.reference is None:
-                pass
-            elif obj.reference not in g:
-                found = True
-                if '/' in obj.reference and '?' not in obj.reference:
-                    pass
-                elif '?' in obj.reference:
-                    found = False
-                    name_reference = obj.reference.split('=')[0]
-                    stripped_name = ''.join(filter(str.isalnum, obj.display)).replace("Dr", '')
-                    name_reference += f'=name|{stripped_name}'
-                    if name_reference in g:
-                        # logging.info(f"{obj.reference} {name_reference} found in G {g[name_reference]}")
-                        obj.reference = g[name_reference]
-                        found = True
-                if not found:
-                    if f"{obj.reference} {obj.display}" not in logged_already:
-                        logging.warning(f"{obj.reference} {obj.display} not found in bundle {path} {file_path}")
-                        logged_already.append(f"{obj.reference} {obj.display}")
-            else:
-                # logging.info(f"{obj.reference} found in G {g[obj.reference]}")
-                obj.reference = g[obj.reference]
-
-            # add global_reference to bundle
-            if obj.reference in is_global and obj.reference not in add_to_research_study_bundle:
-                add_to_research_study_bundle.append(obj.reference)
-
-        if iterator:
-            if id(obj) not in memo:
-                memo.add(id(obj))
-                for path_component, value in iterator(obj):
-                    for result in obj_walk(value, path + (path_component,), memo):
-                        yield result
-                memo.remove(id(obj))
-        else:
-            yield path, obj
+                local_index[f"#{contained.id}"] = f"#{contained.id}"
 
+    normalizer = _ReferenceNormalizer(local_index, global_index, global_references, file_path)
     for e in bundle.entry:
-        for _, _ in obj_walk(e.resource):
-            pass
+        for reference in _iter_references(e.resource):
+            if reference.reference is not None:
+                reference.reference = normalizer.normalize(
+                    reference.reference, reference.display, e.resource.resource_type, e.resource.id
+                )
 
-    return bundle, add_to_research_study_bundle
+    return bundle, sorted(normalizer.add_to_research_study_bundle)
 
 
-def _file_attributes(file_name):
-    """Calculate the hash and size."""
-    import hashlib
+def _index_local_references(resource: dict, local_index: dict):
+    """Add the keys a bundle's own references may use to find resource to local_index."""
+    local_index[f"urn:uuid:{resource['id']}"] = f"{resource['resourceType']}/{resource['id']}"
+    identifiers = resource.get('identifier', None) or []
+    for identifier in identifiers if isinstance(identifiers, list) else [identifiers]:
+        local_index[f"{resource['resourceType']}?identifier={identifier.get('system')}|{identifier.get('value')}"] = f"{resource['resourceType']}/{resource['id']}"
+    for contained in resource.get('contained', None) or []:
+        # TODO - ensure that contained resources make it to destination system
+        local_index[f"#{contained.get('id')}"] = f"#{contained.get('id')}"
 
-    md5_hash = hashlib.md5()
 
-    with open(file_name, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
+def _normalize_resource_dict(resource: dict, normalizer: '_ReferenceNormalizer'):
+    """Normalize the references of a single resource dict in place."""
+    for reference in iter_reference_dicts(resource):
+        reference['reference'] = normalizer.normalize(
+            reference['reference'], reference.get('display'), resource['resourceType'], resource['id']
+        )
 
-    return md5_hash.hexdigest(), os.lstat(file_name).st_size
 
+def _normalize_references_dict(bundle_json: dict, global_index, global_references, file_path) -> list:
+    """_normalize_references for a bundle as parsed json, returns add_to_research_study_bundle."""
+    local_index = {}
+    for e in bundle_json['entry']:
+        _index_local_references(e['resource'], local_index)
 
-def _transform_bundle(file_path: Path, output_path: Path, global_resources: list) -> dict:
-    """Read json, update bundle with bundle Specimen, Task, ensure DocumentReference."""
-    tic = time.perf_counter()
-    bundle = Bundle(json.load(open(file_path)))
-    dna_diagnostic_reports = []
-    dna_document_references = []
-    imaging_diagnostic_reports = []
-    imaging_document_references = []
-    clinical_note_references = []
-    patient = None
-    additional_entries = []
-    conditions = []
-    imaging_studies = []
-    for e in bundle.entry:
+    normalizer = _ReferenceNormalizer(local_index, global_index, global_references, file_path)
+    for e in bundle_json['entry']:
+        _normalize_resource_dict(e['resource'], normalizer)
 
-        if e.resource.resource_type == 'Patient':
-            patient = e.resource
+    return sorted(normalizer.add_to_research_study_bundle)
 
-        if e.resource.resource_type == 'ExplanationOfBenefit':
-            if e.resource.status == 'completed':
-                e.resource.status = None
-                logging.warning(f"invalid status ExplanationOfBenefit.{e.resource.id}  set to None")
 
-        if e.resource.resource_type == 'DiagnosticReport':
-            codes = [c.code for c in e.resource.code.coding]
+class PhaseTimer:
+    """Accumulate wall time per phase, nested phases are excluded from the enclosing one."""
+
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name):
+        tic = time.perf_counter()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - tic
+            self._stack.pop()
+            self.phases[name] += elapsed
+            if self._stack:
+                self.phases[self._stack[-1]] -= elapsed
+
+
+def _file_attributes(file_name, cache=True):
+    """Calculate the hash and size, see file_digest."""
+    return file_attributes(file_name, cache=cache)
+
+
+class BundleIndex(BaseModel):
+    """Resources of interest in a patient bundle, see _classify_bundle."""
+    class Config:
+        arbitrary_types_allowed = True
+    patient: Patient = None
+    dna_diagnostic_reports: List[DiagnosticReport] = []
+    dna_document_references: List[DocumentReference] = []
+    imaging_diagnostic_reports: List[DiagnosticReport] = []
+    imaging_document_references: List[DocumentReference] = []
+    clinical_note_references: List[DocumentReference] = []
+    # first coding of each Condition
+    conditions: List[Coding] = []
+    imaging_studies: List[ImagingStudy] = []
+    # DocumentReference.id -> decoded content[0].attachment.data
+    attachment_text: Dict[str, str] = {}
+
+
+def _classify_bundle(resources: Iterable) -> BundleIndex:
+    """Single pass over resources, decode each attachment once.
+
+    Also clears invalid ExplanationOfBenefit.status.
+    """
+    bundle_index = BundleIndex()
+    for resource in resources:
+
+        if resource.resource_type == 'Patient':
+            bundle_index.patient = resource
+
+        if resource.resource_type == 'ExplanationOfBenefit':
+            if resource.status == 'completed':
+                resource.status = None
+                logging.warning(f"invalid status ExplanationOfBenefit.{resource.id}  set to None")
+
+        if resource.resource_type == 'DiagnosticReport':
+            codes = [c.code for c in resource.code.coding]
             # genetic panel
             if '55232-3' in codes:
-                dna_diagnostic_reports.append(e.resource)
+                bundle_index.dna_diagnostic_reports.append(resource)
             # imaging
-            if e.resource.presentedForm and len(e.resource.presentedForm) == 1 and e.resource.presentedForm[0].data:
-                data = base64.b64decode(e.resource.presentedForm[0].data).decode("utf-8")
+            if resource.presentedForm and len(resource.presentedForm) == 1 and resource.presentedForm[0].data:
+                data = base64.b64decode(resource.presentedForm[0].data).decode("utf-8")
                 if '.dcm' in data:
-                    imaging_diagnostic_reports.append(e.resource)
+                    bundle_index.imaging_diagnostic_reports.append(resource)
 
-        if e.resource.resource_type == 'DocumentReference':
-            data = base64.b64decode(e.resource.content[0].attachment.data).decode("utf-8")
+        if resource.resource_type == 'DocumentReference':
+            data = base64.b64decode(resource.content[0].attachment.data).decode("utf-8")
+            bundle_index.attachment_text[resource.id] = data
             if "_dna.csv" in data:
-                dna_document_references.append(e.resource)
-                clinical_note_references.append(e.resource)
+                bundle_index.dna_document_references.append(resource)
             elif '.dcm' in data:
-                imaging_document_references.append(e.resource)
-                clinical_note_references.append(e.resource)
-            else:
-                clinical_note_references.append(e.resource)
+                bundle_index.imaging_document_references.append(resource)
+            bundle_index.clinical_note_references.append(resource)
+
+        if resource.resource_type == 'Condition':
+            bundle_index.conditions.append(resource.code.coding[0])
+
+        if resource.resource_type == 'ImagingStudy':
+            bundle_index.imaging_studies.append(resource)
+
+    return bundle_index
+
+
+def _dicom_metadata_extension(path) -> Extension:
+    """Read the DICOM header, never the pixel data, return DICOM_METADATA_KEYWORDS as a complex extension."""
+    # only needed with --dicom_metadata
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+    from pydicom.multival import MultiValue
+    try:
+        dataset = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=list(DICOM_METADATA_KEYWORDS))
+    except (OSError, InvalidDicomError) as e:
+        logging.getLogger(__name__).warning(f"Could not read DICOM header {path} {e}")
+        return None
+    extensions = []
+    for keyword, value_type in DICOM_METADATA_KEYWORDS.items():
+        value = dataset.get(keyword)
+        if value is None or value == '':
+            continue
+        if value_type == 'valueInteger':
+            if isinstance(value, MultiValue):
+                logging.getLogger(__name__).warning(f"{keyword} has {len(value)} values in {path}, using the first")
+                value = value[0] if len(value) else None
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                logging.getLogger(__name__).warning(f"Invalid {keyword} {value} in {path}")
+                continue
+        elif value_type == 'valueDate':
+            value = str(value)
+            if len(value) != 8 or not value.isdigit():
+                logging.getLogger(__name__).warning(f"Invalid {keyword} {value} in {path}")
+                continue
+            value = f"{value[:4]}-{value[4:6]}-{value[6:]}"
+        else:
+            value = str(value)
+        extensions.append({'url': keyword, value_type: value})
+    return Extension({'url': DICOM_METADATA_URL, 'extension': extensions})
 
-        if e.resource.resource_type == 'Condition':
-            conditions.append(e.resource)
 
-        if e.resource.resource_type == 'ImagingStudy':
-            imaging_studies.append(e.resource)
+def _replace_extension(extensions: List[Extension], extension: Extension) -> List[Extension]:
+    """extensions with any extension of the same url replaced by extension."""
+    return [existing for existing in extensions or [] if existing.url != extension.url] + [extension]
 
-    output_file = None
-    if len(dna_diagnostic_reports) > 0:
+
+def _imaging_studies_of(imaging_studies: List[ImagingStudy], diagnostic_report: DiagnosticReport) -> List[ImagingStudy]:
+    """ImagingStudies of the report's encounter, or the only one in the bundle."""
+    if diagnostic_report.encounter:
+        same_encounter = [
+            imaging_study for imaging_study in imaging_studies
+            if imaging_study.encounter and imaging_study.encounter.reference == diagnostic_report.encounter.reference
+        ]
+        if same_encounter:
+            return same_encounter
+    return imaging_studies if len(imaging_studies) == 1 else []
+
+
+def _document_reference_entries(bundle_index: BundleIndex, file_path: Path, timer: 'PhaseTimer') -> list:
+    """Add Specimen, Task, DocumentReference with url for dna and imaging reports, write clinical notes to files.
+
+    Returns the resources to add to the bundle.
+    """
+    patient = bundle_index.patient
+    attachment_text = bundle_index.attachment_text
+    additional_entries = []
+
+    if len(bundle_index.dna_diagnostic_reports) > 0:
         # logging.info(f"{file_path} has {len(dna_diagnostic_reports)} genetic analysis reports")
-        for diagnostic_report in dna_diagnostic_reports:
+        for diagnostic_report in bundle_index.dna_diagnostic_reports:
             # create a specimen
             specimen = Specimen()
             specimen.id = str(uuid.uuid5(uuid.UUID(diagnostic_report.id), 'specimen'))
@@ -308,9 +608,9 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
                  'valueReference': {'reference': f"{diagnostic_report.resource_type}/{diagnostic_report.id}"}}
             )]
             assert len(
-                dna_document_references) == 1, "Should have found a document reference with a reference to the dna data."
+                bundle_index.dna_document_references) == 1, "Should have found a document reference with a reference to the dna data."
             # this document reference is the clinical note
-            document_reference = dna_document_references[0]
+            document_reference = bundle_index.dna_document_references[0]
             # clone the document reference, create new one with url
             document_reference_with_url = DocumentReference(document_reference.as_json())
 
@@ -319,7 +619,7 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
             document_reference_with_url.category[0].coding[0].code = "100029-8"
             document_reference_with_url.category[0].coding[0].display = "Cancer related multigene analysis Molgen Doc (cfDNA)"
 
-            data = base64.b64decode(document_reference_with_url.content[0].attachment.data).decode("utf-8")
+            data = attachment_text[document_reference.id]
             lines = data.split('\n')
             line_with_file_info = next(
                 iter([line for line in lines if 'genetic analysis summary panel  stored in' in line]), None)
@@ -338,7 +638,8 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
             # alter attachment
             document_reference_with_url.content[0].attachment.data = None
             document_reference_with_url.content[0].attachment.url = path_from_report
-            md5, file_size = _file_attributes(path_from_report)
+            with timer.phase('hash'):
+                md5, file_size = _file_attributes(path_from_report)
             document_reference_with_url.content[0].attachment.size = file_size
             if not document_reference_with_url.content[0].attachment.extension:
                 document_reference_with_url.content[0].attachment.extension = []
@@ -364,9 +665,11 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
             # add the task to bundle
             additional_entries.append(task)
 
-    if len(imaging_diagnostic_reports) > 0:
-        for imaging_diagnostic_report in imaging_diagnostic_reports:
-            if len(imaging_document_references) != 1:
+    if len(bundle_index.imaging_diagnostic_reports) > 0:
+        # path -> dicom-metadata Extension
+        dicom_metadata_by_path = {}
+        for imaging_diagnostic_report in bundle_index.imaging_diagnostic_reports:
+            if len(bundle_index.imaging_document_references) != 1:
                 logging.warning(f"No document reference found with a reference to the imaging data. {file_path}")
                 continue
 
@@ -375,7 +678,7 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
             #                  f"{len(imaging_document_references)} document_references with embedded dicom files")
 
             # this document reference is the clinical note
-            document_reference = imaging_document_references[0]
+            document_reference = bundle_index.imaging_document_references[0]
             # clone the document reference, create new one with url
             document_reference_with_url = DocumentReference(document_reference.as_json())
 
@@ -384,7 +687,7 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
             document_reference_with_url.category[0].coding[0].code = "image"
             document_reference_with_url.category[0].coding[0].display = "Image"
 
-            data = base64.b64decode(document_reference_with_url.content[0].attachment.data).decode("utf-8")
+            data = attachment_text[document_reference.id]
             lines = data.split('\n')
             line_with_file_info = next(
                 iter([line for line in lines if 'stored in' in line]), None)
@@ -403,7 +706,8 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
 
             document_reference_with_url.content[0].attachment.data = None
             document_reference_with_url.content[0].attachment.url = path_from_report
-            md5, file_size = _file_attributes(path_from_report)
+            with timer.phase('hash'):
+                md5, file_size = _file_attributes(path_from_report)
             document_reference_with_url.content[0].attachment.size = file_size
             if not document_reference_with_url.content[0].attachment.extension:
                 document_reference_with_url.content[0].attachment.extension = []
@@ -415,23 +719,46 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
                 )
             )
 
+            if WORKER_STATE['dicom_metadata']:
+                # reports of the same study share the .dcm, read its header once
+                if path_from_report not in dicom_metadata_by_path:
+                    with timer.phase('dicom'):
+                        dicom_metadata_by_path[path_from_report] = _dicom_metadata_extension(path_from_report)
+                dicom_metadata = dicom_metadata_by_path[path_from_report]
+                if dicom_metadata:
+                    document_reference_with_url.extension = _replace_extension(
+                        document_reference_with_url.extension, dicom_metadata
+                    )
+                    for imaging_study in _imaging_studies_of(bundle_index.imaging_studies, imaging_diagnostic_report):
+                        imaging_study.extension = _replace_extension(
+                            imaging_study.extension, Extension(dicom_metadata.as_json())
+                        )
+
             # unique id
             document_reference_with_url.id = str(uuid.uuid5(uuid.UUID(imaging_diagnostic_report.id), 'document_reference_with_url'))
             additional_entries.append(document_reference_with_url)
             # logging.info(f"Added dicom document_reference to bundle in {file_path}")
 
-    if len(clinical_note_references) > 0:
-        for document_reference in clinical_note_references:
+    if len(bundle_index.clinical_note_references) > 0:
+        for document_reference in bundle_index.clinical_note_references:
             # write data as a file
-            data = base64.b64decode(document_reference.content[0].attachment.data).decode("utf-8")
-            data = data.replace(patient.name[0].given[0], '')
-            path = f"./output/clinical_reports/{patient.id}_{document_reference.id}.txt"
-            with open(path, "w") as f:
-                f.write(data)
+            text = attachment_text[document_reference.id].replace(patient.name[0].given[0], '')
+            data = text.encode("utf-8")
+            note_store = WORKER_STATE['note_store']
+            if note_store:
+                md5, file_size = note_store.put(data, patient.id, document_reference.id)
+                path = note_store.url(md5)
+            else:
+                path = f"./output/clinical_reports/{patient.id}_{document_reference.id}.txt"
+                with open(path, "wb") as f:
+                    f.write(data)
+                md5, file_size = hashlib.md5(data).hexdigest(), len(data)
+            if WORKER_STATE['note_index']:
+                with timer.phase('note_index'):
+                    WORKER_STATE['note_index'].put(text, patient.id, document_reference.id, md5)
             # alter attachment
             document_reference.content[0].attachment.data = None
             document_reference.content[0].attachment.url = path
-            md5, file_size = _file_attributes(path)
             document_reference.content[0].attachment.size = file_size
             if not document_reference.content[0].attachment.extension:
                 document_reference.content[0].attachment.extension = []
@@ -443,31 +770,249 @@ def _transform_bundle(file_path: Path, output_path: Path, global_resources: list
                 )
             )
 
-    # add entries to bundle
-    for additional_entry in additional_entries:
-        bundle_entry = BundleEntry()
-        bundle_entry.resource = additional_entry
-        bundle_entry.request = BundleEntryRequest()
-        bundle_entry.request.method = 'PUT'
-        bundle_entry.request.url = f"{bundle_entry.resource.resource_type}/{bundle_entry.resource.id}"
-        bundle.entry.append(bundle_entry)
+    return additional_entries
+
+
+def _bundle_entry(resource) -> BundleEntry:
+    """BundleEntry that PUTs resource."""
+    bundle_entry = BundleEntry()
+    bundle_entry.resource = resource
+    bundle_entry.request = BundleEntryRequest()
+    bundle_entry.request.method = 'PUT'
+    bundle_entry.request.url = f"{bundle_entry.resource.resource_type}/{bundle_entry.resource.id}"
+    return bundle_entry
 
-    # clean up references, make them ready for load
-    bundle, add_to_research_study_bundle = _normalize_references(bundle, global_resources, file_path)
 
-    # write new bundle to output
-    output_file = output_path.joinpath(file_path.name)
-    json.dump(bundle.as_json(), open(output_file, "w"))
+def _classify_bundle_json(bundle_json: dict) -> (BundleIndex, list):
+    """_classify_bundle for the dict engine, materialize only the resources ingest rewrites.
+
+    Returns the index and (entry, resource) pairs of materialized resources.
+    """
+    materialized = []
+    conditions = []
+    for entry in bundle_json['entry']:
+        resource = entry['resource']
+        resource_type = resource['resourceType']
+        if resource_type in WORKER_STATE['materialized']:
+            materialized.append((entry, WORKER_STATE['materialized'][resource_type](resource)))
+        elif resource_type == 'ExplanationOfBenefit':
+            _fix_explanation_of_benefit(resource)
+        elif resource_type == 'Condition':
+            conditions.append(Coding(resource['code']['coding'][0]))
+    bundle_index = _classify_bundle(resource for _, resource in materialized)
+    bundle_index.conditions = conditions
+    return bundle_index, materialized
+
+
+def _fix_explanation_of_benefit(resource: dict):
+    """Synthea writes an invalid ExplanationOfBenefit.status."""
+    if resource.get('status') == 'completed':
+        del resource['status']
+        logging.warning(f"invalid status ExplanationOfBenefit.{resource['id']}  set to None")
+
+
+def _classify_bundle_stream(reader: BundleReader) -> (BundleIndex, dict, dict):
+    """First pass of the stream engine, keeps only what the second pass needs.
+
+    Returns the index, materialized resources by entry position and the bundle's local reference index.
+    """
+    materialized = {}
+    conditions = []
+    local_index = {}
+    for position, entry in enumerate(reader):
+        resource = entry['resource']
+        resource_type = resource['resourceType']
+        _index_local_references(resource, local_index)
+        if resource_type in WORKER_STATE['materialized']:
+            materialized[position] = WORKER_STATE['materialized'][resource_type](resource)
+        elif resource_type == 'Condition':
+            conditions.append(Coding(resource['code']['coding'][0]))
+    bundle_index = _classify_bundle(materialized.values())
+    bundle_index.conditions = conditions
+    return bundle_index, materialized, local_index
+
+
+def _rewrite_bundle_stream(reader: BundleReader, materialized: dict, additional_entries: list,
+                           normalizer: _ReferenceNormalizer, validate: bool) -> Iterable[dict]:
+    """Second pass of the stream engine, yield the output entries one at a time."""
+    for position, entry in enumerate(itertools.chain(reader, additional_entries)):
+        if position in materialized:
+            entry['resource'] = materialized[position].as_json()
+        resource = entry['resource']
+        if resource['resourceType'] == 'ExplanationOfBenefit':
+            _fix_explanation_of_benefit(resource)
+        _normalize_resource_dict(resource, normalizer)
+        if validate:
+            # strict parse raises on invalid output
+            BundleEntry(entry)
+        yield entry
+
+
+def _commit_note_stores():
+    """Write the bundle's buffered notes, one short transaction per store once the CPU work is done."""
+    for store in (WORKER_STATE['note_store'], WORKER_STATE['note_index']):
+        if store:
+            store.commit()
+
+
+def _sampled(file_path: Path, sample_rate: float) -> bool:
+    """Stable selection of sample_rate of the bundles."""
+    return int(hashlib.md5(file_path.name.encode()).hexdigest()[:8], 16) < sample_rate * 0x100000000
+
+
+def _transform_bundle(file_path: Path, output_path: Path) -> dict:
+    """Read json, update bundle with bundle Specimen, Task, ensure DocumentReference."""
+    tic = time.perf_counter()
+    timer = PhaseTimer()
+    if WORKER_STATE['engine'] == 'stream':
+        return _transform_bundle_stream(file_path, output_path, tic, timer)
+
+    with timer.phase('read'):
+        with open(file_path, 'rb') as fp:
+            raw = fp.read()
+        source = {
+            'file_path': str(file_path),
+            'size': len(raw),
+            'mtime_ns': os.stat(file_path).st_mtime_ns,
+            'md5': hashlib.md5(raw).hexdigest()
+        }
+
+    if WORKER_STATE['engine'] == 'dict':
+        with timer.phase('parse'):
+            bundle_json = orjson.loads(raw)
+            del raw
+        with timer.phase('classify'):
+            bundle_index, materialized = _classify_bundle_json(bundle_json)
+        with timer.phase('document_references'):
+            additional_entries = _document_reference_entries(bundle_index, file_path, timer)
+        with timer.phase('serialize'):
+            # only the materialized resources are serialized back
+            for entry, resource in materialized:
+                entry['resource'] = resource.as_json()
+            bundle_json['entry'].extend(_bundle_entry(additional_entry).as_json() for additional_entry in additional_entries)
+        with timer.phase('normalize'):
+            # clean up references, make them ready for load
+            add_to_research_study_bundle = _normalize_references_dict(
+                bundle_json, WORKER_STATE['global_index'], WORKER_STATE['global_references'], file_path
+            )
+        if _sampled(file_path, WORKER_STATE['validate_sample_rate']):
+            with timer.phase('validate'):
+                # keep the dict engine honest, strict parse raises on invalid output
+                Bundle(bundle_json)
+                logging.getLogger(__name__).info(f"Validated {file_path}")
+    else:
+        with timer.phase('parse'):
+            bundle_json = json.loads(raw)
+            del raw
+        with timer.phase('construct'):
+            bundle = Bundle(bundle_json)
+        with timer.phase('classify'):
+            bundle_index = _classify_bundle(e.resource for e in bundle.entry)
+        with timer.phase('document_references'):
+            additional_entries = _document_reference_entries(bundle_index, file_path, timer)
+            # add entries to bundle
+            bundle.entry.extend(_bundle_entry(additional_entry) for additional_entry in additional_entries)
+        with timer.phase('normalize'):
+            # clean up references, make them ready for load
+            bundle, add_to_research_study_bundle = _normalize_references(
+                bundle, WORKER_STATE['global_index'], WORKER_STATE['global_references'], file_path
+            )
+        with timer.phase('serialize'):
+            bundle_json = bundle.as_json()
+
+    with timer.phase('write'):
+        _commit_note_stores()
 
+        if WORKER_STATE['output_format'] == 'ndjson':
+            bytes_written = _write_ndjson_shards((e['resource'] for e in bundle_json['entry']), output_path)
+            output_file = file_path
+        else:
+            # write new bundle to output
+            output_file = output_path.joinpath(file_path.name)
+            if WORKER_STATE['engine'] == 'dict':
+                with open(output_file, "wb") as fp:
+                    fp.write(orjson.dumps(bundle_json))
+            else:
+                json.dump(bundle_json, open(output_file, "w"))
+            bytes_written = os.path.getsize(output_file)
+
+    return _transform_result(file_path, output_file, bundle_index, add_to_research_study_bundle, source,
+                             bytes_written, tic, timer)
+
+
+def _transform_bundle_stream(file_path: Path, output_path: Path, tic: float, timer: PhaseTimer) -> dict:
+    """_transform_bundle in two streaming passes over file_path, memory is bounded by the largest entry."""
+    with timer.phase('classify'):
+        reader = BundleReader(file_path)
+        bundle_index, materialized, local_index = _classify_bundle_stream(reader)
+        source = {
+            'file_path': str(file_path),
+            'size': reader.size,
+            'mtime_ns': os.stat(file_path).st_mtime_ns,
+            'md5': reader.md5
+        }
+    with timer.phase('document_references'):
+        additional_entries = [
+            _bundle_entry(additional_entry).as_json()
+            for additional_entry in _document_reference_entries(bundle_index, file_path, timer)
+        ]
+        for additional_entry in additional_entries:
+            _index_local_references(additional_entry['resource'], local_index)
+
+    normalizer = _ReferenceNormalizer(
+        local_index, WORKER_STATE['global_index'], WORKER_STATE['global_references'], file_path
+    )
+    validate = _sampled(file_path, WORKER_STATE['validate_sample_rate'])
+    # rewrite is interleaved with write, reported as one phase
+    with timer.phase('write'):
+        _commit_note_stores()
+
+        reader = BundleReader(file_path)
+        entries = _rewrite_bundle_stream(reader, materialized, additional_entries, normalizer, validate)
+        if WORKER_STATE['output_format'] == 'ndjson':
+            bytes_written = _write_ndjson_shards((e['resource'] for e in entries), output_path)
+            output_file = file_path
+        else:
+            output_file = output_path.joinpath(file_path.name)
+            with open(output_file, "wb") as fp:
+                # reader.header is complete once the first entry is read
+                first_entry = next(entries, None)
+                with BundleWriter(fp, reader.header) as writer:
+                    if first_entry is not None:
+                        writer.write(first_entry)
+                    for entry in entries:
+                        writer.write(entry)
+            bytes_written = writer.bytes_written
+    if validate:
+        logging.getLogger(__name__).info(f"Validated {file_path}")
+
+    return _transform_result(file_path, output_file, bundle_index, sorted(normalizer.add_to_research_study_bundle),
+                             source, bytes_written, tic, timer)
+
+
+def _transform_result(file_path, output_file, bundle_index, add_to_research_study_bundle, source, bytes_written,
+                      tic, timer) -> dict:
+    """What a worker returns to ingest for one bundle."""
     toc = time.perf_counter()
     msg = f"Parsed {file_path} in {toc - tic:0.4f} seconds, wrote {output_file}"
     logging.getLogger(__name__).info(msg)
 
     return {
-        'patient_id': patient.id,
-        'conditions': [condition.code.coding[0] for condition in conditions],
+        'patient_id': bundle_index.patient.id,
+        'conditions': bundle_index.conditions,
         'bundle_file_path': output_file,
-        'add_to_research_study_bundle': add_to_research_study_bundle
+        'add_to_research_study_bundle': add_to_research_study_bundle,
+        'source': source,
+        'metrics': {
+            'file_path': str(file_path),
+            'pid': os.getpid(),
+            'seconds': toc - tic,
+            'phases': dict(timer.phases),
+            # peak for the worker process so far, kilobytes on linux
+            'max_rss': getrusage(RUSAGE_SELF).ru_maxrss,
+            'bytes_read': source['size'],
+            'bytes_written': bytes_written
+        }
     }
 
 
@@ -527,7 +1072,7 @@ http://snomed.info/sct,162573006,Suspected lung cancer (situation)
         "Lung Cancer": {'conditions': ['254637007', '424132000', '162573006']},
     }
     for study_name, study_dict in study_manifests.items():
-        study_dict['bundle_file_paths'] = []
+        study_dict['bundle_file_paths'] = set()
         study_dict['research_subjects'] = []
         study_dict['research_study'] = ResearchStudy({
             'title': study_name,
@@ -541,39 +1086,247 @@ http://snomed.info/sct,162573006,Suspected lung cancer (situation)
                 condition_code in study_dict['conditions']
             ],
         })
-        study_dict['add_to_research_study_bundle'] = []
+        study_dict['add_to_research_study_bundle'] = set()
 
     return study_manifests
 
 
-def member_of_study(patient_conditions, study_manifests):
+def condition_study_index(study_manifests) -> dict:
+    """Map each condition code to the studies that include it."""
+    condition_index = defaultdict(list)
+    for study in study_manifests.values():
+        for condition_code in study['conditions']:
+            condition_index[condition_code].append(study)
+    return condition_index
+
+
+def member_of_study(patient_conditions, study_manifests, condition_index=None):
     """Add patient to manifest based on condition_code."""
+    if condition_index is None:
+        condition_index = condition_study_index(study_manifests)
+    bundle_file_path = str(patient_conditions['bundle_file_path'])
     for patient_condition in patient_conditions['conditions']:
+        for study in condition_index.get(patient_condition.code, ()):
+            if bundle_file_path not in study['bundle_file_paths']:
+                logging.info(
+                    f"Added {patient_conditions['bundle_file_path']} to research_study "
+                    f"\"{study['research_study'].title}\" condition \"{patient_condition.display}\""
+                )
+                study['bundle_file_paths'].add(bundle_file_path)
+                study['research_subjects'].append(ResearchSubject(
+                    {
+                        'id': str(uuid.uuid5(uuid.NAMESPACE_DNS, patient_conditions['patient_id'])),
+                        'status': 'on-study',
+                        'study': {"reference": f"ResearchStudy/{study['research_study'].id}"},
+                        'individual': {"reference": f"Patient/{patient_conditions['patient_id']}"},
+                        'meta': {'source': bundle_file_path}
+                    }
+                ))
+                study['add_to_research_study_bundle'].update(patient_conditions['add_to_research_study_bundle'])
+
+
+def _load_ingest_manifest(manifest_path: Path, settings: dict) -> dict:
+    """Read bundle entries recorded by a previous run, ignore them if version or settings changed."""
+    if not manifest_path.is_file():
+        return {}
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+    if manifest.get('version') != INGEST_MANIFEST_VERSION or manifest.get('settings') != settings:
+        logging.getLogger(__name__).info(f"{manifest_path} is out of date, re-transforming all bundles")
+        return {}
+    return manifest['bundles']
+
+
+def _write_ingest_manifest(manifest_path: Path, settings: dict, bundles: dict):
+    """Write manifest, replace atomically so an interrupted run leaves the previous one intact."""
+    manifest = {'version': INGEST_MANIFEST_VERSION, 'settings': settings, 'bundles': bundles}
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_path, manifest_path)
+
+
+def _manifest_entry(patient_conditions: dict) -> dict:
+    """Serializable manifest entry for a _transform_bundle result."""
+    source = patient_conditions['source']
+    return {
+        'size': source['size'],
+        'mtime_ns': source['mtime_ns'],
+        'md5': source['md5'],
+        'patient_conditions': {
+            'patient_id': patient_conditions['patient_id'],
+            'conditions': [coding.as_json() for coding in patient_conditions['conditions']],
+            'bundle_file_path': str(patient_conditions['bundle_file_path']),
+            'add_to_research_study_bundle': patient_conditions['add_to_research_study_bundle']
+        }
+    }
+
+
+def _cached_patient_conditions(file_path: Path, entry: dict):
+    """Return the recorded _transform_bundle result if file_path is unchanged, otherwise None.
+
+    size and mtime are checked first, the content hash only when mtime moved (e.g. re-extracted zip).
+    """
+    if not entry:
+        return None
+    stat = os.stat(file_path)
+    if stat.st_size != entry['size']:
+        return None
+    patient_conditions = entry['patient_conditions']
+    if not os.path.isfile(patient_conditions['bundle_file_path']):
+        return None
+    if stat.st_mtime_ns != entry['mtime_ns']:
+        md5, _ = _file_attributes(file_path)
+        if md5 != entry['md5']:
+            return None
+        entry['mtime_ns'] = stat.st_mtime_ns
+    return {
+        **patient_conditions,
+        'conditions': [Coding(coding) for coding in patient_conditions['conditions']]
+    }
+
+
+def _sample_key(file_path: Path) -> str:
+    """Patient id, synthea names bundles <given>_<family>_<patient id>.json, other names are keyed by the whole stem."""
+    _, _, patient_id = file_path.stem.rpartition('_')
+    return patient_id or file_path.stem
+
+
+def _sample_rank(key: str, seed: int) -> float:
+    """Stable pseudo random number in [0, 1) for key."""
+    return int(hashlib.md5(f"{seed}:{key}".encode()).hexdigest()[:16], 16) / 0x10000000000000000
+
+
+def sample_file_paths(file_paths: List[Path], sample_fraction: float, sample_seed: int, study_manifests: dict,
+                      cohort_index: CohortIndex = None) -> List[Path]:
+    """Select sample_fraction of the bundles by a hash of patient id.
+
+    With the cohort index of a previous full run, selection is stratified: every study keeps
+    at least ceil(sample_fraction * members) members, taken in hash order.
+    """
+    def _rank(file_path):
+        return _sample_rank(_sample_key(file_path), sample_seed)
+
+    selected = {file_path for file_path in file_paths if _rank(file_path) < sample_fraction}
+    if cohort_index:
+        file_paths_by_key = {_sample_key(file_path): file_path for file_path in file_paths}
         for study in study_manifests.values():
-            if patient_condition.code in study['conditions']:
-                bundle_file_path = str(patient_conditions['bundle_file_path'])
-                if bundle_file_path not in study['bundle_file_paths']:
-                    logging.info(
-                        f"Added {patient_conditions['bundle_file_path']} to research_study "
-                        f"\"{study['research_study'].title}\" condition \"{patient_condition.display}\""
-                    )
-                    study['bundle_file_paths'].append(bundle_file_path)
-                    study['research_subjects'].append(ResearchSubject(
-                        {
-                            'id': str(uuid.uuid5(uuid.NAMESPACE_DNS, patient_conditions['patient_id'])),
-                            'status': 'on-study',
-                            'study': {"reference": f"ResearchStudy/{study['research_study'].id}"},
-                            'individual': {"reference": f"Patient/{patient_conditions['patient_id']}"},
-                            'meta': {'source': bundle_file_path}
-                        }
-                    ))
-                    study['add_to_research_study_bundle'].extend(
-                        [
-                            reference for reference in
-                            patient_conditions['add_to_research_study_bundle']
-                            if reference not in study['add_to_research_study_bundle']
-                        ]
-                    )
+            members = sorted(
+                (
+                    file_paths_by_key[patient_id]
+                    for patient_id in cohort_index.patient_ids(cohort_index.query(any_of=study['conditions']))
+                    if patient_id in file_paths_by_key
+                ),
+                key=_rank
+            )
+            quota = math.ceil(sample_fraction * len(members)) - len(selected.intersection(members))
+            for member in members:
+                if quota <= 0:
+                    break
+                if member not in selected:
+                    selected.add(member)
+                    quota -= 1
+    return sorted(selected)
+
+
+def write_sample_studies_manifest(studies_manifest_path: Path, cohort_index: CohortIndex, output_path: Path) -> Path:
+    """Copy the coherent_fhir_studies manifest with expected_count of the sample."""
+    with open(studies_manifest_path) as fp:
+        studies_manifest = yaml.load(fp, yaml.SafeLoader)
+    for values in studies_manifest.values():
+        if 'expected_count' in values:
+            values['expected_count'] = cohort_index.condition_count(values['conditions'])
+    sample_manifest_path = output_path.joinpath('coherent_studies.sample.manifest.yaml')
+    with open(sample_manifest_path, 'w') as fp:
+        yaml.dump(studies_manifest, fp)
+    return sample_manifest_path
+
+
+def _cohort_entry(patient_conditions: dict) -> dict:
+    """What CohortIndex needs from a _transform_bundle result."""
+    return {
+        'patient_id': patient_conditions['patient_id'],
+        'bundle_file_path': str(patient_conditions['bundle_file_path']),
+        'conditions': [coding.as_json() for coding in patient_conditions['conditions']]
+    }
+
+
+def _percentile(sorted_values: list, percent: float):
+    """Nearest-rank percentile."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(percent / 100 * len(sorted_values)) - 1))]
+
+
+def write_ingest_report(metrics: list, output_path: Path, slowest_count=20) -> tuple:
+    """Aggregate worker metrics into ingest_report.json (summary) and ingest_report.csv (a row per bundle).
+
+    Returns the paths written, none if no bundle was transformed: the previous run's report is kept.
+    """
+    if not metrics:
+        logging.getLogger(__name__).info("No bundles transformed, keeping the previous ingest report")
+        return ()
+    phases = sorted({phase for metric in metrics for phase in metric['phases']})
+    max_rss = defaultdict(int)
+    for metric in metrics:
+        max_rss[metric['pid']] = max(max_rss[metric['pid']], metric['max_rss'])
+    summary = {
+        'bundles': len(metrics),
+        'seconds': sum(metric['seconds'] for metric in metrics),
+        'bytes_read': sum(metric['bytes_read'] for metric in metrics),
+        'bytes_written': sum(metric['bytes_written'] for metric in metrics),
+        'phases': {},
+        'max_rss_by_worker': dict(max_rss),
+        'slowest': sorted(metrics, key=lambda metric: metric['seconds'], reverse=True)[:slowest_count]
+    }
+    for phase in ['seconds'] + phases:
+        values = sorted(
+            metric['seconds'] if phase == 'seconds' else metric['phases'].get(phase, 0.0) for metric in metrics
+        )
+        summary['phases'][phase if phase != 'seconds' else 'total'] = {
+            'sum': sum(values),
+            'p50': _percentile(values, 50),
+            'p90': _percentile(values, 90),
+            'p99': _percentile(values, 99),
+            'max': _percentile(values, 100)
+        }
+
+    json_path = output_path.joinpath('ingest_report.json')
+    with open(json_path, 'w') as fp:
+        json.dump(summary, fp, indent=2)
+
+    csv_path = output_path.joinpath('ingest_report.csv')
+    with open(csv_path, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['file_path', 'pid', 'seconds', 'max_rss', 'bytes_read', 'bytes_written'] + phases)
+        for metric in metrics:
+            writer.writerow(
+                [metric[k] for k in ['file_path', 'pid', 'seconds', 'max_rss', 'bytes_read', 'bytes_written']] +
+                [metric['phases'].get(phase, 0.0) for phase in phases]
+            )
+    return json_path, csv_path
+
+
+class _Progress:
+    """Log bundles transformed, rate and ETA at most every `interval` seconds."""
+
+    def __init__(self, total, interval=10.0):
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self):
+        self.count += 1
+        now = time.perf_counter()
+        if now - self.last < self.interval and self.count != self.total:
+            return
+        self.last = now
+        rate = self.count / (now - self.start)
+        eta = (self.total - self.count) / rate
+        logging.getLogger(__name__).info(
+            f"Transformed {self.count}/{self.total} bundles, {rate:0.2f} bundles/second, ETA {eta:0.0f} seconds"
+        )
 
 
 @click.command()
@@ -593,7 +1346,66 @@ def member_of_study(patient_conditions, study_manifests):
               default='output/',
               show_default=True,
               help='Path to output data.')
-def ingest(coherent_path, output_path, file_name_pattern, minimum_file_count):
+@click.option('--incremental/--no-incremental',
+              default=True,
+              show_default=True,
+              help='Skip bundles unchanged since the last run, see <output_path>/ingest_manifest.json.')
+@click.option('--study_global_resources',
+              default='all',
+              type=click.Choice(['all', 'referenced']),
+              show_default=True,
+              help='Global Practitioner/Organization/Location resources written to each research_study bundle: '
+                   'all of them, or only those referenced by the study\'s subjects.')
+@click.option('--output_format',
+              default='bundle',
+              type=click.Choice(['bundle', 'ndjson']),
+              show_default=True,
+              help='Write a bundle per patient, or <output_path>/ndjson/<ResourceType>.ndjson. '
+                   'research_study bundles are written either way.')
+@click.option('--engine',
+              default='fhirclient',
+              type=click.Choice(['fhirclient', 'dict', 'stream']),
+              show_default=True,
+              help='fhirclient: parse each bundle into fhirclient objects. '
+                   'dict: work on parsed json, only build objects for resources that are rewritten. '
+                   'stream: dict in two passes over the file an entry at a time, for very large bundles.')
+@click.option('--validate_sample_rate',
+              default=0.01,
+              show_default=True,
+              help='With --engine dict or stream, fraction of output bundles strictly parsed with fhirclient.')
+@click.option('--note_store',
+              default='files',
+              type=click.Choice(['files', 'sqlite']),
+              show_default=True,
+              help='Write clinical notes as ./output/clinical_reports/*.txt, '
+                   'or once per md5 into <output_path>/clinical_reports.sqlite.')
+@click.option('--sample_fraction',
+              default=1.0,
+              show_default=True,
+              help='Transform this fraction of the bundles, selected by a hash of patient id. '
+                   'Stratified by study if <output_path>/cohort_index.json exists from a full run.')
+@click.option('--sample_seed',
+              default=0,
+              show_default=True,
+              help='With --sample_fraction, a different seed selects a different sample.')
+@click.option('--studies_manifest',
+              default='coherent_studies.manifest.yaml',
+              show_default=True,
+              help='With --sample_fraction, written to <output_path>/coherent_studies.sample.manifest.yaml '
+                   'with the expected_count of the sample.')
+@click.option('--dicom_metadata/--no-dicom_metadata',
+              default=False,
+              show_default=True,
+              help='Read DICOM headers (not pixel data), add modality, dimensions, dates, etc. as extensions '
+                   'to the imaging DocumentReference and ImagingStudy.')
+@click.option('--note_index/--no-note_index',
+              default=False,
+              show_default=True,
+              help='Maintain a full text index of clinical notes in <output_path>/clinical_notes_index.sqlite, '
+                   'search it with note_index.py.')
+def ingest(coherent_path, output_path, file_name_pattern, minimum_file_count, incremental, study_global_resources,
+           output_format, engine, validate_sample_rate, note_store, sample_fraction, sample_seed, studies_manifest,
+           dicom_metadata, note_index):
     """Re-writes synthea bundles."""
 
     # validate parameters
@@ -607,19 +1419,104 @@ def ingest(coherent_path, output_path, file_name_pattern, minimum_file_count):
     file_paths = list(fhir_path.glob(file_name_pattern))
     assert len(file_paths) >= minimum_file_count, f"{str(fhir_path)}.{file_name_pattern} only returned {len(file_paths)} expected at least {minimum_file_count}"
 
+    # the full run's cohort index stratifies the sample, a sample writes its own
+    cohort_index_path = output_path.joinpath('cohort_index.json')
+    sampled = sample_fraction < 1.0
+    if sampled:
+        assert 0.0 < sample_fraction < 1.0, "--sample_fraction must be in (0, 1]"
+        cohort_index = CohortIndex.load(cohort_index_path) if cohort_index_path.is_file() else None
+        if not cohort_index:
+            logging.getLogger(__name__).warning(f"{cohort_index_path} not found, sample is not stratified by study")
+        file_paths = sample_file_paths(file_paths, sample_fraction, sample_seed, create_study_manifests(),
+                                       cohort_index)
+        logging.getLogger(__name__).info(f"Sampled {len(file_paths)} bundles")
+        cohort_index_path = output_path.joinpath('cohort_index.sample.json')
+
+    # bundles unchanged since the last run keep their output and study membership
+    manifest_path = output_path.joinpath('ingest_manifest.json')
+    note_store_path = str(output_path.joinpath('clinical_reports.sqlite')) if note_store == 'sqlite' else None
+    note_index_path = str(output_path.joinpath('clinical_notes_index.sqlite')) if note_index else None
+    # the global resource index is part of every bundle's output
+    manifest_settings = {'output_path': str(output_path), 'output_format': output_format, 'engine': engine,
+                         'note_store_path': note_store_path, 'dicom_metadata': dicom_metadata,
+                         'note_index_path': note_index_path, 'coherent_path': str(coherent_path),
+                         'global_resource_digests': global_resource_digests(coherent_path)}
+    if incremental and output_format == 'ndjson':
+        # ndjson files are rebuilt from every bundle
+        logging.getLogger(__name__).info("--output_format ndjson, transforming all bundles")
+        incremental = False
+    manifest_bundles = _load_ingest_manifest(manifest_path, manifest_settings) if incremental else {}
+    cached_results = []
+    changed_file_paths = []
+    for file_path in file_paths:
+        patient_conditions = _cached_patient_conditions(file_path, manifest_bundles.get(str(file_path)))
+        if patient_conditions:
+            cached_results.append(patient_conditions)
+        else:
+            changed_file_paths.append(file_path)
+    logging.getLogger(__name__).info(
+        f"{len(cached_results)} bundles unchanged, transforming {len(changed_file_paths)} bundles"
+    )
+
+    if output_format == 'ndjson':
+        # discard shards left by an interrupted run
+        shard_path = _ndjson_shard_path(output_path)
+        shutil.rmtree(shard_path, ignore_errors=True)
+        shard_path.mkdir(parents=True)
+
     # set up multi-processing
     tic = time.perf_counter()
     pool_count = max(multiprocessing.cpu_count() - 1, 1)
-    pool = multiprocessing.Pool(pool_count)
+    # each worker builds its own global resource index, tasks only carry the bundle path
+    if note_store_path:
+        # create schema before workers open it
+        NoteStore(note_store_path).close()
+    if note_index_path:
+        NoteIndex(note_index_path).close()
+    worker_settings = {
+        'output_format': output_format,
+        'engine': engine,
+        'validate_sample_rate': validate_sample_rate,
+        'note_store_path': note_store_path,
+        'dicom_metadata': dicom_metadata,
+        'note_index_path': note_index_path
+    }
+    pool = multiprocessing.Pool(pool_count, initializer=_init_worker, initargs=(coherent_path, worker_settings))
     # organizations, locations, etc.
     global_resources = create_global_resources(coherent_path)
     # create our artificial ResearchStudies
     study_manifests = create_study_manifests()
-    # transform patient bundles, write to output
-    for patient_conditions in pool.starmap(_transform_bundle,
-                                           zip(file_paths, repeat(output_path), repeat(global_resources))):
-        # create ResearchStudy & ResearchSubject->Patient for each condition
-        member_of_study(patient_conditions, study_manifests)
+    condition_index = condition_study_index(study_manifests)
+    # create ResearchStudy & ResearchSubject->Patient for each condition
+    # patient_id, bundle_file_path and conditions of every bundle, see CohortIndex
+    cohort = []
+    for patient_conditions in cached_results:
+        member_of_study(patient_conditions, study_manifests, condition_index)
+        cohort.append(_cohort_entry(patient_conditions))
+    # transform patient bundles, write to output, consume results as they complete
+    progress = _Progress(len(changed_file_paths))
+    metrics = []
+    for patient_conditions in pool.imap_unordered(partial(_transform_bundle, output_path=output_path),
+                                                  changed_file_paths):
+        metrics.append(patient_conditions.pop('metrics'))
+        member_of_study(patient_conditions, study_manifests, condition_index)
+        cohort.append(_cohort_entry(patient_conditions))
+        manifest_bundles[patient_conditions['source']['file_path']] = _manifest_entry(patient_conditions)
+        progress.update()
+    pool.close()
+    pool.join()
+    if output_format == 'ndjson':
+        for ndjson_path in concatenate_ndjson_shards(output_path):
+            logging.getLogger(__name__).info(f"Created {ndjson_path}")
+    _write_ingest_manifest(manifest_path, manifest_settings, manifest_bundles)
+    for report_path in write_ingest_report(metrics, output_path):
+        logging.getLogger(__name__).info(f"Created {report_path}")
+    cohort_index = CohortIndex.build(cohort)
+    cohort_index.save(cohort_index_path)
+    logging.getLogger(__name__).info(f"Created {cohort_index_path}")
+    if sampled and os.path.isfile(studies_manifest):
+        sample_manifest_path = write_sample_studies_manifest(Path(studies_manifest), cohort_index, output_path)
+        logging.getLogger(__name__).info(f"Created {sample_manifest_path}")
     toc = time.perf_counter()
     msg = f"Parsed all files in {fhir_path} in {toc - tic:0.4f} seconds"
     logging.getLogger(__name__).info(msg)
@@ -642,7 +1539,8 @@ def ingest(coherent_path, output_path, file_name_pattern, minimum_file_count):
     for study_manifest in study_manifests.values():
         bundle = Bundle({'entry': [], 'type': 'collection'})
         research_study = study_manifest['research_study']
-        research_subjects = study_manifest['research_subjects']
+        # results arrive in completion order, keep output stable
+        research_subjects = sorted(study_manifest['research_subjects'], key=lambda research_subject: research_subject.id)
 
         bundle.entry.append(_make_bundle_entry(research_study))
         bundle.entry.extend(
@@ -652,19 +1550,11 @@ def ingest(coherent_path, output_path, file_name_pattern, minimum_file_count):
             ]
         )
 
-        for resource in global_resources:
-            bundle_entry = BundleEntry()
-            bundle_entry.resource = resource
-            bundle.entry.append(bundle_entry)
-
-        # for reference in study_manifest['add_to_research_study_bundle']:
-        #     resource_type, id_ = reference.split('/')
-        #     for resource in global_resources:
-        #         if resource.resource_type == resource_type and resource.id == id_:
-        #             logging.getLogger(__name__).debug(f"add global_reference {reference} to research_study_bundle")
-        #             bundle_entry = BundleEntry()
-        #             bundle_entry.resource = resource
-        #             bundle.entry.append(bundle_entry)
+        if study_global_resources == 'referenced':
+            resources = _referenced_global_resources(global_resources, study_manifest['add_to_research_study_bundle'])
+        else:
+            resources = global_resources
+        bundle.entry.extend([_make_bundle_entry(resource) for resource in resources])
 
         bundle_path = f"{output_path}/research_study_{'_'.join(research_study.title.split(' '))}.json"
         json.dump(bundle.as_json(), open(bundle_path, 'w'))
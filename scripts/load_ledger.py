@@ -0,0 +1,46 @@
+import os
+import sqlite3
+import time
+
+from file_digest import file_attributes
+
+# override with FHIR_LOAD_LEDGER
+LEDGER_PATH = os.environ.get('FHIR_LOAD_LEDGER', '.fhir_load_ledger.sqlite')
+
+
+class LoadLedger:
+    """Bundles confirmed loaded into a FHIR server, keyed on server url, path and md5.
+
+    A bundle whose content changes is loaded again, see loaded().
+    """
+
+    def __init__(self, path=LEDGER_PATH):
+        self.path = str(path)
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS loaded '
+            '(url TEXT, path TEXT, md5 TEXT, size INTEGER, loaded_at REAL, PRIMARY KEY (url, path, md5))'
+        )
+
+    def loaded(self, url: str, path) -> bool:
+        md5, _ = file_attributes(str(path))
+        row = self.connection.execute(
+            'SELECT 1 FROM loaded WHERE url = ? AND path = ? AND md5 = ?', (url, os.path.abspath(path), md5)
+        ).fetchone()
+        return row is not None
+
+    def record(self, url: str, path):
+        """Record path as loaded, commits immediately so an interrupted run keeps its progress."""
+        md5, size = file_attributes(str(path))
+        self.connection.execute(
+            'INSERT OR REPLACE INTO loaded VALUES (?, ?, ?, ?, ?)',
+            (url, os.path.abspath(path), md5, size, time.time())
+        )
+
+    def forget(self, url: str):
+        """Drop the records of url, everything is loaded again."""
+        self.connection.execute('DELETE FROM loaded WHERE url = ?', (url,))
+
+    def close(self):
+        self.connection.close()
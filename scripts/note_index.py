@@ -0,0 +1,109 @@
+import sqlite3
+from typing import Iterator
+
+import click
+
+
+class NoteIndex:
+    """sqlite FTS5 full text index of clinical notes, keyed by DocumentReference id.
+
+    A note is re-indexed only if its md5 changed, so re-running ingest keeps the index incremental.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        # pool workers write concurrently, autocommit, the write lock is only held in commit()
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS note_document '
+            '(id INTEGER PRIMARY KEY, document_reference_id TEXT UNIQUE, patient_id TEXT, md5 TEXT)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS note_document_patient ON note_document (patient_id)')
+        # rowid of note_text is note_document.id
+        self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS note_text USING fts5(text)')
+        self._pending = []
+
+    def put(self, text: str, patient_id: str, document_reference_id: str, md5: str):
+        """Buffer text for indexing. Call commit() to index the buffered notes."""
+        self._pending.append((text, patient_id, document_reference_id, md5))
+
+    def commit(self):
+        """Index the buffered notes in one short transaction, notes already indexed with the same md5 are skipped."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        # take the write lock now rather than at the first INSERT, other workers wait at most one commit
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            for text, patient_id, document_reference_id, md5 in pending:
+                self._index(text, patient_id, document_reference_id, md5)
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def _index(self, text: str, patient_id: str, document_reference_id: str, md5: str):
+        row = self.connection.execute(
+            'SELECT id, md5 FROM note_document WHERE document_reference_id = ?', (document_reference_id,)
+        ).fetchone()
+        if row:
+            id_, indexed_md5 = row
+            if indexed_md5 == md5:
+                return
+            self.connection.execute('DELETE FROM note_text WHERE rowid = ?', (id_,))
+            self.connection.execute(
+                'UPDATE note_document SET patient_id = ?, md5 = ? WHERE id = ?', (patient_id, md5, id_)
+            )
+        else:
+            id_ = self.connection.execute(
+                'INSERT INTO note_document (document_reference_id, patient_id, md5) VALUES (?, ?, ?)',
+                (document_reference_id, patient_id, md5)
+            ).lastrowid
+        self.connection.execute('INSERT INTO note_text (rowid, text) VALUES (?, ?)', (id_, text))
+
+    def search(self, query: str, limit: int = 100) -> Iterator[tuple]:
+        """Yield (patient_id, document_reference_id, snippet) best match first, query is FTS5 syntax."""
+        yield from self.connection.execute(
+            'SELECT note_document.patient_id, note_document.document_reference_id, '
+            "snippet(note_text, 0, '[', ']', '...', 16) "
+            'FROM note_text JOIN note_document ON note_document.id = note_text.rowid '
+            'WHERE note_text MATCH ? ORDER BY rank LIMIT ?',
+            (query, limit)
+        )
+
+    def patients(self, query: str) -> list:
+        """Sorted ids of the patients with a note matching query."""
+        return [row[0] for row in self.connection.execute(
+            'SELECT DISTINCT note_document.patient_id '
+            'FROM note_text JOIN note_document ON note_document.id = note_text.rowid '
+            'WHERE note_text MATCH ? ORDER BY 1',
+            (query,)
+        )]
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+@click.command()
+@click.argument('query')
+@click.option('--index', 'index_path', default='output/clinical_notes_index.sqlite', show_default=True,
+              help='Written by ingest --note_index')
+@click.option('--limit', default=20, show_default=True,
+              help='Maximum number of notes to print')
+@click.option('--patients/--no-patients', default=False, show_default=True,
+              help='Print every matching patient id instead of notes')
+def main(query, index_path, limit, patients):
+    """Search clinical notes, QUERY is FTS5 syntax e.g. 'asthma', '"chest pain"', 'covid NOT vaccine'."""
+    note_index = NoteIndex(index_path)
+    if patients:
+        for patient_id in note_index.patients(query):
+            print(patient_id)
+        return
+    for patient_id, document_reference_id, snippet in note_index.search(query, limit):
+        print(f"Patient/{patient_id} DocumentReference/{document_reference_id}\n  {' '.join(snippet.split())}")
+
+
+if __name__ == '__main__':
+    main()
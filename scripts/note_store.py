@@ -0,0 +1,91 @@
+import functools
+import hashlib
+import pathlib
+import sqlite3
+from typing import Iterator
+
+
+class NoteStore:
+    """Content-addressed clinical notes in a single sqlite file.
+
+    A note is stored once per md5, members map DocumentReference ids to notes.
+    DocumentReference attachment urls point to a note as `<path>#<md5>`, see url().
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = str(path)
+        self._pending = []
+        if read_only:
+            # readers of an existing store, never create it or change its journal mode
+            self.connection = sqlite3.connect(
+                f"{pathlib.Path(self.path).absolute().as_uri()}?mode=ro", uri=True, isolation_level=None
+            )
+            return
+        # pool workers write concurrently, autocommit, the write lock is only held in commit()
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS note (md5 TEXT PRIMARY KEY, size INTEGER, data BLOB)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS note_member '
+            '(document_reference_id TEXT PRIMARY KEY, patient_id TEXT, md5 TEXT)'
+        )
+
+    def put(self, data: bytes, patient_id: str, document_reference_id: str) -> (str, int):
+        """Buffer data, returns md5 and size. Call commit() to write the buffered notes."""
+        md5 = hashlib.md5(data).hexdigest()
+        self._pending.append((md5, data, patient_id, document_reference_id))
+        return md5, len(data)
+
+    def commit(self):
+        """Write the buffered notes in one short transaction."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        # take the write lock now rather than at the first INSERT, other workers wait at most one commit
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO note VALUES (?, ?, ?)',
+                [(md5, len(data), data) for md5, data, _, _ in pending]
+            )
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO note_member VALUES (?, ?, ?)',
+                [(document_reference_id, patient_id, md5) for md5, _, patient_id, document_reference_id in pending]
+            )
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def url(self, md5: str) -> str:
+        """Attachment url of a note."""
+        return f"{self.path}#{md5}"
+
+    def get(self, md5: str) -> bytes:
+        """Note contents, None if not found."""
+        row = self.connection.execute('SELECT data FROM note WHERE md5 = ?', (md5,)).fetchone()
+        return row[0] if row else None
+
+    def members(self) -> Iterator[tuple]:
+        """Yield (document_reference_id, patient_id, md5) for every stored note."""
+        yield from self.connection.execute('SELECT document_reference_id, patient_id, md5 FROM note_member')
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+@functools.lru_cache(maxsize=None)
+def open_note_store(path: str) -> NoteStore:
+    """One read-only connection per note store, for readers of attachment urls, see parse_url()."""
+    return NoteStore(path, read_only=True)
+
+
+def parse_url(url: str) -> (str, str):
+    """(store path, md5) of an attachment url written by NoteStore.url(), None for any other url."""
+    path, _, md5 = (url or '').partition('#')
+    if not md5 or not path.endswith('.sqlite'):
+        return None
+    return path, md5
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import asyncio
 import base64
+import io
 import json
 import logging
 import pathlib
@@ -15,6 +16,8 @@ from gen3.auth import Gen3Auth
 from gen3.file import Gen3File
 from gen3.index import Gen3Index
 
+from note_store import open_note_store, parse_url
+
 logging.basicConfig(level=logging.INFO)
 
 logger = logging.getLogger(__name__)
@@ -57,7 +60,12 @@ async def upload_and_decorate_document_reference(document_reference, bucket_name
 
     # use gen3 properties - should we use 'native' FHIR properties
     md5sum = document_reference["md5sum"]
-    object_name = document_reference['file_name'].lstrip('./').lstrip('file:///')
+    note = parse_url(document_reference['file_name'])
+    if note:
+        # ingest --note_store sqlite, the note is read from the store
+        object_name = f"{note[1]}.txt"
+    else:
+        object_name = document_reference['file_name'].lstrip('./').lstrip('file:///')
 
     hashes = {'md5': md5sum}
     assert 'id' in document_reference, document_reference
@@ -87,8 +95,12 @@ async def upload_and_decorate_document_reference(document_reference, bucket_name
     signed_url = urllib.parse.unquote(document['url'])
     guid = document_reference['id']
 
-    file_name = pathlib.Path(file_path) / object_name
-    with open(file_name, 'rb') as data_f:
+    if note:
+        store_path, md5 = note
+        data_f = io.BytesIO(open_note_store(str(pathlib.Path(file_path) / store_path)).get(md5))
+    else:
+        data_f = open(pathlib.Path(file_path) / object_name, 'rb')
+    with data_f:
         # When you use this header, Amazon S3 checks the object against the provided MD5 value and,
         # if they do not match, returns an error.
         content_md5 = base64.b64encode(bytes.fromhex(md5sum))
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# scripts are run from, and import each other from, the scripts directory
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('scripts')))
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from coherent_fhir_load import import_all, serve_staging
+from load_ledger import LoadLedger
+
+
+class _ImportServer:
+    """Bulk Data $import in a thread: 202 + Content-Location, `pending` polls of 202, then fetch the input and 200."""
+
+    def __init__(self, pending=2):
+        self.pending = pending
+        self.parameters = None
+        self.polls = 0
+        # input url -> ndjson fetched from it
+        self.fetched = {}
+        self.url = None
+        self._started = threading.Event()
+
+    async def _import(self, request):
+        assert request.headers['Prefer'] == 'respond-async'
+        self.parameters = await request.json()
+        return web.Response(status=202, headers={'Content-Location': f"{self.url}/$import-poll-status/1"})
+
+    async def _status(self, request):
+        self.polls += 1
+        if self.polls <= self.pending:
+            return web.Response(status=202, headers={'Retry-After': '0', 'X-Progress': f"poll {self.polls}"})
+        urls = [
+            part['valueUri'] for parameter in self.parameters['parameter'] if parameter['name'] == 'input'
+            for part in parameter['part'] if part['name'] == 'url'
+        ]
+        async with aiohttp.ClientSession() as session:
+            for url in urls:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    self.fetched[url] = await response.text()
+        return web.json_response({'output': [{'type': 'OperationOutcome', 'url': url} for url in urls], 'error': []})
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post('/fhir/$import', self._import)
+        app.router.add_get('/fhir/$import-poll-status/1', self._status)
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.url = f"http://127.0.0.1:{runner.addresses[0][1]}/fhir"
+        self._started.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(runner.cleanup())
+
+    def __enter__(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._started.wait()
+        return self
+
+    def __exit__(self, *args):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def _bundle(*resources):
+    return {'resourceType': 'Bundle', 'type': 'transaction', 'entry': [
+        {'fullUrl': f"urn:uuid:{resource['id']}", 'resource': resource,
+         'request': {'method': 'POST', 'url': resource['resourceType']}}
+        for resource in resources
+    ]}
+
+
+@pytest.fixture
+def coherent_path(tmp_path, monkeypatch):
+    # the file digest cache is written to the working directory
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('fhir').mkdir()
+    bundles = {
+        'organizations': _bundle({'resourceType': 'Organization', 'id': 'o1',
+                                  'identifier': [{'system': 'https://github.com/synthetichealth/synthea', 'value': 'x'}]}),
+        'practitioners': _bundle({'resourceType': 'Practitioner', 'id': 'pr1'}),
+        'p1': _bundle(
+            {'resourceType': 'Patient', 'id': 'p1'},
+            {'resourceType': 'Encounter', 'id': 'e1', 'subject': {'reference': 'urn:uuid:p1'},
+             'serviceProvider': {'reference': 'Organization?identifier=https://github.com/synthetichealth/synthea|x'}},
+        ),
+    }
+    for name, bundle in bundles.items():
+        tmp_path.joinpath('fhir', f"{name}.json").write_text(json.dumps(bundle))
+    return tmp_path
+
+
+def test_import_all(coherent_path):
+    staging_path = coherent_path.joinpath('import')
+    ledger = LoadLedger(coherent_path.joinpath('ledger.sqlite'))
+    with _ImportServer(pending=2) as server, serve_staging(staging_path, '127.0.0.1', 0) as staging_url:
+        asyncio.run(import_all(coherent_path, server.url, staging_path, staging_url, 0.0, None, ledger))
+
+        # kicked off once, polled until complete
+        assert server.polls == 3
+        expected_urls = {f"{staging_url}{resource_type}.ndjson"
+                         for resource_type in ['Encounter', 'Organization', 'Patient', 'Practitioner']}
+        assert set(server.fetched) == expected_urls
+        # the server read what was staged, references rewritten to ResourceType/id
+        encounter = json.loads(server.fetched[f"{staging_url}Encounter.ndjson"])
+        assert encounter['subject'] == {'reference': 'Patient/p1'}
+        assert encounter['serviceProvider'] == {'reference': 'Organization/o1'}
+        # only staging_path is served
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{staging_url}../fhir/p1.json")
+        assert all(ledger.loaded(server.url, path) for path in coherent_path.joinpath('fhir').glob('*.json'))
+
+        # nothing left to import
+        asyncio.run(import_all(coherent_path, server.url, staging_path, staging_url, 0.0, None, ledger))
+        assert server.polls == 3
@@ -0,0 +1,131 @@
+import hashlib
+import io
+import json
+import random
+
+import pytest
+from fhirclient.models.bundle import Bundle
+
+from bundle_stream import (BundleReader, BundleWriter, iter_bundle_resources, iter_reference_dicts, local_references,
+                           rewrite_references)
+
+
+def _random_value(rng: random.Random, depth=0):
+    kind = rng.choice(['int', 'float', 'string', 'bool', 'null'] + (['list', 'dict'] if depth < 3 else []))
+    if kind == 'int':
+        return rng.choice([0, -1, 7, 2 ** 53, rng.randint(-10 ** 6, 10 ** 6)])
+    if kind == 'float':
+        return rng.choice([0.0001, -2.5e-8, 1e300, 3.14159, rng.uniform(-1e6, 1e6)])
+    if kind == 'string':
+        return ''.join(rng.choice('ab "\\/\n\té€😀0.e[]{},:') for _ in range(rng.randint(0, 12)))
+    if kind == 'bool':
+        return rng.choice([True, False])
+    if kind == 'null':
+        return None
+    if kind == 'list':
+        return [_random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {f"k{i}": _random_value(rng, depth + 1) for i in range(rng.randint(0, 4))}
+
+
+def _random_bundle(rng: random.Random) -> dict:
+    bundle = {'resourceType': 'Bundle', 'type': 'transaction'}
+    for i in range(rng.randint(0, 3)):
+        bundle[f"before{i}"] = _random_value(rng)
+    bundle['entry'] = [
+        {'resource': {'resourceType': 'Observation', 'id': str(i), 'value': _random_value(rng)}}
+        for i in range(rng.randint(0, 6))
+    ]
+    for i in range(rng.randint(0, 2)):
+        bundle[f"after{i}"] = _random_value(rng)
+    return bundle
+
+
+def _write(tmp_path, text: str):
+    path = tmp_path.joinpath('bundle.json')
+    path.write_bytes(text.encode('utf-8'))
+    return path
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_reader_random_bundles(tmp_path, seed):
+    rng = random.Random(seed)
+    bundle = _random_bundle(rng)
+    text = json.dumps(bundle, ensure_ascii=rng.choice([True, False]), indent=rng.choice([None, 0, 2]))
+    path = _write(tmp_path, text + rng.choice(['', '\n', ' \r\n ']))
+    for chunk_size in [1, 2, 3, 5, 7, 64, 1024 * 1024]:
+        reader = BundleReader(path, chunk_size=chunk_size)
+        assert list(reader) == bundle['entry'], chunk_size
+        assert reader.header == {key: value for key, value in bundle.items() if key != 'entry'}, chunk_size
+        assert reader.md5 == hashlib.md5(path.read_bytes()).hexdigest()
+        assert reader.size == path.stat().st_size
+
+
+@pytest.mark.parametrize('number', ['0.0001', '-12.5e-3', '1E+10', '123456789', '-0'])
+def test_reader_number_split_at_every_boundary(tmp_path, number):
+    path = _write(tmp_path, f'{{"resourceType":"Bundle","x":{number},"entry":[{{"y":{number}}}],"z":{number}}}')
+    for chunk_size in range(1, 12):
+        reader = BundleReader(path, chunk_size=chunk_size)
+        assert list(reader) == [{'y': json.loads(number)}], chunk_size
+        assert reader.header == {'resourceType': 'Bundle', 'x': json.loads(number), 'z': json.loads(number)}
+
+
+def test_reader_empty(tmp_path):
+    for text in ['{}', '{"resourceType": "Bundle", "entry": []}', ' { } ']:
+        reader = BundleReader(_write(tmp_path, text), chunk_size=1)
+        assert list(reader) == []
+
+
+@pytest.mark.parametrize('text', ['', '[]', '{"entry": [1, 2', '{"a": 1 "b": 2}', '{"a": 1}x'])
+def test_reader_invalid(tmp_path, text):
+    with pytest.raises(json.JSONDecodeError):
+        list(BundleReader(_write(tmp_path, text), chunk_size=2))
+
+
+def test_iter_bundle_resources_not_a_bundle(tmp_path):
+    for text in ['{"resourceType": "Patient", "entry": [{"resource": {}}]}',
+                 '{"entry": [{"resource": {}}], "resourceType": "Patient"}',
+                 '{"entry": [{"resource": {}}]}']:
+        with pytest.raises(AssertionError):
+            list(iter_bundle_resources(_write(tmp_path, text)))
+
+
+def test_iter_bundle_resources_fhirclient_key_order(tmp_path):
+    """fhirclient's as_json() writes resourceType after entry, e.g. ingest --engine fhirclient output."""
+    resources = [{'resourceType': 'Patient', 'id': 'p1'}, {'resourceType': 'Observation', 'id': 'o1', 'status': 'final',
+                                                           'code': {'text': 'x'}}]
+    bundle_json = Bundle({'resourceType': 'Bundle', 'type': 'transaction',
+                          'entry': [{'resource': resource} for resource in resources]}).as_json()
+    assert list(bundle_json).index('entry') < list(bundle_json).index('resourceType')
+    path = _write(tmp_path, json.dumps(bundle_json))
+    assert list(iter_bundle_resources(path, chunk_size=7)) == resources
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_writer_round_trip(tmp_path, seed):
+    rng = random.Random(seed)
+    bundle = _random_bundle(rng)
+    fp = io.BytesIO()
+    with BundleWriter(fp, bundle) as writer:
+        for entry in bundle['entry']:
+            writer.write(entry)
+    assert writer.bytes_written == len(fp.getvalue())
+    written = json.loads(fp.getvalue())
+    assert written == {**{key: value for key, value in bundle.items() if key != 'entry'}, 'entry': bundle['entry']}
+
+    path = _write(tmp_path, fp.getvalue().decode('utf-8'))
+    reader = BundleReader(path, chunk_size=3)
+    assert list(reader) == bundle['entry']
+    assert reader.size == writer.bytes_written
+
+
+def test_local_and_rewrite_references():
+    entries = [
+        {'fullUrl': 'urn:uuid:p1', 'resource': {'resourceType': 'Patient', 'id': 'p1'}},
+        {'resource': {'resourceType': 'Encounter', 'id': 'e1', 'subject': {'reference': 'urn:uuid:p1'},
+                      'participant': [{'individual': {'reference': 'Practitioner/x'}}]}},
+    ]
+    references = local_references(entries)
+    assert references == {'Patient/p1': 'Patient/p1', 'urn:uuid:p1': 'Patient/p1', 'Encounter/e1': 'Encounter/e1'}
+    encounter = entries[1]['resource']
+    assert rewrite_references(encounter, references) == [{'reference': 'Practitioner/x'}]
+    assert [reference['reference'] for reference in iter_reference_dicts(encounter)] == ['Patient/p1', 'Practitioner/x']
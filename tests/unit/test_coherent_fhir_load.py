@@ -0,0 +1,77 @@
+from coherent_fhir_load import AdaptiveSplit, _split_entries
+
+
+def _entry(resource_type, id_, *references, full_url=True):
+    resource = {'resourceType': resource_type, 'id': id_}
+    for index, reference in enumerate(references):
+        resource[f"reference{index}"] = {'reference': reference}
+    entry = {'resource': resource, 'request': {'method': 'POST', 'url': resource_type}}
+    if full_url:
+        entry['fullUrl'] = f"urn:uuid:{id_}"
+    return entry
+
+
+def _ids(entries):
+    return [entry['resource']['id'] for entry in entries]
+
+
+def test_split_entries_referenced_first():
+    entries = [
+        _entry('Observation', 'o1', 'urn:uuid:e1', 'urn:uuid:p1'),
+        _entry('Encounter', 'e1', 'urn:uuid:p1'),
+        _entry('Condition', 'c1', 'Patient/p1'),
+        _entry('Patient', 'p1'),
+    ]
+    assert _ids(_split_entries(entries)) == ['p1', 'e1', 'o1', 'c1']
+
+
+def test_split_entries_rewrites_urn_uuid_and_puts():
+    entries = _split_entries([
+        _entry('Patient', 'p1'),
+        _entry('Encounter', 'e1', 'urn:uuid:p1', 'Practitioner?identifier=x|y', 'urn:uuid:elsewhere'),
+    ])
+    encounter = entries[1]
+    assert 'fullUrl' not in encounter
+    assert encounter['request'] == {'method': 'PUT', 'url': 'Encounter/e1'}
+    assert encounter['resource']['reference0'] == {'reference': 'Patient/p1'}
+    # not in the bundle, left for the server
+    assert encounter['resource']['reference1'] == {'reference': 'Practitioner?identifier=x|y'}
+    assert encounter['resource']['reference2'] == {'reference': 'urn:uuid:elsewhere'}
+
+
+def test_split_entries_keeps_other_full_urls():
+    entry = _entry('Patient', 'p1', full_url=False)
+    entry['fullUrl'] = 'http://example.com/fhir/Patient/p1'
+    assert _split_entries([entry])[0]['fullUrl'] == 'http://example.com/fhir/Patient/p1'
+
+
+def test_split_entries_cycle_keeps_file_order():
+    entries = [
+        _entry('Patient', 'p1'),
+        _entry('Encounter', 'e2', 'urn:uuid:e1'),
+        _entry('Encounter', 'e1', 'urn:uuid:e2', 'urn:uuid:p1'),
+        _entry('Encounter', 'e3', 'urn:uuid:e3'),
+    ]
+    # a self reference is not a dependency, the cycle follows the rest in file order
+    assert _ids(_split_entries(entries)) == ['p1', 'e3', 'e2', 'e1']
+
+
+def test_adaptive_split():
+    split = AdaptiveSplit(max_entries=500, max_bytes=5_000_000, target_latency=10.0)
+    assert (split.entries, split.bytes) == (500, 5_000_000)
+    split.observe(11.0)
+    assert (split.entries, split.bytes) == (250, 2_500_000)
+    split.observe(11.0)
+    assert split.entries == 125
+    split.observe(1.0)
+    assert split.entries == int(500 * 0.3)
+    for _ in range(100):
+        split.observe(1.0)
+    # never above the maximum
+    assert (split.entries, split.bytes) == (500, 5_000_000)
+    for _ in range(100):
+        split.observe(60.0)
+    # never below the minimum scale, or one entry
+    assert split.scale == AdaptiveSplit.MINIMUM_SCALE
+    assert split.entries == int(500 * AdaptiveSplit.MINIMUM_SCALE)
+    assert AdaptiveSplit(max_entries=1, max_bytes=1, target_latency=0.0).entries == 1
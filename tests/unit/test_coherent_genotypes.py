@@ -0,0 +1,55 @@
+import json
+
+import pyarrow as pa
+from fhirclient.models.bundle import Bundle
+
+from coherent_genotypes import main, open_genotypes, patient_genotypes, variant_carriers
+
+GENOTYPES = {
+    'p1': [('rs1', '1', 'AA'), ('rs2', '1', 'AG')],
+    'p2': [('rs2', '2', 'GG'), ('rs3', '2', 'CT'), ('rs1', '1', 'AT')],
+}
+
+
+def _ingest_output(tmp_path):
+    """ingest --engine fhirclient output, bundles written by Bundle.as_json(), resourceType after entry."""
+    output_path = tmp_path.joinpath('output')
+    output_path.mkdir()
+    bundles = {}
+    for patient_id, rows in GENOTYPES.items():
+        csv_path = tmp_path.joinpath(f"{patient_id}_dna.csv")
+        csv_path.write_text('variant,chromosome,genotype\n' + ''.join(f"{','.join(row)}\n" for row in rows))
+        bundle = Bundle({'resourceType': 'Bundle', 'type': 'transaction', 'entry': [
+            {'resource': {'resourceType': 'Patient', 'id': patient_id}},
+            {'resource': {'resourceType': 'DocumentReference', 'id': f"d-{patient_id}", 'status': 'current',
+                          'subject': {'reference': f"Patient/{patient_id}"},
+                          'content': [{'attachment': {'url': str(csv_path)}}]}},
+            {'resource': {'resourceType': 'DocumentReference', 'id': f"note-{patient_id}", 'status': 'current',
+                          'subject': {'reference': f"Patient/{patient_id}"},
+                          'content': [{'attachment': {'url': f"./output/clinical_reports/{patient_id}.txt"}}]}},
+        ]})
+        bundle_path = output_path.joinpath(f"{patient_id}.json")
+        bundle_path.write_text(json.dumps(bundle.as_json()))
+        bundles[str(bundle_path)] = {'patient_conditions': {'bundle_file_path': str(bundle_path)}}
+    output_path.joinpath('ingest_manifest.json').write_text(json.dumps({
+        'settings': {'output_format': 'bundle'}, 'bundles': bundles
+    }))
+    return output_path
+
+
+def test_genotypes_from_fhirclient_bundles(tmp_path):
+    output_path = _ingest_output(tmp_path)
+    main.main(['--output_path', str(output_path), '--workers', '2'], standalone_mode=False)
+
+    table, index = open_genotypes(output_path.joinpath('genotypes.arrow'))
+    assert table.num_rows == 5
+    assert pa.types.is_dictionary(table.schema.field('variant').type)
+    assert set(index) == {'d-p1', 'd-p2'}
+    assert index['d-p2']['patient_id'] == 'p2'
+    for patient_id, rows in GENOTYPES.items():
+        rows_table = patient_genotypes(table, index, f"d-{patient_id}")
+        assert rows_table.column('variant').to_pylist() == [row[0] for row in rows]
+        assert rows_table.column('genotype').to_pylist() == [row[2] for row in rows]
+    assert variant_carriers(table, 'rs1') == {'d-p1': 'AA', 'd-p2': 'AT'}
+    assert variant_carriers(table, 'rs3') == {'d-p2': 'CT'}
+    assert variant_carriers(table, 'rs404') == {}
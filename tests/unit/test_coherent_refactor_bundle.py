@@ -0,0 +1,73 @@
+import random
+
+import pytest
+
+from coherent_refactor_bundle import ASSERTATION_PATTERN, _parse_assertation, _parse_assertation_split
+
+SENTENCES = [
+    "The NOD2 gene with variant index rs2066844_T has clinical significance of 'risk factor' for an increased "
+    "risk of: Crohn's disease.",
+    "The TCF7L2 gene with variant index rs7903146 has clinical significance of 'Likely pathogenic' for an "
+    "increased risk of: Type 2 diabetes, obesity and Diabetes mellitus type 2.",
+    "The APOE gene with variant index rs429358_C has clinical significance of 'pathogenic' for an elevated risk "
+    "of: Alzheimer's disease and The other thing.",
+]
+
+# pieces the parsers split on, mixed into the sentences
+FRAGMENTS = ["The ", " gene", "of ", "'", "index ", " ", "_", "of: ", " an ", " and ", ",", ".", "\n", "x", "rs1"]
+
+
+def _parse(parser, sentence):
+    """Result, or the exception type raised."""
+    try:
+        return parser(sentence)
+    except Exception as e:
+        return type(e)
+
+
+def _mutate(rng: random.Random, sentence: str) -> str:
+    cuts = sorted(rng.sample(range(1, len(sentence)), 12))
+    pieces = [sentence[start:end] for start, end in zip([0] + cuts, cuts + [len(sentence)])]
+    for _ in range(rng.randint(1, 3)):
+        operation = rng.choice(['delete', 'insert', 'swap', 'duplicate'])
+        index = rng.randrange(len(pieces))
+        if operation == 'delete' and len(pieces) > 1:
+            del pieces[index]
+        elif operation == 'insert':
+            pieces.insert(index, rng.choice(FRAGMENTS))
+        elif operation == 'swap':
+            other = rng.randrange(len(pieces))
+            pieces[index], pieces[other] = pieces[other], pieces[index]
+        else:
+            pieces.insert(index, pieces[index])
+    return ''.join(pieces)
+
+
+@pytest.mark.parametrize('sentence', SENTENCES)
+def test_parse_assertation(sentence):
+    assert ASSERTATION_PATTERN.match(sentence)
+    assert _parse_assertation(sentence) == _parse_assertation_split(sentence)
+
+
+def test_parse_assertation_example():
+    assert _parse_assertation(SENTENCES[1]) == {
+        'gene': 'TCF7L2', 'significance': 'Likely pathogenic', 'snp_id': 'rs7903146', 'snp_capture': None,
+        'risk': 'increased risk', 'conditions': ['Type 2 diabetes', ' obesity', 'Diabetes mellitus type 2']
+    }
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_parse_assertation_matches_split(seed):
+    """The regex parser returns what the split parser returns, and raises when it raises."""
+    rng = random.Random(seed)
+    for _ in range(1000):
+        sentence = _mutate(rng, rng.choice(SENTENCES))
+        assert _parse(_parse_assertation, sentence) == _parse(_parse_assertation_split, sentence), sentence
+
+
+@pytest.mark.parametrize('sentence', ['', 'The BRCA1 gene', 'no gene here', 'The X gene of y'])
+def test_parse_assertation_raises(sentence):
+    with pytest.raises(Exception) as split_error:
+        _parse_assertation_split(sentence)
+    with pytest.raises(split_error.type):
+        _parse_assertation(sentence)
@@ -0,0 +1,80 @@
+import pytest
+
+from cohort_index import CohortIndex
+
+
+@pytest.fixture
+def cohort_index():
+    # built out of patient_id order, ordinals follow patient_id
+    return CohortIndex.build([
+        {'patient_id': 'p3', 'bundle_file_path': 'fhir/p3.json', 'conditions': [
+            {'code': 'asthma', 'display': 'Asthma'}, {'code': 'asthma', 'display': 'Asthma'}
+        ]},
+        {'patient_id': 'p1', 'bundle_file_path': 'fhir/p1.json', 'conditions': [
+            {'code': 'asthma', 'display': 'Asthma'}, {'code': 'diabetes', 'display': 'Diabetes'}
+        ]},
+        {'patient_id': 'p2', 'bundle_file_path': 'fhir/p2.json', 'conditions': [
+            {'code': 'diabetes', 'display': 'Diabetes'}, {'code': 'obesity'}
+        ]},
+        {'patient_id': 'p4', 'bundle_file_path': 'fhir/p4.json', 'conditions': []},
+    ])
+
+
+def test_build(cohort_index):
+    assert cohort_index.patients == ['p1', 'p2', 'p3', 'p4']
+    assert cohort_index.bundle_file_paths == ['fhir/p1.json', 'fhir/p2.json', 'fhir/p3.json', 'fhir/p4.json']
+    assert cohort_index.postings == {'asthma': 0b101, 'diabetes': 0b011, 'obesity': 0b010}
+    assert cohort_index.condition_counts == {'asthma': 3, 'diabetes': 2, 'obesity': 1}
+    assert cohort_index.displays == {'asthma': 'Asthma', 'diabetes': 'Diabetes', 'obesity': None}
+
+
+def test_save_load(cohort_index, tmp_path):
+    path = tmp_path.joinpath('cohort_index.json')
+    cohort_index.save(path)
+    loaded = CohortIndex.load(path)
+    assert vars(loaded) == vars(cohort_index)
+
+
+def test_save_load_many_patients(tmp_path):
+    patients = [
+        {'patient_id': f"p{ordinal:05}", 'bundle_file_path': f"fhir/p{ordinal:05}.json",
+         'conditions': [{'code': str(code)} for code in range(20) if ordinal % (code + 1) == 0]}
+        for ordinal in range(10_000)
+    ]
+    cohort_index = CohortIndex.build(patients)
+    path = tmp_path.joinpath('cohort_index.json')
+    cohort_index.save(path)
+    loaded = CohortIndex.load(path)
+    assert vars(loaded) == vars(cohort_index)
+    assert loaded.patient_count(loaded.query(all_of=['1'])) == 5_000
+
+
+def test_load_version(cohort_index, tmp_path):
+    path = tmp_path.joinpath('cohort_index.json')
+    path.write_text('{"version": 0}')
+    with pytest.raises(AssertionError):
+        CohortIndex.load(path)
+
+
+def test_query(cohort_index):
+    def patients(**query):
+        return cohort_index.patient_ids(cohort_index.query(**query))
+
+    assert patients(any_of=['asthma']) == ['p1', 'p3']
+    assert patients(any_of=['asthma', 'diabetes']) == ['p1', 'p2', 'p3']
+    assert patients(all_of=['asthma', 'diabetes']) == ['p1']
+    assert patients(any_of=['asthma', 'obesity'], all_of=['diabetes']) == ['p1', 'p2']
+    assert patients(any_of=['unknown']) == []
+    assert patients(all_of=['asthma', 'unknown']) == []
+    assert patients(any_of=['unknown', 'obesity']) == ['p2']
+    with pytest.raises(AssertionError):
+        cohort_index.query()
+
+
+def test_counts_and_paths(cohort_index):
+    bitmap = cohort_index.query(any_of=['asthma', 'diabetes'])
+    assert cohort_index.patient_count(bitmap) == 3
+    assert cohort_index.bundle_paths(bitmap) == ['fhir/p1.json', 'fhir/p2.json', 'fhir/p3.json']
+    # Conditions, not patients, as a FHIR server counts Condition?code=...&_summary=count
+    assert cohort_index.condition_count(['asthma', 'diabetes', 'asthma']) == 5
+    assert cohort_index.condition_count(['unknown']) == 0
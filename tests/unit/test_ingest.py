@@ -0,0 +1,410 @@
+import base64
+import json
+import os
+import uuid
+from pathlib import Path
+
+import pytest
+
+from fhirclient.models.bundle import BundleEntryRequest
+from fhirclient.models.diagnosticreport import DiagnosticReport
+from fhirclient.models.documentreference import DocumentReference
+from fhirclient.models.extension import Extension
+from fhirclient.models.imagingstudy import ImagingStudy
+from fhirclient.models.patient import Patient
+
+import ingest
+from cohort_index import CohortIndex
+from ingest import (DICOM_METADATA_URL, BundleIndex, PhaseTimer, _cached_patient_conditions,
+                    _document_reference_entries, _load_ingest_manifest, _manifest_entry, _replace_extension,
+                    _write_ingest_manifest)
+
+SYNTHEA = 'https://github.com/synthetichealth/synthea'
+ORGANIZATIONS = {'o1': str(uuid.uuid5(uuid.NAMESPACE_DNS, 'o1')), 'o2': str(uuid.uuid5(uuid.NAMESPACE_DNS, 'o2'))}
+PRACTITIONERS = {'pr1': str(uuid.uuid5(uuid.NAMESPACE_DNS, 'pr1')), 'pr2': str(uuid.uuid5(uuid.NAMESPACE_DNS, 'pr2'))}
+# given, family, condition code and display, organization and practitioner of the encounter
+PATIENTS = [
+    ('Jane', 'Doe', '44054006', 'Diabetes', 'o1', 'pr1'),
+    ('John', 'Roe', '7200002', 'Alcoholism', 'o2', 'pr2'),
+    ('Alice', 'Poe', '195662009', 'Acute viral pharyngitis (disorder)', 'o1', 'pr1'),
+]
+
+
+def _dicom_metadata(modality):
+    return Extension({'url': DICOM_METADATA_URL, 'extension': [{'url': 'Modality', 'valueString': modality}]})
+
+
+def test_replace_extension():
+    """An extension with the same url is replaced, others are kept."""
+    other = Extension({'url': 'http://example.org/other', 'valueString': 'x'})
+    extensions = _replace_extension([other, _dicom_metadata('CT')], _dicom_metadata('MR'))
+    assert [extension.as_json() for extension in extensions] == [other.as_json(), _dicom_metadata('MR').as_json()]
+    assert [extension.url for extension in _replace_extension(None, _dicom_metadata('MR'))] == [DICOM_METADATA_URL]
+
+
+def _imaging_bundle_index(dcm_path, report_count):
+    """A patient with report_count imaging reports of one ImagingStudy, all pointing at dcm_path."""
+    patient = Patient({'id': str(uuid.uuid4()), 'name': [{'given': ['Jane'], 'family': 'Doe'}]})
+    subject = {'reference': f"Patient/{patient.id}"}
+    text = f"imaging study stored in {dcm_path}"
+    document_reference = DocumentReference({
+        'id': str(uuid.uuid4()),
+        'status': 'current',
+        'category': [{'coding': [{'code': 'clinical-note'}]}],
+        'content': [{'attachment': {'data': base64.b64encode(text.encode()).decode()}}],
+    })
+    reports = [
+        DiagnosticReport({'id': str(uuid.uuid4()), 'status': 'final', 'code': {'coding': [{'code': 'imaging'}]}, 'subject': subject})
+        for _ in range(report_count)
+    ]
+    imaging_study = ImagingStudy({'id': str(uuid.uuid4()), 'status': 'available', 'subject': subject})
+    return BundleIndex(
+        patient=patient,
+        imaging_diagnostic_reports=reports,
+        imaging_document_references=[document_reference],
+        imaging_studies=[imaging_study],
+        attachment_text={document_reference.id: text},
+    )
+
+
+def test_dicom_header_read_once(tmp_path, monkeypatch):
+    """Reports sharing a .dcm read its header once and leave one dicom-metadata extension per resource."""
+    monkeypatch.chdir(tmp_path)
+    dcm_path = tmp_path / 'study.dcm'
+    dcm_path.write_bytes(b'not really dicom')
+    reads = []
+
+    def _dicom_metadata_extension(path):
+        reads.append(path)
+        return _dicom_metadata('CT')
+
+    monkeypatch.setattr(ingest, '_dicom_metadata_extension', _dicom_metadata_extension)
+    monkeypatch.setattr(ingest, 'WORKER_STATE', {'dicom_metadata': True, 'note_store': None, 'note_index': None})
+
+    bundle_index = _imaging_bundle_index(str(dcm_path), report_count=3)
+    additional_entries = _document_reference_entries(bundle_index, tmp_path / 'bundle.json', PhaseTimer())
+
+    assert reads == [str(dcm_path)]
+    assert len(additional_entries) == 3
+    for resource in additional_entries + bundle_index.imaging_studies:
+        assert [extension.url for extension in resource.extension] == [DICOM_METADATA_URL]
+
+
+def _patient_bundle(given, family, condition_code, condition_display, organization, practitioner):
+    """A synthea style bundle, urn:uuid and conditional references, a clinical note."""
+    patient_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, given))
+    encounter_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{given}-encounter"))
+    subject = {'reference': f"urn:uuid:{patient_id}"}
+    note = f"{given} was seen for {condition_display}."
+    resources = [
+        {'resourceType': 'Patient', 'id': patient_id, 'name': [{'given': [given], 'family': family}],
+         'gender': 'female', 'birthDate': '1970-01-01'},
+        {'resourceType': 'Encounter', 'id': encounter_id, 'status': 'finished',
+         'class': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'AMB'},
+         'subject': subject,
+         'participant': [{'individual': {
+             'reference': f"Practitioner?identifier={SYNTHEA}|{PRACTITIONERS[practitioner]}", 'display': 'Dr. Who'
+         }}],
+         'serviceProvider': {
+             'reference': f"Organization?identifier={SYNTHEA}|{ORGANIZATIONS[organization]}", 'display': organization
+         }},
+        {'resourceType': 'Condition', 'id': str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{given}-condition")),
+         'code': {'coding': [{'system': 'http://snomed.info/sct', 'code': condition_code,
+                              'display': condition_display}], 'text': condition_display},
+         'subject': subject, 'encounter': {'reference': f"urn:uuid:{encounter_id}"}},
+        {'resourceType': 'DocumentReference', 'id': str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{given}-note")),
+         'status': 'superseded', 'subject': subject,
+         'category': [{'coding': [{'system': 'http://hl7.org/fhir/us/core/CodeSystem/us-core-documentreference-category',
+                                   'code': 'clinical-note'}]}],
+         'content': [{'attachment': {'contentType': 'text/plain; charset=utf-8',
+                                     'data': base64.b64encode(note.encode()).decode()}}]},
+    ]
+    return {'resourceType': 'Bundle', 'type': 'transaction', 'entry': [
+        {'fullUrl': f"urn:uuid:{resource['id']}", 'resource': resource,
+         'request': {'method': 'POST', 'url': resource['resourceType']}}
+        for resource in resources
+    ]}
+
+
+@pytest.fixture
+def coherent_path(tmp_path, monkeypatch):
+    """Unzipped coherent data: the provider and organization csvs and a few patient bundles."""
+    # clinical notes and the file digest cache are written to the working directory
+    monkeypatch.chdir(tmp_path)
+    # coherent_fhir_load patches fhirclient to PUT on import, ingest runs without it
+    if 'as_json' in vars(BundleEntryRequest):
+        monkeypatch.delattr(BundleEntryRequest, 'as_json')
+    tmp_path.joinpath('output', 'clinical_reports').mkdir(parents=True)
+    coherent_path = tmp_path.joinpath('coherent')
+    coherent_path.joinpath('output', 'csv').mkdir(parents=True)
+    coherent_path.joinpath('output', 'fhir').mkdir()
+    coherent_path.joinpath('output', 'csv', 'organizations.csv').write_text(
+        'Id,NAME,ADDRESS,CITY,STATE,ZIP,LAT,LON,PHONE,REVENUE,UTILIZATION\n' + ''.join(
+            f"{id_},Clinic {name},1 Main St,Springfield,MA,01101,42.1,-72.5,555-0100,0.0,1\n"
+            for name, id_ in ORGANIZATIONS.items()
+        )
+    )
+    coherent_path.joinpath('output', 'csv', 'providers.csv').write_text(
+        'Id,ORGANIZATION,NAME,GENDER,SPECIALITY\n' + ''.join(
+            f"{id_},{ORGANIZATIONS[name.replace('pr', 'o')]},Dr. {name},F,GENERAL PRACTICE\n"
+            for name, id_ in PRACTITIONERS.items()
+        )
+    )
+    for patient in PATIENTS:
+        bundle = _patient_bundle(*patient)
+        bundle_path = coherent_path.joinpath('output', 'fhir', f"{patient[0]}_{patient[1]}_{bundle['entry'][0]['resource']['id']}.json")
+        bundle_path.write_text(json.dumps(bundle))
+    return coherent_path
+
+
+def _ingest(coherent_path, output_path, *arguments):
+    output_path.mkdir(exist_ok=True)
+    ingest.ingest.main(
+        ['--coherent_path', str(coherent_path), '--output_path', str(output_path), '--minimum_file_count', '1',
+         *arguments],
+        standalone_mode=False
+    )
+
+
+def _bundle_paths(coherent_path):
+    return sorted(coherent_path.joinpath('output', 'fhir').glob('*.json'))
+
+
+def _touch_outputs(output_path):
+    """Set the mtime of the transformed bundles to 0, a bundle transformed again gets a new one."""
+    for bundle_path in _bundle_paths(output_path.parent.joinpath('coherent')):
+        os.utime(output_path.joinpath(bundle_path.name), ns=(0, 0))
+
+
+def _transformed(output_path):
+    return sorted(
+        bundle_path.name for bundle_path in _bundle_paths(output_path.parent.joinpath('coherent'))
+        if os.stat(output_path.joinpath(bundle_path.name)).st_mtime_ns != 0
+    )
+
+
+def test_cached_patient_conditions(tmp_path, monkeypatch):
+    """size and mtime first, an mtime change alone is confirmed by md5."""
+    monkeypatch.chdir(tmp_path)
+    file_path = tmp_path.joinpath('bundle.json')
+    file_path.write_bytes(b'{"a": 1}')
+    output_file = tmp_path.joinpath('output.json')
+    output_file.write_text('{}')
+    stat = os.stat(file_path)
+    entry = _manifest_entry({
+        'patient_id': 'p1',
+        'conditions': [ingest.Coding({'system': 'http://snomed.info/sct', 'code': '44054006'})],
+        'bundle_file_path': output_file,
+        'add_to_research_study_bundle': ['Organization/o1'],
+        'source': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': ingest._file_attributes(file_path)[0]},
+    })
+    # the manifest is json
+    entry = json.loads(json.dumps(entry))
+
+    cached = _cached_patient_conditions(file_path, entry)
+    assert cached['patient_id'] == 'p1'
+    assert [coding.code for coding in cached['conditions']] == ['44054006']
+    assert cached['add_to_research_study_bundle'] == ['Organization/o1']
+
+    # touched, same content
+    os.utime(file_path, ns=(stat.st_mtime_ns + 10 ** 9, stat.st_mtime_ns + 10 ** 9))
+    assert _cached_patient_conditions(file_path, entry)['patient_id'] == 'p1'
+    assert entry['mtime_ns'] == stat.st_mtime_ns + 10 ** 9
+
+    # same size, different content
+    file_path.write_bytes(b'{"a": 2}')
+    assert _cached_patient_conditions(file_path, entry) is None
+
+    # no entry, or the output is gone
+    assert _cached_patient_conditions(file_path, None) is None
+    file_path.write_bytes(b'{"a": 1}')
+    os.utime(file_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    assert _cached_patient_conditions(file_path, entry) is not None
+    output_file.unlink()
+    assert _cached_patient_conditions(file_path, entry) is None
+
+
+def test_load_ingest_manifest(tmp_path):
+    manifest_path = tmp_path.joinpath('ingest_manifest.json')
+    settings = {'engine': 'fhirclient', 'global_resource_digests': {'output/csv/providers.csv': 'abc'}}
+    bundles = {'bundle.json': {'md5': 'def'}}
+    assert _load_ingest_manifest(manifest_path, settings) == {}
+    _write_ingest_manifest(manifest_path, settings, bundles)
+    assert _load_ingest_manifest(manifest_path, settings) == bundles
+    assert _load_ingest_manifest(manifest_path, {**settings, 'engine': 'dict'}) == {}
+    assert _load_ingest_manifest(
+        manifest_path, {**settings, 'global_resource_digests': {'output/csv/providers.csv': 'xyz'}}
+    ) == {}
+
+
+def test_incremental(coherent_path):
+    output_path = coherent_path.parent.joinpath('ingested')
+    bundle_paths = _bundle_paths(coherent_path)
+    _ingest(coherent_path, output_path)
+    assert len(json.loads(output_path.joinpath('ingest_manifest.json').read_text())['bundles']) == 3
+
+    # unchanged bundles are skipped
+    _touch_outputs(output_path)
+    _ingest(coherent_path, output_path)
+    assert _transformed(output_path) == []
+
+    # a changed bundle is transformed again
+    bundle = json.loads(bundle_paths[1].read_text())
+    bundle['entry'][0]['resource']['gender'] = 'other'
+    bundle_paths[1].write_text(json.dumps(bundle))
+    _ingest(coherent_path, output_path)
+    assert _transformed(output_path) == [bundle_paths[1].name]
+
+    # the global resources are part of every bundle's output
+    _touch_outputs(output_path)
+    providers_path = coherent_path.joinpath('output', 'csv', 'providers.csv')
+    providers_path.write_text(providers_path.read_text().replace('GENERAL PRACTICE', 'FAMILY PRACTICE'))
+    _ingest(coherent_path, output_path)
+    assert _transformed(output_path) == [bundle_path.name for bundle_path in bundle_paths]
+
+    # --no-incremental transforms everything
+    _touch_outputs(output_path)
+    _ingest(coherent_path, output_path, '--no-incremental')
+    assert _transformed(output_path) == [bundle_path.name for bundle_path in bundle_paths]
+
+
+def _ingest_output(output_path):
+    """Patient and research_study bundles ingest wrote, by file name."""
+    return {bundle_path.name: json.loads(bundle_path.read_text()) for bundle_path in sorted(output_path.glob('*.json'))
+            if bundle_path.name not in ('ingest_manifest.json', 'ingest_report.json', 'cohort_index.json')}
+
+
+def test_engines_agree(coherent_path):
+    output_path = coherent_path.parent.joinpath('ingested')
+    outputs = {}
+    for engine in ['fhirclient', 'dict', 'stream']:
+        _ingest(coherent_path, output_path, '--engine', engine, '--validate_sample_rate', '1', '--no-incremental')
+        outputs[engine] = _ingest_output(output_path)
+    assert len(outputs['fhirclient']) == len(PATIENTS) + 7
+    assert outputs['dict'] == outputs['fhirclient']
+    assert outputs['stream'] == outputs['fhirclient']
+    # references were rewritten
+    bundle = outputs['fhirclient'][_bundle_paths(coherent_path)[0].name]
+    encounter = next(entry['resource'] for entry in bundle['entry'] if entry['resource']['resourceType'] == 'Encounter')
+    assert encounter['subject']['reference'].startswith('Patient/')
+    assert encounter['serviceProvider']['reference'].startswith('Organization/')
+    research_subjects = [
+        entry['resource']['individual']['reference'] for entry in outputs['fhirclient']['research_study_Diabetes.json']['entry']
+        if entry['resource']['resourceType'] == 'ResearchSubject'
+    ]
+    assert research_subjects == [f"Patient/{uuid.uuid5(uuid.NAMESPACE_DNS, 'Jane')}"]
+
+
+def test_percentile():
+    assert ingest._percentile([], 50) is None
+    assert ingest._percentile([7], 99) == 7
+    values = list(range(1, 11))
+    assert [ingest._percentile(values, percent) for percent in [0, 10, 11, 50, 90, 99, 100]] == [1, 1, 2, 5, 9, 10, 10]
+
+
+def test_report_kept_by_noop_run(coherent_path):
+    output_path = coherent_path.parent.joinpath('ingested')
+    _ingest(coherent_path, output_path)
+    report = json.loads(output_path.joinpath('ingest_report.json').read_text())
+    assert report['bundles'] == len(PATIENTS)
+    assert report['phases']['total']['max'] == max(metric['seconds'] for metric in report['slowest'])
+
+    # nothing to transform, the report of the last run that did is kept
+    _ingest(coherent_path, output_path)
+    assert json.loads(output_path.joinpath('ingest_report.json').read_text()) == report
+
+
+def test_sample_key():
+    assert ingest._sample_key(Path('fhir/Jane_Doe_1234.json')) == '1234'
+    assert ingest._sample_key(Path('fhir/1234.json')) == '1234'
+    assert ingest._sample_key(Path('fhir/Jane_Doe_.json')) == 'Jane_Doe_'
+
+
+def _sample_population(count):
+    """file paths of count patients, every tenth has diabetes, the cohort index of a full run."""
+    file_paths = [Path(f"fhir/Given_Family_p{ordinal:04}.json") for ordinal in range(count)]
+    cohort_index = CohortIndex.build([
+        {'patient_id': f"p{ordinal:04}", 'bundle_file_path': str(file_path),
+         'conditions': [{'code': '44054006', 'display': 'Diabetes'}] if ordinal % 10 == 0 else []}
+        for ordinal, file_path in enumerate(file_paths)
+    ])
+    return file_paths, cohort_index
+
+
+def test_sample_fraction_and_seed():
+    file_paths, _ = _sample_population(2000)
+    study_manifests = ingest.create_study_manifests()
+    sample = ingest.sample_file_paths(file_paths, 0.1, 0, study_manifests)
+    assert 150 < len(sample) < 250
+    assert set(sample) <= set(file_paths)
+    # a seed always selects the same sample, a different seed another one
+    assert ingest.sample_file_paths(list(reversed(file_paths)), 0.1, 0, study_manifests) == sample
+    assert ingest.sample_file_paths(file_paths, 0.1, 1, study_manifests) != sample
+
+
+def test_sample_covers_every_study():
+    file_paths, cohort_index = _sample_population(200)
+    study_manifests = ingest.create_study_manifests()
+    diabetes = cohort_index.query(any_of=study_manifests['Diabetes']['conditions'])
+    diabetes_paths = {Path(bundle_path) for bundle_path in cohort_index.bundle_paths(diabetes)}
+    stratified = 0
+    for seed in range(20):
+        unstratified = ingest.sample_file_paths(file_paths, 0.05, seed, study_manifests)
+        sample = ingest.sample_file_paths(file_paths, 0.05, seed, study_manifests, cohort_index)
+        # stratification only adds members of under-sampled studies
+        assert set(unstratified) <= set(sample)
+        assert set(sample) - set(unstratified) <= diabetes_paths
+        # ceil(0.05 * 20)
+        assert len(diabetes_paths.intersection(sample)) >= 1
+        stratified += not diabetes_paths.intersection(unstratified)
+    # the hash alone misses the study for some seeds
+    assert stratified
+
+
+def test_referenced_global_resources(coherent_path):
+    global_resources = ingest.create_global_resources(coherent_path)
+    assert len(global_resources) == 6
+
+    def _references(resources):
+        return [f"{resource.resource_type}/{resource.id}" for resource in resources]
+
+    # a practitioner brings its organization
+    assert _references(ingest._referenced_global_resources(
+        global_resources, {f"Practitioner/{PRACTITIONERS['pr1']}", 'Patient/p1'}
+    )) == [f"Organization/{ORGANIZATIONS['o1']}", f"Practitioner/{PRACTITIONERS['pr1']}"]
+    assert ingest._referenced_global_resources(global_resources, set()) == []
+
+
+def _study_global_resources(output_path):
+    """research_study title -> the global resources in its bundle."""
+    return {
+        bundle_path.name: sorted(
+            f"{entry['resource']['resourceType']}/{entry['resource']['id']}" for entry in json.loads(bundle_path.read_text())['entry']
+            if entry['resource']['resourceType'] in ('Organization', 'Practitioner', 'Location')
+        )
+        for bundle_path in output_path.glob('research_study_*.json')
+    }
+
+
+def test_study_global_resources(coherent_path):
+    output_path = coherent_path.parent.joinpath('ingested')
+    _ingest(coherent_path, output_path, '--study_global_resources', 'referenced')
+    study_global_resources = _study_global_resources(output_path)
+    assert study_global_resources.pop('research_study_Diabetes.json') == [
+        f"Organization/{ORGANIZATIONS['o1']}", f"Practitioner/{PRACTITIONERS['pr1']}"
+    ]
+    assert study_global_resources.pop('research_study_Alcoholism.json') == [
+        f"Organization/{ORGANIZATIONS['o2']}", f"Practitioner/{PRACTITIONERS['pr2']}"
+    ]
+    # studies without subjects
+    assert len(study_global_resources) == 5
+    assert all(resources == [] for resources in study_global_resources.values())
+
+    # incremental runs keep what cached bundles referenced
+    _ingest(coherent_path, output_path, '--study_global_resources', 'referenced')
+    assert _study_global_resources(output_path)['research_study_Diabetes.json'] == [
+        f"Organization/{ORGANIZATIONS['o1']}", f"Practitioner/{PRACTITIONERS['pr1']}"
+    ]
+
+    _ingest(coherent_path, output_path)
+    assert all(len(resources) == 6 for resources in _study_global_resources(output_path).values())
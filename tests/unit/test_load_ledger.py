@@ -0,0 +1,178 @@
+import asyncio
+import gzip
+import json
+import threading
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from coherent_fhir_load import AdaptiveSplit, Retry, load, load_all, main
+from load_ledger import LoadLedger
+
+
+class _FhirServer:
+    """Transaction endpoint in a thread, fails the first `failures` POSTs of each bundle with 503."""
+
+    def __init__(self, failures=2, always_fail=()):
+        self.failures = failures
+        self.always_fail = always_fail
+        self.posts = {}
+        # (Content-Encoding, decompressed body) of each POST
+        self.bodies = []
+        self.url = None
+        self._started = threading.Event()
+
+    async def _transaction(self, request):
+        body = await request.read()
+        # aiohttp decompresses the body, unless a proxy in between already has
+        if body.startswith(b'\x1f\x8b'):
+            body = gzip.decompress(body)
+        self.bodies.append((request.headers.get('Content-Encoding'), body))
+        bundle = json.loads(body)
+        id_ = bundle['entry'][0]['resource']['id']
+        self.posts[id_] = self.posts.get(id_, 0) + 1
+        if id_ in self.always_fail or self.posts[id_] <= self.failures:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return web.json_response({'resourceType': 'Bundle', 'type': 'transaction-response'})
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post('/fhir', self._transaction)
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.url = f"http://127.0.0.1:{runner.addresses[0][1]}/fhir"
+        self._started.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(runner.cleanup())
+
+    def __enter__(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._started.wait()
+        return self
+
+    def __exit__(self, *args):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@pytest.fixture
+def coherent_path(tmp_path, monkeypatch):
+    # the file digest cache is written to the working directory
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('fhir').mkdir()
+    for id_ in ['organizations', 'practitioners', 'p1', 'p2', 'p3']:
+        bundle = {'resourceType': 'Bundle', 'type': 'transaction', 'entry': [
+            {'fullUrl': f"urn:uuid:{id_}", 'resource': {'resourceType': 'Patient', 'id': id_},
+             'request': {'method': 'POST', 'url': 'Patient'}}
+        ]}
+        tmp_path.joinpath('fhir', f"{id_}.json").write_text(json.dumps(bundle))
+    return tmp_path
+
+
+def test_retry_delay():
+    retry = Retry(max_retries=6, base=1.0, maximum=60.0)
+    for attempt in range(10):
+        assert 0 <= retry.delay(attempt) <= min(60.0, 2 ** attempt)
+    # at least Retry-After, at most the maximum
+    assert retry.delay(0, '30') >= 30
+    assert retry.delay(0, '3600') == 60.0
+    assert retry.delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT') <= 1.0
+
+
+@pytest.mark.parametrize('split', [False, True])
+def test_retry_then_resume(coherent_path, split):
+    ledger = LoadLedger(coherent_path.joinpath('ledger.sqlite'))
+    retry = Retry(max_retries=3, base=0.001, maximum=0.01)
+    with _FhirServer(failures=2) as server:
+        split_ = AdaptiveSplit(500, 5_000_000, 10.0) if split else None
+        assert asyncio.run(load_all(coherent_path, server.url, 2, split_, False, retry, ledger)) == {}
+        # two 503s, then loaded
+        assert server.posts == {id_: 3 for id_ in ['organizations', 'practitioners', 'p1', 'p2', 'p3']}
+        assert all(ledger.loaded(server.url, path) for path in coherent_path.joinpath('fhir').glob('*.json'))
+
+        # nothing left to load
+        assert asyncio.run(load_all(coherent_path, server.url, 2, split_, False, retry, ledger)) == {}
+        assert sum(server.posts.values()) == 15
+
+        # a changed bundle loads again
+        path = coherent_path.joinpath('fhir', 'p2.json')
+        path.write_text(path.read_text() + '\n')
+        assert asyncio.run(load_all(coherent_path, server.url, 2, split_, False, retry, ledger)) == {}
+        assert server.posts['p2'] == 4
+        assert sum(server.posts.values()) == 16
+
+
+def test_failed_bundle_is_retried_by_the_next_run(coherent_path):
+    ledger = LoadLedger(coherent_path.joinpath('ledger.sqlite'))
+    retry = Retry(max_retries=2, base=0.001, maximum=0.01)
+    with _FhirServer(failures=0, always_fail=['p2']) as server:
+        failures = asyncio.run(load_all(coherent_path, server.url, 2, None, False, retry, ledger))
+        assert list(failures) == [str(coherent_path.joinpath('fhir', 'p2.json'))]
+        # the other bundles loaded
+        assert server.posts == {'organizations': 1, 'practitioners': 1, 'p1': 1, 'p2': 3, 'p3': 1}
+
+        server.always_fail = []
+        assert asyncio.run(load_all(coherent_path, server.url, 2, None, False, retry, ledger)) == {}
+        assert server.posts == {'organizations': 1, 'practitioners': 1, 'p1': 1, 'p2': 4, 'p3': 1}
+
+
+def test_dependency_failure_stops_the_run(coherent_path):
+    retry = Retry(max_retries=1, base=0.001, maximum=0.01)
+    with _FhirServer(failures=0, always_fail=['organizations']) as server:
+        with pytest.raises(Exception):
+            asyncio.run(load_all(coherent_path, server.url, 2, None, False, retry, None))
+        assert 'p1' not in server.posts
+
+
+def test_no_resume_forgets(coherent_path):
+    ledger_path = str(coherent_path.joinpath('ledger.sqlite'))
+    with _FhirServer(failures=0) as server:
+        arguments = ['--coherent_path', str(coherent_path), '--url', server.url, '--ledger', ledger_path,
+                     '--split_entries', '0']
+        main.main(arguments, standalone_mode=False)
+        main.main(arguments, standalone_mode=False)
+        assert set(server.posts.values()) == {1}
+        main.main(arguments + ['--no-resume'], standalone_mode=False)
+        assert set(server.posts.values()) == {2}
+
+
+def test_split_reads_entries_streamed(coherent_path):
+    """A split bundle is read with BundleReader, resourceType may follow entry as fhirclient writes it."""
+    path = coherent_path.joinpath('fhir', 'p4.json')
+    entries = [
+        {'fullUrl': f"urn:uuid:p4-{index}", 'resource': {'resourceType': 'Patient', 'id': f"p4-{index}"},
+         'request': {'method': 'POST', 'url': 'Patient'}}
+        for index in range(5)
+    ]
+    path.write_text(json.dumps({'entry': entries, 'type': 'transaction', 'resourceType': 'Bundle'}))
+
+    async def _load(url):
+        async with aiohttp.ClientSession() as session:
+            return await load(session, path, url, AdaptiveSplit(2, 5_000_000, 10.0))
+
+    with _FhirServer(failures=0) as server:
+        assert asyncio.run(_load(server.url)) > 0
+        assert server.posts == {'p4-0': 1, 'p4-2': 1, 'p4-4': 1}
+
+
+def test_gzip_streams_whole_file(coherent_path):
+    """Without split the file is streamed through gzip, the server sees the file's bytes."""
+    path = coherent_path.joinpath('fhir', 'p1.json')
+    # compressible
+    path.write_text(json.dumps({'resourceType': 'Bundle', 'type': 'transaction', 'entry': [
+        {'fullUrl': f"urn:uuid:p1-{index}", 'resource': {'resourceType': 'Patient', 'id': f"p1-{index}"},
+         'request': {'method': 'POST', 'url': 'Patient'}}
+        for index in range(100)
+    ]}))
+
+    async def _load(url):
+        async with aiohttp.ClientSession() as session:
+            return await load(session, path, url, compress=True)
+
+    with _FhirServer(failures=0) as server:
+        wire_bytes = asyncio.run(_load(server.url))
+        assert server.bodies == [('gzip', path.read_bytes())]
+        assert 0 < wire_bytes < path.stat().st_size
@@ -0,0 +1,69 @@
+import hashlib
+import sqlite3
+
+import pytest
+
+from note_store import NoteStore, open_note_store, parse_url
+
+
+def test_put_commit_get(tmp_path):
+    store = NoteStore(tmp_path.joinpath('notes.sqlite'))
+    md5, size = store.put(b'note one', 'p1', 'd1')
+    assert (md5, size) == (hashlib.md5(b'note one').hexdigest(), 8)
+    # buffered until commit
+    assert store.get(md5) is None
+    store.put(b'note one', 'p1', 'd2')
+    store.put(b'note two', 'p2', 'd3')
+    store.commit()
+    assert store.get(md5) == b'note one'
+    assert store.get('0' * 32) is None
+    # the same text is stored once
+    assert store.connection.execute('SELECT COUNT(*) FROM note').fetchone()[0] == 2
+    assert sorted(store.members()) == [
+        ('d1', 'p1', md5), ('d2', 'p1', md5), ('d3', 'p2', hashlib.md5(b'note two').hexdigest())
+    ]
+    store.close()
+
+
+def test_put_holds_no_lock(tmp_path):
+    """A worker's buffered notes do not block other writers, the lock is only taken in commit()."""
+    path = tmp_path.joinpath('notes.sqlite')
+    store = NoteStore(path)
+    store.put(b'note one', 'p1', 'd1')
+    other = NoteStore(path)
+    other.connection.execute('BEGIN IMMEDIATE')
+    other.connection.execute('ROLLBACK')
+    other.close()
+    store.close()
+    assert NoteStore(path).get(hashlib.md5(b'note one').hexdigest()) == b'note one'
+
+
+def test_url_round_trip(tmp_path):
+    store = NoteStore(tmp_path.joinpath('notes.sqlite'))
+    md5, _ = store.put(b'note one', 'p1', 'd1')
+    store.close()
+    assert parse_url(store.url(md5)) == (str(tmp_path.joinpath('notes.sqlite')), md5)
+    assert open_note_store(parse_url(store.url(md5))[0]).get(md5) == b'note one'
+
+
+@pytest.mark.parametrize('url', [None, '', './output/clinical_reports/p1_d1.txt', 'notes.sqlite', 'notes.txt#abc'])
+def test_parse_url_other_urls(url):
+    assert parse_url(url) is None
+
+
+def test_read_only(tmp_path):
+    path = tmp_path.joinpath('notes.sqlite')
+    store = NoteStore(path)
+    md5, _ = store.put(b'note one', 'p1', 'd1')
+    store.close()
+
+    reader = NoteStore(path, read_only=True)
+    assert reader.get(md5) == b'note one'
+    reader.put(b'note two', 'p1', 'd2')
+    with pytest.raises(sqlite3.OperationalError):
+        reader.commit()
+
+    # never created
+    with pytest.raises(sqlite3.OperationalError):
+        NoteStore(tmp_path.joinpath('missing.sqlite'), read_only=True)
+    assert not tmp_path.joinpath('missing.sqlite').exists()